@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Document, DocumentRevision, EntityType, EntityDocument,Transcription
+from .models import Document, DocumentRevision, EntityType, EntityDocument, Page, QuarantinedRecord, Transcription
 import nested_admin
 
 class EntityDocumentInline(nested_admin.NestedTabularInline):
@@ -26,9 +26,24 @@ class TranscriptionInline(nested_admin.NestedTabularInline):
 	can_delete=False
 	extra=0
 
+class PageInline(nested_admin.NestedTabularInline):
+	model=Page
+	readonly_fields=(
+		'page_number',
+		'image_url',
+		'width',
+		'height',
+		'api_version',
+		'profile_level'
+		)
+	classes=['collapse']
+	can_delete=False
+	extra=0
+
 class DocumentRevisionInline(nested_admin.NestedStackedInline):
 	model=DocumentRevision
 	inlines=(
+		PageInline,
 		TranscriptionInline,
 	)
 	readonly_fields=(
@@ -36,7 +51,9 @@ class DocumentRevisionInline(nested_admin.NestedStackedInline):
 		'status',
 		'revision_number',
 		'timestamp',
-		'content'
+		'content',
+		'manifest_fingerprint',
+		'content_hash'
 	)
 	classes=['collapse']
 	can_delete=False
@@ -54,3 +71,12 @@ class DocumentAdmin(nested_admin.NestedModelAdmin):
 
 
 admin.site.register(Document,DocumentAdmin)
+
+class QuarantinedRecordAdmin(admin.ModelAdmin):
+	readonly_fields=['source','key','error','data','timestamp']
+	search_fields=['key']
+	list_display=['key','source','timestamp']
+	list_filter=['source']
+
+
+admin.site.register(QuarantinedRecord,QuarantinedRecordAdmin)
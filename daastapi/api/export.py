@@ -0,0 +1,61 @@
+"""
+Export of the published catalog as newline delimited JSON
+"""
+
+import datetime
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from api.models import PublishedDocument, Transcription
+
+def export_lines(after: str | None = None,
+                 since: datetime.datetime | None = None,
+                 transcriptions: bool = False,
+                 entities: bool = False,
+                 batch_size: int = 1000):
+    """
+    Generate one JSON line per published document, ordered by document key.
+    The documents are read with a server-side cursor (where the database
+    supports it) and transcriptions are fetched for each batch of documents,
+    so memory usage does not depend on the size of the catalog.
+
+    An export can be resumed after the key of the last document received,
+    and limited to the documents updated since a given time.
+    """
+    qs = PublishedDocument.objects.order_by('key')
+    if after:
+        qs = qs.filter(key__gt=after)
+    if since:
+        qs = qs.filter(updated__gte=since)
+    fields = ['revision_id', 'key', 'revision_number', 'label', 'timestamp', 'thumbnail',
+              'bib', 'updated']
+    if entities:
+        fields.append('entities')
+    batch = []
+    for item in qs.values(*fields).iterator(chunk_size=batch_size):
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield from _batch_lines(batch, transcriptions)
+            batch = []
+    yield from _batch_lines(batch, transcriptions)
+
+def _batch_lines(batch: list[dict], transcriptions: bool):
+    pages = {}
+    if transcriptions and batch:
+        items = Transcription.objects \
+            .filter(document_rev_id__in=[item['revision_id'] for item in batch]) \
+            .order_by('document_rev_id', 'page_number', 'pk') \
+            .values_list('document_rev_id', 'page_number', 'language_code',
+                         'is_translation', 'text')
+        for (rev_id, page_number, language_code, is_translation, text) in items:
+            pages.setdefault(rev_id, []).append({
+                'page': page_number,
+                'language': language_code,
+                'is_translation': is_translation,
+                'text': text
+            })
+    for item in batch:
+        rev_id = item.pop('revision_id')
+        item['thumb'] = item.pop('thumbnail')
+        if transcriptions:
+            item['transcriptions'] = pages.get(rev_id, [])
+        yield json.dumps(item, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
@@ -0,0 +1,151 @@
+"""
+Full-text search over document transcriptions and labels
+
+The transcription index is an FTS5 table on SQLite and a GIN text search
+index on PostgreSQL, both created by migration 0008 and kept in sync by the
+database. The normalized labels of published documents have a trigram index
+(migration 0011).
+"""
+
+import re
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+_highlight_start = '<mark>'
+_highlight_end = '</mark>'
+
+def _terms(text: str):
+    return re.findall(r"\w+", text)
+
+def _fts5_query(text: str):
+    # Quote every term so that user input never breaks the FTS5 query syntax,
+    # all the terms must match.
+    return ' '.join(f'"{term}"' for term in _terms(text))
+
+def _tsquery(text: str):
+    return ' & '.join(_terms(text))
+
+def is_supported():
+    """
+    Whether the database has a full-text index of the transcriptions.
+    """
+    return connection.vendor in ('sqlite', 'postgresql')
+
+def has_terms(text: str | None):
+    """
+    Whether the text contains any searchable term.
+    """
+    return bool(text and _terms(text))
+
+def _matches_sql(text: str, language: str | None):
+    """
+    SQL selecting (revision id, rank) of the transcriptions matching the text,
+    where lower ranks are better matches.
+    """
+    if connection.vendor == 'sqlite':
+        sql = "SELECT document_rev_id, rank FROM api_transcription_fts " + \
+            "WHERE api_transcription_fts MATCH %s"
+        params = [_fts5_query(text)]
+        if language:
+            sql += " AND language_code = %s"
+            params.append(language)
+        return (sql, params)
+    sql = "SELECT document_rev_id, " + \
+        "-ts_rank(to_tsvector('simple', text), to_tsquery('simple', %s)) AS rank " + \
+        "FROM api_transcription WHERE to_tsvector('simple', text) @@ to_tsquery('simple', %s)"
+    params = [_tsquery(text), _tsquery(text)]
+    if language:
+        sql += " AND language_code = %s"
+        params.append(language)
+    return (sql, params)
+
+def matching_revisions(text: str, language: str | None = None):
+    """
+    An expression selecting the ids of the revisions with a transcription that
+    matches the text, to be used in an `__in` filter.
+    """
+    (sql, params) = _matches_sql(text, language)
+    return RawSQL(f"SELECT document_rev_id FROM ({sql}) AS fts_matches", params)
+
+def rank_revisions(text: str, language: str | None, revision_ids, limit: int, offset: int = 0,
+                   after: tuple[float, int] | None = None):
+    """
+    Rank the revisions selected by the revision_ids queryset (a values
+    queryset with a single id column) by their best matching transcription.
+    Returns a page of (revision id, score) tuples, best matches first, where
+    higher scores are better matches. If after is a (score, revision id)
+    tuple, the page starts right after that result.
+    """
+    (sql, params) = _matches_sql(text, language)
+    (ids_sql, ids_params) = revision_ids.query.sql_with_params()
+    params = [*params, *ids_params]
+    sql = f"SELECT document_rev_id, MIN(rank) AS best FROM ({sql}) AS fts_matches " + \
+        f"WHERE document_rev_id IN ({ids_sql}) GROUP BY document_rev_id "
+    if after:
+        sql += "HAVING MIN(rank) > %s OR (MIN(rank) = %s AND document_rev_id > %s) "
+        params += [-after[0], -after[0], after[1]]
+    sql += "ORDER BY best, document_rev_id LIMIT %s OFFSET %s"
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [*params, limit, offset])
+        return [(rev_id, -best) for (rev_id, best) in cursor.fetchall()]
+
+def matching_labels(normalized_label: str):
+    """
+    An expression selecting the ids of the published documents whose
+    normalized label contains the given normalized label, to be used in an
+    `__in` filter. Returns None if the label index cannot serve the match,
+    in which case a `normalized_label__contains` filter should be used (on
+    PostgreSQL the trigram index serves that filter directly).
+    """
+    # Trigrams can only match 3 characters or more.
+    if connection.vendor != 'sqlite' or len(normalized_label) < 3:
+        return None
+    phrase = '"' + normalized_label.replace('"', '""') + '"'
+    return RawSQL("SELECT rowid FROM api_publisheddocument_label_fts " + \
+        "WHERE api_publisheddocument_label_fts MATCH %s", [phrase])
+
+def snippets(revision_ids: list[int], text: str, language: str | None = None, limit: int = 3):
+    """
+    Highlighted snippets of the transcriptions of the given revisions that
+    match the text. Returns a dict indexed by revision id whose values are
+    lists of matches with the page number, language and snippet, best matches
+    first.
+    """
+    if not revision_ids:
+        return {}
+    placeholders = ', '.join(['%s'] * len(revision_ids))
+    if connection.vendor == 'sqlite':
+        sql = "SELECT f.document_rev_id, t.page_number, t.language_code, " + \
+            f"snippet(api_transcription_fts, 0, '{_highlight_start}', '{_highlight_end}', '…', 16) " + \
+            "FROM api_transcription_fts f JOIN api_transcription t ON t.id = f.rowid " + \
+            "WHERE api_transcription_fts MATCH %s " + \
+            f"AND f.document_rev_id IN ({placeholders})"
+        params = [_fts5_query(text), *revision_ids]
+        if language:
+            sql += " AND f.language_code = %s"
+            params.append(language)
+        sql += " ORDER BY f.rank"
+    else:
+        sql = "SELECT document_rev_id, page_number, language_code, " + \
+            "ts_headline('simple', text, q, %s) " + \
+            "FROM api_transcription, to_tsquery('simple', %s) q " + \
+            "WHERE to_tsvector('simple', text) @@ q " + \
+            f"AND document_rev_id IN ({placeholders})"
+        params = [f"StartSel={_highlight_start},StopSel={_highlight_end},MaxFragments=2",
+                  _tsquery(text), *revision_ids]
+        if language:
+            sql += " AND language_code = %s"
+            params.append(language)
+        sql += " ORDER BY ts_rank(to_tsvector('simple', text), q) DESC"
+    result = {}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        for (rev_id, page_number, language_code, snippet) in cursor.fetchall():
+            matches = result.setdefault(rev_id, [])
+            if len(matches) < limit:
+                matches.append({
+                    'page': page_number,
+                    'language': language_code,
+                    'snippet': snippet
+                })
+    return result
@@ -0,0 +1,340 @@
+"""
+Helpers for talking to IIIF Image API servers
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from django.utils import timezone
+from api.models import ImageServiceInfo
+
+# Maximum number of image service URLs per cache query, keeping well under the
+# limit of query parameters of SQLite.
+_lookup_batch_size = 500
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request to an image server whose circuit
+    breaker is open after too many consecutive failures.
+    """
+
+class HostPolicy:
+    """
+    Limits applied to the requests sent to each image server host.
+    """
+
+    def __init__(self, concurrency: int = 4, rate: float = 10, retries: int = 3,
+                 backoff: float = 0.5, failure_threshold: int = 5, cooldown: float = 60):
+        # Maximum number of concurrent requests.
+        self.concurrency = max(1, concurrency)
+        # Sustained number of requests per second (token bucket), 0 for no limit.
+        self.rate = rate
+        # Number of retries of a failed request, with exponential backoff
+        # starting at the given number of seconds.
+        self.retries = retries
+        self.backoff = backoff
+        # Number of consecutive failed requests that open the circuit breaker
+        # and the number of seconds before requests are attempted again.
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+class _TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token from the bucket, waiting for it to be refilled if needed.
+        """
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class _HostState:
+    """
+    The connections, limits, circuit breaker and statistics of a host.
+    """
+
+    def __init__(self, policy: HostPolicy):
+        self.policy = policy
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=policy.concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.slots = threading.BoundedSemaphore(policy.concurrency)
+        self.bucket = _TokenBucket(policy.rate, policy.concurrency)
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.skipped = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def check_circuit(self, host: str):
+        """
+        Raise CircuitOpenError if requests to the host should be skipped.
+        """
+        with self.lock:
+            if time.monotonic() < self.open_until:
+                self.skipped += 1
+                raise CircuitOpenError(f"Circuit open for image server {host}")
+
+    def record(self, latency: float, failed: bool):
+        """
+        Record the outcome of a request and open the circuit when the host
+        keeps failing.
+        """
+        with self.lock:
+            self.requests += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            if not failed:
+                self.consecutive_failures = 0
+                return
+            self.errors += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.policy.failure_threshold:
+                self.open_until = time.monotonic() + self.policy.cooldown
+
+    def stats(self):
+        """
+        A summary of the requests sent to the host.
+        """
+        avg_latency = self.total_latency / self.requests if self.requests else 0
+        return f"{self.requests} requests, {self.errors} errors, {self.retries} retries, " + \
+            f"{self.skipped} skipped, latency avg {avg_latency * 1000:.0f} ms/" + \
+            f"max {self.max_latency * 1000:.0f} ms"
+
+def _is_retryable(ex: Exception):
+    if isinstance(ex, requests.HTTPError):
+        return ex.response is not None and \
+            (ex.response.status_code == 429 or ex.response.status_code >= 500)
+    return isinstance(ex, (requests.ConnectionError, requests.Timeout))
+
+class ImageInfoFetcher:
+    """
+    Fetches the info.json of IIIF image services concurrently. A pooled
+    keep-alive session is kept for each image server host so that consecutive
+    pages of a document reuse the same connections.
+
+    Requests to each host are limited by a HostPolicy: a cap on concurrent
+    requests, a token-bucket rate limit, retries with exponential backoff and
+    a circuit breaker that skips the pages of a failing host.
+    """
+
+    def __init__(self, workers: int = 8, timeout: int = 30, policy: HostPolicy | None = None):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.policy = policy or HostPolicy()
+        self._hosts: dict[str, _HostState] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix='iiif-info')
+
+    def _host(self, host: str) -> _HostState:
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None:
+                state = _HostState(self.policy)
+                self._hosts[host] = state
+            return state
+
+    def fetch(self, img_url_base: str):
+        """
+        Fetch the info.json of a single image service.
+        """
+        return self.fetch_conditional(img_url_base)[0]
+
+    def _request(self, state: _HostState, url: str, headers: dict):
+        state.bucket.acquire()
+        with state.slots:
+            start = time.monotonic()
+            try:
+                res = state.session.get(url, headers=headers, timeout=self.timeout)
+                info = None
+                if res.status_code != 304:
+                    res.raise_for_status()
+                    info = res.json()
+            except Exception:
+                state.record(time.monotonic() - start, True)
+                raise
+            state.record(time.monotonic() - start, False)
+            return (res, info)
+
+    def fetch_conditional(self, img_url_base: str,
+                          etag: str | None = None, last_modified: str | None = None):
+        """
+        Fetch the info.json of a single image service, revalidating with the
+        given HTTP validators if any. Returns a tuple (info, etag,
+        last_modified) where info is None if the server reported that the
+        document was not modified.
+        """
+        host = urlparse(img_url_base).netloc
+        state = self._host(host)
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        attempt = 0
+        while True:
+            state.check_circuit(host)
+            try:
+                (res, info) = self._request(state, f"{img_url_base}/info.json", headers)
+                break
+            except Exception as ex:
+                if attempt >= self.policy.retries or not _is_retryable(ex):
+                    raise
+                with state.lock:
+                    state.retries += 1
+                time.sleep(self.policy.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+                attempt += 1
+        etag = res.headers.get('ETag', etag)
+        last_modified = res.headers.get('Last-Modified', last_modified)
+        return (info, etag, last_modified)
+
+    def map(self, fn, items):
+        """
+        Apply fn to the items using the fetcher's worker threads. The results
+        are returned in the same order as the input.
+        """
+        return list(self._executor.map(fn, items))
+
+    def fetch_all(self, img_url_bases: list[str]):
+        """
+        Fetch the info.json of all the given image services in parallel. The
+        results are returned in the same order as the input.
+        """
+        return self.map(self.fetch, img_url_bases)
+
+    def host_stats(self):
+        """
+        A summary of the requests sent to each image server host.
+        """
+        with self._lock:
+            return {host: state.stats() for host, state in sorted(self._hosts.items())}
+
+    def close(self):
+        """
+        Stop the worker threads and close all pooled connections.
+        """
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for state in self._hosts.values():
+                state.session.close()
+            self._hosts.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ImageInfoCache:
+    """
+    A persistent cache of image service info stored in the database and keyed
+    by the image service URL. Entries older than the TTL are revalidated with
+    the server (using ETag/Last-Modified when available) on their next use.
+
+    The database is only accessed from the calling thread, the fetcher's
+    worker threads only perform the network requests.
+    """
+
+    def __init__(self, fetcher: ImageInfoFetcher, ttl: timedelta | None = None,
+                 refresh: bool = False):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+    def _is_fresh(self, entry: ImageServiceInfo, now):
+        return not self.refresh and (self.ttl is None or entry.fetched_at + self.ttl > now)
+
+    def fetch_all(self, img_url_bases: list[str], return_exceptions: bool = False):
+        """
+        Get the info.json of all the given image services, using the cached
+        copies when fresh and fetching the others in parallel. The results are
+        returned in the same order as the input. If return_exceptions is set,
+        the error raised when fetching an image service is returned in place
+        of its info, otherwise the first error is raised.
+        """
+        now = timezone.now()
+        unique_urls = list(dict.fromkeys(img_url_bases))
+        entries = {}
+        for i in range(0, len(unique_urls), _lookup_batch_size):
+            batch = unique_urls[i:i + _lookup_batch_size]
+            entries.update({e.url: e for e in ImageServiceInfo.objects.filter(url__in=batch)})
+        stale = [url for url in unique_urls
+                 if url not in entries or not self._is_fresh(entries[url], now)]
+        self.hits += len(img_url_bases) - len(stale)
+
+        def fetch_stale(url):
+            entry = entries.get(url)
+            try:
+                if entry is None or self.refresh:
+                    return self.fetcher.fetch_conditional(url)
+                return self.fetcher.fetch_conditional(url, entry.etag, entry.last_modified)
+            except Exception as ex:
+                return ex
+
+        created = []
+        updated = []
+        errors = {}
+        for url, result in zip(stale, self.fetcher.map(fetch_stale, stale)):
+            if isinstance(result, Exception):
+                errors[url] = result
+                continue
+            (info, etag, last_modified) = result
+            entry = entries.get(url)
+            if info is None:
+                self.revalidated += 1
+            else:
+                self.misses += 1
+            if entry is None:
+                entry = ImageServiceInfo(url=url, info=info)
+                entries[url] = entry
+                created.append(entry)
+            else:
+                if info is not None:
+                    entry.info = info
+                updated.append(entry)
+            entry.etag = etag
+            entry.last_modified = last_modified
+            entry.fetched_at = now
+        if created:
+            ImageServiceInfo.objects.bulk_create(created, batch_size=_lookup_batch_size)
+        if updated:
+            ImageServiceInfo.objects.bulk_update(updated, ['info', 'etag', 'last_modified', 'fetched_at'],
+                                                 batch_size=_lookup_batch_size)
+        if errors and not return_exceptions:
+            raise next(iter(errors.values()))
+        return [errors[url] if url in errors else entries[url].info for url in img_url_bases]
+
+    def stats(self):
+        """
+        A summary of the cache usage.
+        """
+        return f"{self.hits} hits, {self.misses} misses, {self.revalidated} revalidated"
@@ -0,0 +1,55 @@
+"""
+Management command for exporting the published catalog
+"""
+
+import datetime
+import pathlib
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from api.export import export_lines
+
+class Command(BaseCommand):
+    """
+    Catalog export command
+    """
+
+    help = """This command exports one JSON line per published document,
+        the same format as the api/export endpoint"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--out", type=pathlib.Path,
+                            help="The output file, the standard output by default")
+        parser.add_argument("--cursor",
+                            help="Resume the export after the document with this key")
+        parser.add_argument("--since",
+                            help="Only export the documents updated since this ISO 8601 time")
+        parser.add_argument("--transcriptions", action="store_true",
+                            help="Include the transcriptions of each document")
+        parser.add_argument("--entities", action="store_true",
+                            help="Include the entity links of each document")
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Number of documents read from the database at a time. " +
+                            "Default = 1000")
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError(f"Invalid --since time: {options['since']}")
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since, datetime.timezone.utc)
+        lines = export_lines(options['cursor'], since, options['transcriptions'],
+                             options['entities'], max(1, options['batch_size']))
+        count = 0
+        out = open(options['out'], 'w', encoding='utf-8') if options['out'] else sys.stdout
+        try:
+            for line in lines:
+                out.write(line)
+                count += 1
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        print(f"Exported {count} documents", file=sys.stderr)
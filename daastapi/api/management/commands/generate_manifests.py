@@ -2,34 +2,210 @@
 Management command for generating IIIF manifests
 """
 
+import hashlib
 import json
 import pathlib
-import re
-import requests
+import zlib
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
-from django.db.models import Prefetch
-from api.models import DocumentRevision, EntityDocument
-
-# We special case these sources as they have issues with their IIIF Image
-# Service preventing us from creating manifests that point directly to the image
-# service, instead manifests from these sources will link directly to the image
-# files.
-_special_case_no_img_service = ['catalog.archives.gov']
-
-def _get_api_and_profile(img_info):
-    profile_source = img_info['profile'][0]
-    level_match = re.match('.*(level[0-9]).*', profile_source)
-    img_profile = re.match(".*/api/image/([0-9]+)/(level[0-9]).json$", profile_source)
-    if img_profile:
-        api_version = img_profile.group(1)
-    else:
-        # Try to get the api version from the context
-        profile_source = img_info.get('@context', '')
-        api_match = re.match("/api/image/([0-9]+)", profile_source)
-        api_version = api_match.group(1) if api_match else None
-    return (api_version, level_match.group(1) if level_match else None)
+from django.db.models import F, Prefetch, Q
+from api.iiif import HostPolicy, ImageInfoCache, ImageInfoFetcher
+from api.manifests import brotli, build_shard, encoding_suffixes, page_image_url, \
+    resolve_image_info
+from api.models import Document, DocumentRevision, EntityDocument, ManifestJob, ManifestJobItem, \
+    Page, PublishedDocument
+from api.storage import BlobManifestStorage, LocalManifestStorage, ManifestPublisher
+
+def _manifest_fingerprint(rev: DocumentRevision, base_url: str):
+    """
+    Compute a hash of every input that affects the manifest generated for the
+    revision: its content, pages (with their resolved image service details),
+    transcriptions, entity links (as formatted by their EntityType) and the
+    base URL of the manifest.
+    """
+    pages = [
+        [p.page_number, p.image_url, p.width, p.height, p.api_version, p.profile_level]
+        for p in rev.page_list]
+    transcriptions = sorted(
+        [t.page_number, t.language_code, t.is_translation, t.text]
+        for t in rev.transcriptions.all())
+    links = sorted(
+        [e.entity_type.name, e.entity_type.url_format, e.entity_type.url_label, e.entity_key]
+        for e in rev.document.entities.all())
+    data = {
+        'base_url': base_url,
+        'key': rev.document.key,
+        'revision_number': rev.revision_number,
+        'label': rev.label,
+        'timestamp': str(rev.timestamp),
+        'content': rev.content,
+        'pages': pages,
+        'transcriptions': transcriptions,
+        'links': links
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _image_pages(rev: DocumentRevision):
+    return [page for page in rev.page_list if page.image_url]
+
+def _sync_pages(revisions: list[DocumentRevision]):
+    """
+    Recreate the Page rows of the revisions whose page images don't match
+    their content, e.g. after the content was edited. The image service
+    info of the new pages is resolved with the other unresolved pages.
+    """
+    stale = {}
+    for rev in revisions:
+        urls = [page_image_url(page) for page in rev.content.get('page_images') or []]
+        if [page.image_url for page in _image_pages(rev)] != urls:
+            stale[rev] = urls
+    if not stale:
+        return
+    with transaction.atomic():
+        Page.objects.filter(revision__in=list(stale)).delete()
+        for rev, urls in stale.items():
+            rev.page_list = [Page(revision=rev, page_number=i, image_url=url)
+                             for i, url in enumerate(urls, 1)]
+        Page.objects.bulk_create([page for rev in stale for page in rev.page_list])
+
+def _manifest_spec(rev: DocumentRevision):
+    """
+    Extract the plain data needed to build the manifest of a revision.
+    """
+    links = []
+    for entity in rev.document.entities.all():
+        et = entity.entity_type
+        links.append({
+            'typename': et.name,
+            'url': et.url_format.format(key=entity.entity_key),
+            'label': et.url_label.format(key=entity.entity_key)
+        })
+    return {
+        'key': rev.document.key,
+        'label': rev.label,
+        'timestamp': str(rev.timestamp),
+        'metadata': rev.content['metadata'],
+        'pages': [{
+            'image_url': page.image_url,
+            'width': page.width,
+            'height': page.height,
+            'api_version': page.api_version,
+            'profile_level': page.profile_level
+        } for page in _image_pages(rev)],
+        'transcriptions': [{
+            'page_number': t.page_number,
+            'language_code': t.language_code,
+            'text': t.text
+        } for t in rev.transcriptions.all()],
+        'links': links
+    }
+
+def _build_chunk(pool: ProcessPoolExecutor | None, workers: int, specs: list[dict],
+                 base_url: str, serialize_options: dict):
+    """
+    Build and serialize the manifests of a chunk. When a process pool is
+    given, the specs are split into shards by document key and each shard is
+    built by a worker process. The results are in the same order as the specs.
+    """
+    if pool is None:
+        return build_shard(specs, base_url, serialize_options)
+    shards = {}
+    for pos, spec in enumerate(specs):
+        shard = shards.setdefault(zlib.crc32(spec['key'].encode('utf-8')) % workers, [])
+        shard.append(pos)
+    futures = {pool.submit(build_shard, [specs[pos] for pos in positions],
+                           base_url, serialize_options): positions
+               for positions in shards.values()}
+    results = [None] * len(specs)
+    for future in as_completed(futures):
+        for pos, result in zip(futures[future], future.result()):
+            results[pos] = result
+    return results
+
+def _manifest_filename(key: str, revision_number: int):
+    return f"{key}_rev{str(revision_number).zfill(3)}.json"
+
+def _manifest_index():
+    """
+    The index of all the manifests of current published revisions.
+    """
+    published = PublishedDocument.objects \
+        .order_by('key') \
+        .values_list('key', 'revision_number')
+    return {
+        'manifests': [{
+            'key': key,
+            'revision_number': revision_number,
+            'file': _manifest_filename(key, revision_number)
+        } for (key, revision_number) in published.iterator()]
+    }
+
+# The command options that are persisted with a job and restored when it is
+# resumed. Secrets such as --blob-container-url must be passed again.
+_job_options = ['base_url', 'out_dir', 'status', 'incremental', 'compact',
+                'compress', 'index_name']
+
+def _create_job(options):
+    """
+    Create a new manifest job persisting the options that determine its
+    output.
+    """
+    job_options = {name: options[name] for name in _job_options}
+    if job_options['out_dir'] is not None:
+        job_options['out_dir'] = str(job_options['out_dir'])
+    return ManifestJob.objects.create(options=job_options)
+
+def _load_job(options):
+    """
+    Load the job that should be resumed and restore its options.
+    """
+    try:
+        job = ManifestJob.objects.get(pk=options['resume'])
+    except ManifestJob.DoesNotExist as ex:
+        raise CommandError(f"Manifest job {options['resume']} does not exist") from ex
+    options.update(job.options)
+    if options['out_dir'] is not None:
+        options['out_dir'] = pathlib.Path(options['out_dir'])
+    return job
+
+def _save_job_items(job: ManifestJob, outcomes: dict):
+    """
+    Record the outcome of each revision of a chunk, indexed by revision id
+    with (state, reason) values. Revisions that failed again have their retry
+    count incremented.
+    """
+    existing = {item.revision_id: item for item in job.items.filter(revision_id__in=outcomes.keys())}
+    created = []
+    for revision_id, (state, reason) in outcomes.items():
+        item = existing.get(revision_id)
+        if item is None:
+            created.append(ManifestJobItem(job=job, revision_id=revision_id,
+                                           state=state, reason=reason))
+            continue
+        if item.state == ManifestJobItem.State.FAILED:
+            item.retry_count += 1
+        item.state = state
+        item.reason = reason
+    ManifestJobItem.objects.bulk_create(created)
+    ManifestJobItem.objects.bulk_update(existing.values(), ['state', 'reason', 'retry_count'])
+
+def _revision_chunks(revisions, chunk_size: int):
+    """
+    Iterate over the revisions in chunks of bounded size. Each chunk is a
+    separate query (keyed on the primary key) with its own prefetches, so no
+    cursor is left open on the table while the previous chunk is written.
+    """
+    last_pk = 0
+    while True:
+        chunk = list(revisions.filter(pk__gt=last_pk).order_by('pk')[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
 
 class Command(BaseCommand):
     """
@@ -40,164 +216,235 @@ class Command(BaseCommand):
         marked for publication in the database"""
 
     def add_arguments(self, parser):
+        parser.add_argument("--resume", type=int,
+                            help="Resume the manifest job with this id from its last " +
+                            "checkpoint and retry its failed revisions, using the " +
+                            "options of the original run")
+        parser.add_argument("--max-retries", type=int, default=3,
+                            help="Maximum number of times a failed revision is retried " +
+                            "when resuming a job. Default = 3")
         parser.add_argument("--base-url")
         parser.add_argument("--out-dir", type=pathlib.Path,
                             help="The output directory where the manifests should be placed")
+        parser.add_argument("--blob-container-url",
+                            help="Upload the manifests to this Azure Blob Storage " +
+                            "container URL (including a SAS token) instead of --out-dir")
+        parser.add_argument("--upload-workers", type=int, default=8,
+                            help="Number of manifest files written or uploaded in " +
+                            "parallel. Default = 8")
+        parser.add_argument("--index-name", default="index.json",
+                            help="Name of the manifest index file, published after " +
+                            "all the manifests. Default = index.json")
         parser.add_argument("--status", nargs="*", type=int,
                             default=DocumentRevision.Status.APPROVED,
                             help="Only generate manifests with these status codes. " +
                             "Default = PUBLISHED")
+        parser.add_argument("--fetch-workers", type=int, default=8,
+                            help="Number of concurrent requests for IIIF image " +
+                            "service info. Default = 8")
+        parser.add_argument("--fetch-timeout", type=int, default=30,
+                            help="Timeout in seconds of IIIF image service requests. " +
+                            "Default = 30")
+        parser.add_argument("--host-concurrency", type=int, default=4,
+                            help="Maximum number of concurrent requests to each image " +
+                            "server host. Default = 4")
+        parser.add_argument("--host-rate", type=float, default=10,
+                            help="Maximum number of requests per second to each image " +
+                            "server host, 0 for no limit. Default = 10")
+        parser.add_argument("--fetch-retries", type=int, default=3,
+                            help="Number of retries, with exponential backoff, of failed " +
+                            "image service requests. Default = 3")
+        parser.add_argument("--circuit-threshold", type=int, default=5,
+                            help="Number of consecutive failed requests after which the " +
+                            "pages of an image server are skipped. Default = 5")
+        parser.add_argument("--circuit-cooldown", type=float, default=60,
+                            help="Number of seconds before requests to a skipped image " +
+                            "server are attempted again. Default = 60")
+        parser.add_argument("--image-info-ttl", type=int, default=30,
+                            help="Number of days for which cached IIIF image service " +
+                            "info is used without revalidation. Default = 30")
+        parser.add_argument("--refresh-image-info", action="store_true",
+                            help="Ignore the cached IIIF image service info and " +
+                            "fetch it again from the image servers")
+        parser.add_argument("--incremental", action="store_true",
+                            help="Also check the current published revisions and only " +
+                            "generate manifests whose inputs changed since they were " +
+                            "last generated")
+        parser.add_argument("--chunk-size", type=int, default=200,
+                            help="Number of revisions loaded and written to the " +
+                            "database at a time. Default = 200")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Number of processes used to build and serialize " +
+                            "the manifests. Default = 1 (no worker processes)")
+        parser.add_argument("--compact", action="store_true",
+                            help="Serialize the manifests without whitespace")
+        parser.add_argument("--compress", nargs="*", default=[],
+                            choices=list(encoding_suffixes.keys()),
+                            help="Also write precompressed copies of each manifest " +
+                            "with these encodings (.gz/.br files)")
 
     def handle(self, *args, **options):
-        revisions = DocumentRevision.objects \
+        job = _load_job(options) if options['resume'] is not None else None
+        if 'br' in options['compress'] and brotli is None:
+            raise CommandError("The brotli package is required for --compress br")
+        if bool(options['out_dir']) == bool(options['blob_container_url']):
+            raise CommandError("Exactly one of --out-dir or --blob-container-url is required")
+        if options['blob_container_url']:
+            storage = BlobManifestStorage(options['blob_container_url'], options['upload_workers'])
+        else:
+            storage = LocalManifestStorage(options['out_dir'])
+        serialize_options = {
+            'compact': options['compact'],
+            'encodings': options['compress']
+        }
+        if job is None:
+            job = _create_job(options)
+        print(f"Manifest job {job.pk}")
+        status_filter = Q(status__in=[int(s) for s in options['status']])
+        if options['incremental']:
+            # The current published revisions are rebuilt if their
+            # fingerprint changed, e.g. after their entity links changed.
+            status_filter |= Q(status=DocumentRevision.Status.PUBLISHED,
+                               revision_number=F('document__current_rev'))
+        revisions = DocumentRevision.objects.filter(status_filter)
+        if options['resume'] is not None:
+            # Continue after the checkpoint and retry the failed revisions.
+            retry_ids = job.items \
+                .filter(state=ManifestJobItem.State.FAILED) \
+                .filter(retry_count__lt=options['max_retries']) \
+                .values_list('revision_id')
+            revisions = revisions.filter(Q(pk__gt=job.checkpoint) | Q(pk__in=retry_ids))
+        print(f"Found {revisions.count()} revisions to publish")
+        revisions = revisions \
             .select_related('document') \
             .prefetch_related('transcriptions') \
+            .prefetch_related(Prefetch('pages', Page.objects.order_by('page_number'),
+                                       to_attr='page_list')) \
             .prefetch_related( \
-                Prefetch('document__entities', EntityDocument.objects.prefetch_related('entity_type'))) \
-            .filter(status__in=[int(s) for s in options['status']])
-        revisions = list(revisions)
-        print(f"Found {len(revisions)} revisions to publish")
+                Prefetch('document__entities', EntityDocument.objects.prefetch_related('entity_type')))
         generated_count = 0
-        for rev in revisions:
-            with transaction.atomic():
-                content = rev.content
-                page_images = content['page_images']
-                if not page_images:
-                    # Do not generate manifest without images.
-                    rev.status = DocumentRevision.Status.NO_IMAGES
-                    rev.save()
-                    continue
-                # Generate manifest for this revision.
-                base_id = f"{options['base_url']}/{rev.document.key}"
-                first_thumb = None
-                canvas = []
-                abort = False
-                transcriptions = list(rev.transcriptions.all())
-                # We support multiple languages in the transcription so the same
-                # page may appear multiple times.
-                transcriptions = {page_num: [t for t in transcriptions if t.page_number == page_num]
-                                for page_num in {t.page_number for t in transcriptions}}
-                for i, page in enumerate(page_images, 1):
-                    # A canvas page.
-                    host_addr = page[0]
-                    img_url_base = f"https://{host_addr}{page[1]}"
-                    img_info = requests.get(f"{img_url_base}/info.json", timeout=30).json()
-                    (api_version, profile_level) = _get_api_and_profile(img_info)
-                    use_img_service = not any(s in host_addr for s in _special_case_no_img_service)
-                    if use_img_service and not (api_version and profile_level):
+        unchanged_count = 0
+        failed_count = 0
+        workers = max(1, options['workers'])
+        host_policy = HostPolicy(concurrency=options['host_concurrency'],
+                                 rate=options['host_rate'],
+                                 retries=options['fetch_retries'],
+                                 failure_threshold=options['circuit_threshold'],
+                                 cooldown=options['circuit_cooldown'])
+        with ImageInfoFetcher(options['fetch_workers'], options['fetch_timeout'],
+                              host_policy) as fetcher, \
+                ManifestPublisher(storage, options['upload_workers']) as publisher, \
+                ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as pool:
+            image_info = ImageInfoCache(fetcher,
+                                        timedelta(days=options['image_info_ttl']),
+                                        options['refresh_image_info'])
+            for chunk in _revision_chunks(revisions, options['chunk_size']):
+                # Revisions and documents are updated in bulk at the end of
+                # each chunk.
+                updated_revs = []
+                updated_docs = {}
+                updated_pages = []
+                outcomes = {}
+                _sync_pages(chunk)
+                # Resolve the image service details of the pages that were
+                # not resolved yet, fetching the image service info for all
+                # of them concurrently. The details are part of the
+                # fingerprints, so refreshed dimensions rebuild the manifests.
+                unresolved = [page for rev in chunk for page in _image_pages(rev)
+                              if options['refresh_image_info'] or not page.is_resolved]
+                img_infos = image_info.fetch_all([page.image_url for page in unresolved],
+                                                 return_exceptions=True)
+                failed_revs = {}
+                for page, img_info in zip(unresolved, img_infos):
+                    try:
+                        if isinstance(img_info, Exception):
+                            raise img_info
+                        for field, value in resolve_image_info(img_info).items():
+                            setattr(page, field, value)
+                        updated_pages.append(page)
+                    except Exception as ex:
+                        failed_revs.setdefault(page.revision_id, ex)
+                specs = []
+                built_revs = []
+                for rev in chunk:
+                    fingerprint = _manifest_fingerprint(rev, options['base_url'])
+                    error = failed_revs.get(rev.pk)
+                    if options['incremental'] and \
+                            rev.status == DocumentRevision.Status.PUBLISHED and \
+                            rev.manifest_fingerprint == fingerprint:
+                        unchanged_count += 1
+                        outcomes[rev.pk] = (ManifestJobItem.State.SKIPPED, 'Unchanged')
+                        continue
+                    if not _image_pages(rev):
+                        # Do not generate manifest without images.
+                        rev.status = DocumentRevision.Status.NO_IMAGES
+                        updated_revs.append(rev)
+                        outcomes[rev.pk] = (ManifestJobItem.State.SKIPPED, 'No images')
+                        continue
+                    if error is not None:
+                        print(f"Failed to fetch image service info: {rev.label} [{rev.document.key}]")
+                        failed_count += 1
+                        outcomes[rev.pk] = (ManifestJobItem.State.FAILED,
+                                            f"Failed to fetch image service info: {error}")
+                        continue
+                    rev.manifest_fingerprint = fingerprint
+                    specs.append(_manifest_spec(rev))
+                    built_revs.append(rev)
+                results = _build_chunk(pool, workers, specs, options['base_url'],
+                                       serialize_options)
+                for rev, result in zip(built_revs, results):
+                    if result is None:
                         print("Failed to find API version and level for image service: " +
                               f"{rev.label} [{rev.document.key}]")
-                        abort = True
-                        break
-                    thumb = [
-                        {
-                            "id": f"{img_url_base}/full/300,300/0/default.jpg",
-                            "type": "Image",
-                            "format": "image/jpeg"
-                        }
-                    ]
-                    if i == 1:
-                        first_thumb = thumb
-                    w = int(img_info['width'])
-                    h = int(img_info['height'])
-                    max_dim = max(w, h)
-                    max_len = 1920
-                    if max_dim > max_len:
-                        w = int(round(w * max_len / max_dim))
-                        h = int(round(h * max_len / max_dim))
-                    img_size_urlparam = f"{w},{h}" if use_img_service else 'max'
-                    canvas_body = {
-                        "id": f"{img_url_base}/full/{img_size_urlparam}/0/default.jpg",
-                        "type": "Image",
-                        "format": "image/jpeg",
-                        "width": img_info['width'],
-                        "height": img_info['height']
-                    }
-                    if use_img_service:
-                        canvas_body['service'] = [{
-                            "id": img_url_base,
-                            "type": f"ImageService{api_version}",
-                            "profile": profile_level
-                        }]
-                    canvas_id = f"{base_id}/canvas{i}"
-                    canvas_data = {
-                        "id": canvas_id,
-                        "type": "Canvas",
-                        "thumbnail": thumb,
-                        "height": h,
-                        "width": w,
-                        "items": [{
-                            "id": f"{canvas_id}/item1",
-                            "type": "AnnotationPage",
-                            "items": [{
-                                "id": f"{canvas_id}/item1/image1",
-                                "type": "Annotation",
-                                "motivation": "painting",
-                                "body": canvas_body,
-                                "target": canvas_id
-                            }]
-                        }]
-                    }
-                    transc = transcriptions.get(i)
-                    if transc:
-                        canvas_data["annotations"] = [{
-                            "id": f"{canvas_id}/annopage{idx_t}",
-                            "type": "AnnotationPage",
-                            "items": [{
-                                "id": f"{canvas_id}/annopage{idx_t}/anno1",
-                                "type": "Annotation",
-                                "motivation": "commenting",
-                                "body": {
-                                    "type": "TextualBody",
-                                    "language": t.language_code,
-                                    "format": "text/html",
-                                    "value": t.text
-                                },
-                                "target": canvas_id
-                            }]
-                        } for idx_t, t in enumerate(transc, 1)]
-                    canvas.append(canvas_data)
-                if abort:
-                    break
-                # Append entity connections to metadata.
-                doc_links = {}
-                for entity in rev.document.entities.all():
-                    et = entity.entity_type
-                    entity_links = doc_links.setdefault(et.name, [])
-                    link_url = et.url_format.format(key=entity.entity_key)
-                    link_label = et.url_label.format(key=entity.entity_key)
-                    entity_links.append(f"<span><a href='{link_url}'>{link_label}</a></span>")
-                # Make a copy of the metadata so as not to overwrite the
-                # revision's version.
-                metadata = list(content['metadata'])
-                for typename, entries in doc_links.items():
-                    link_item = {
-                        "label": { 'en': [f"Linked {typename}"] },
-                        "value": { 'en': entries }
-                    }
-                    metadata.append(link_item)
-                manifest = {
-                    "@context": "http://iiif.io/api/presentation/3/context.json",
-                    "id": base_id,
-                    "type": "Manifest",
-                    "label": { 'en': [rev.label] },
-                    "metadata": metadata,
-                    "viewingDirection": "left-to-right",
-                    "behavior": ["paged"],
-                    "navDate": str(rev.timestamp),
-                    "thumbnail": first_thumb,
-                    "items": canvas
-                }
-                filename = f"{rev.document.key}_rev{str(rev.revision_number).zfill(3)}.json"
-                out_dir: pathlib.Path = options['out_dir']
-                with open(out_dir.joinpath(filename), 'w', encoding='utf-8') as f:
-                    json.dump(manifest, f)
-                rev.status = DocumentRevision.Status.PUBLISHED
-                rev.save()
-                doc = rev.document
-                doc.current_rev = rev.revision_number
-                doc.thumbnail = first_thumb[0]['id']
-                doc.save()
-                generated_count += 1
-                if generated_count % 50 == 0:
-                    print(f"Generated {generated_count} manifests")
+                        failed_count += 1
+                        outcomes[rev.pk] = (ManifestJobItem.State.FAILED,
+                                            "Failed to find API version and level for image service")
+                        continue
+                    (files, thumbnail) = result
+                    filename = _manifest_filename(rev.document.key, rev.revision_number)
+                    for suffix, data in files.items():
+                        publisher.publish(filename + suffix, data)
+                    rev.status = DocumentRevision.Status.PUBLISHED
+                    updated_revs.append(rev)
+                    # A chunk may hold several revisions of a document, the
+                    # document points at the latest of them.
+                    doc = updated_docs.get(rev.document_id)
+                    if doc is None or doc.current_rev < rev.revision_number:
+                        doc = rev.document
+                        doc.current_rev = rev.revision_number
+                        doc.thumbnail = thumbnail
+                        updated_docs[rev.document_id] = doc
+                    outcomes[rev.pk] = (ManifestJobItem.State.PROCESSED, None)
+                    generated_count += 1
+                    if generated_count % 50 == 0:
+                        print(f"Generated {generated_count} manifests")
+                # Only mark the revisions as published once their manifests
+                # have landed in the storage.
+                publisher.wait()
+                with transaction.atomic():
+                    DocumentRevision.objects.bulk_update(
+                        updated_revs, ['status', 'manifest_fingerprint'])
+                    Document.objects.bulk_update(updated_docs.values(), ['current_rev', 'thumbnail'])
+                    Page.objects.bulk_update(updated_pages, ['width', 'height', 'api_version',
+                                                             'profile_level'])
+                    # Bulk updates send no signals, update the copies read by
+                    # searches explicitly.
+                    PublishedDocument.sync({rev.document_id for rev in updated_revs})
+                    _save_job_items(job, outcomes)
+                    job.checkpoint = max(job.checkpoint, chunk[-1].pk)
+                    job.save()
+            # The index is published last so that it never references a
+            # manifest that is not available yet.
+            publisher.publish(options['index_name'],
+                              json.dumps(_manifest_index(), separators=(',', ':')).encode('utf-8'))
+            publisher.wait()
+            print(f"Manifest storage: {publisher.stats()}")
+            for host, stats in fetcher.host_stats().items():
+                print(f"Image server {host}: {stats}")
+        job.status = ManifestJob.Status.FINISHED
+        job.save()
+        if options['incremental']:
+            print(f"Skipped {unchanged_count} unchanged manifests")
+        if failed_count:
+            print(f"Failed to generate {failed_count} manifests, retry them with --resume {job.pk}")
+        print(f"Image info cache: {image_info.stats()}")
@@ -1,11 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from django.core.management.base import BaseCommand
-from django.db import transaction
-from api.models import Document, DocumentRevision, EntityDocument, EntityType, Transcription
+from django.db import DataError, IntegrityError, transaction
+from django.db.models import F
+from api.manifests import page_image_url
+from api.models import Document, DocumentRevision, EntityDocument, EntityType, \
+    ImportCheckpoint, Page, QuarantinedRecord, SourceVersion, Transcription
+from api.signals import documents_changed
+from api.sources import ErrorBudget, PagedFetcher, RecordCache, SourceIndex
+from urllib.parse import quote
 from xml.etree import ElementTree
+import hashlib
 import json
 import re
 import requests
+import time
 
 _dublin_core_labels = {
     "abstract": "Abstract",
@@ -127,10 +137,55 @@ _dublin_core_labels = {
 _max_errors = 5 # Maximum number of *consecutive* errors for the APIs we call.
 _voyages_cache_filename = '.cached_voyages_data'
 _zotero_cache_filename = '.cached_zotero_data'
+_timestamp_format = "%Y-%m-%dT%H:%M:%S.%fZ"
+_bulk_batch_size = 1000 # Maximum number of rows per INSERT statement.
+_import_name = 'import_external' # The name of the checkpoint and quarantine.
 
 def _makeLabelValue(label, value, lang):
     return { 'label': { lang: [label] }, 'value': { lang: value } }
 
+def _total_results(res: requests.Response):
+    total = res.headers.get('Total-Results')
+    return int(total) if total is not None else None
+
+def _content_hash(label, content: dict, transcriptions: list):
+    data = {
+        # The label is hashed as it is stored.
+        'label': str(label),
+        'content': content,
+        'transcriptions': [[i, text] for (i, text) in transcriptions]
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+class _ImportStats:
+    """
+    The number of rows and the time spent in each stage of the import.
+    """
+
+    def __init__(self):
+        self.stages: dict[str,list[float]] = {}
+
+    @contextmanager
+    def stage(self, name: str, rows: int):
+        """
+        Time a stage processing the given number of rows.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, [0, 0.0])
+            stage[0] += rows
+            stage[1] += time.perf_counter() - start
+
+    def summary(self):
+        """
+        A line per stage with its throughput.
+        """
+        for name, (rows, elapsed) in self.stages.items():
+            rate = rows / elapsed if elapsed > 0 else 0
+            yield f"{name}: {rows} rows in {elapsed:.1f} s ({rate:.0f} rows/s)"
+
 class Command(BaseCommand):
     help = """This command fetches data from multiple APIs and consolidates
     the information into a local Document entity"""
@@ -141,19 +196,68 @@ class Command(BaseCommand):
         parser.add_argument("--zotero-key")
         parser.add_argument("--zotero-url", default="https://api.zotero.org")
         parser.add_argument("--zotero-userid")
-        parser.add_argument("--ignore-cache")
+        parser.add_argument("--ignore-cache", action='store_true',
+                            help="Fetch all the data from the APIs instead of using " +
+                            "the local cache files. Default = False")
+        parser.add_argument("--incremental", action='store_true',
+                            help="Only fetch and import the sources that changed since " +
+                            "the last import, applying the changes to the local caches. " +
+                            "Default = False")
+        parser.add_argument("--fetch-workers", type=int, default=4,
+                            help="Number of concurrent page requests to each API. " +
+                            "Default = 4")
+        parser.add_argument("--zotero-page-size", type=int, default=100,
+                            help="Number of Zotero items per page (at most 100). " +
+                            "Default = 100")
+        parser.add_argument("--voyages-page-size", type=int, default=100,
+                            help="Number of Voyages rows per page. Default = 100")
+        parser.add_argument("--chunk-size", type=int, default=500,
+                            help="Number of sources written to the database per " +
+                            "transaction. Default = 500")
+        parser.add_argument("--resume", action='store_true',
+                            help="Resume an interrupted import after the last " +
+                            "committed source. Default = False")
 
     @staticmethod
-    def _get_zotero_data(options, group_ids: list[int]):
+    def _load_cache(options, index: SourceIndex, filename: str):
+        """
+        Load a cache file into the index, returns the number of records or
+        None if there is no cache to use.
+        """
+        if options['ignore_cache']:
+            return None
+        try:
+            count = index.load(filename)
+        except OSError:
+            count = 0
+        return count or None
+
+    @staticmethod
+    def _update_cache(index: SourceIndex, tables: list[str], filename: str, loaded: int, appended: int):
+        # The cache is rewritten from the index once most of its records
+        # were replaced by later ones.
+        if appended and loaded + appended > 2 * index.count(tables):
+            with RecordCache(filename) as cache:
+                index.dump(tables, cache)
+
+    @staticmethod
+    def _get_zotero_data(options, fetcher: PagedFetcher, index: SourceIndex,
+                         group_ids: list[int], versions: dict):
+        """
+        Fetch the Zotero items of the groups to the 'zotero' and
+        'zotero_bib' tables of the index and the cache file. Returns the
+        library version of each group. In incremental mode only the items
+        modified since the stored library version of a group are fetched
+        and appended to the cached items.
+        """
         # Check if we already have cached data from the Zotero API.
-        if not options.get('--ignore-cache', False):
-            try:
-                with open(_zotero_cache_filename, encoding='utf-8') as f:
-                    cached = json.load(f)
-                    print(f"Imported {len(cached.keys())} Zotero entries from cached file")
-                    return cached
-            except:
-                print("No cached Zotero data")
+        loaded = Command._load_cache(options, index, _zotero_cache_filename)
+        if loaded is None:
+            print("No cached Zotero data")
+        else:
+            print(f"Imported {loaded} Zotero records from cached file")
+            if not options['incremental']:
+                return {}
 
         def extract_from_rdf(rdf):
             # Map all the entries first and later keep only those that have a
@@ -167,138 +271,159 @@ class Command(BaseCommand):
             return { _dublin_core_labels[key]: val
                     for key, val in complete.items() if key in _dublin_core_labels }
 
-        def zotero_page(start: int, group_id: str, limit=100):
-            res = requests.get( \
-                f"{options['zotero_url']}/groups/{group_id}/items?" + \
-                f"start={start}&limit={limit}&content=rdf_dc", \
-                headers={ 'Authorization': f"Bearer {options['zotero_key']}" }, \
-                timeout=60)
-            page = ElementTree.fromstring(res.content)
-            # Select the content nodes and navigate through RDF elements until
-            # we reach http://www.w3.org/1999/02/22-rdf-syntax-ns#Description.
-            # The following will build a dictionary, indexed by Zotero ids,
-            # where each entry is the RDF data of the Zotero item.
-            entries = {
-                e.find('{http://zotero.org/ns/api}key').text:
-                    e.find('.//{http://www.w3.org/2005/Atom}content/*[1]/*[1]') for
-                    e in page.findall('.//{http://www.w3.org/2005/Atom}entry')
-            }
-            count = len(entries)
-            # Replace the XML element in the dict values by a dictionary of RDF
-            # attributes with their respective values.
-            page = {
-                key: extract_from_rdf(rdf)
-                for key, rdf in entries.items() if rdf is not None
-            }
-            return (page, count)
+        limit = options['zotero_page_size']
+        new_versions = {}
 
-        zotero_data = {}
-        for group_id in group_ids:
-            zotero_start = 0
-            error_count = 0
-            last_error = None
-            while True:
-                if error_count >= _max_errors:
-                    raise Exception(f"Too many failures fetching data from the Zotero API: {last_error}")
-                try:
-                    (page, count) = zotero_page(zotero_start, group_id, 100)
+        def group_request(group_id: str, since: str | None):
+            headers = { 'Authorization': f"Bearer {options['zotero_key']}" }
+            params = ''
+            if since is not None:
+                # Zotero answers 304 when nothing changed in the library.
+                headers['If-Modified-Since-Version'] = since
+                params = f"&since={since}"
+            def get(start: int, query: str):
+                res = fetcher.get(
+                    f"{options['zotero_url']}/groups/{group_id}/items?" + \
+                    f"start={start}&limit={limit}{params}&{query}",
+                    headers=headers, stream=True)
+                if start == 0 and res.headers.get('Last-Modified-Version'):
+                    new_versions[f"zotero:{group_id}"] = res.headers['Last-Modified-Version']
+                return res
+            return get
+
+        def zotero_page(get):
+            def fetch(start: int):
+                with get(start, "content=rdf_dc") as res:
+                    if res.status_code == 304:
+                        return ({}, 0, 0)
+                    res.raw.decode_content = True
+                    # Parse the entries as they are received, for each one
+                    # select the content node and navigate through RDF elements
+                    # until we reach
+                    # http://www.w3.org/1999/02/22-rdf-syntax-ns#Description.
+                    # The following will build a dictionary, indexed by Zotero
+                    # ids, where each entry is a dictionary of RDF attributes
+                    # with their respective values.
+                    page = {}
+                    count = 0
+                    for (_, e) in ElementTree.iterparse(res.raw):
+                        if e.tag != '{http://www.w3.org/2005/Atom}entry':
+                            continue
+                        count += 1
+                        rdf = e.find('.//{http://www.w3.org/2005/Atom}content/*[1]/*[1]')
+                        if rdf is not None:
+                            page[e.find('{http://zotero.org/ns/api}key').text] = extract_from_rdf(rdf)
+                        e.clear()
                     print(f"Fetched {count} records from Zotero's API/{len(page)} items with proper data.")
-                    if count == 0:
-                        break
-                    zotero_start += count
-                    zotero_data.update(page)
-                    error_count = 0
-                except Exception as ex:
-                    last_error = ex
-                    error_count += 1
-            # Now get bib info from Zotero.
-            error_count = 0
-            zotero_start = 0
-            while True:
-                if error_count >= _max_errors:
-                    raise Exception(f"Too many failures fetching data from the Zotero API: {last_error}")
-                try:
-                    res = requests.get( \
-                        f"{options['zotero_url']}/groups/{group_id}/items?start={zotero_start}" + \
-                        "&limit=100&format=json&include=bib&style=chicago-fullnote-bibliography", \
-                        headers={ 'Authorization': f"Bearer {options['zotero_key']}" }, \
-                        timeout=60)
+                    return (page, count, _total_results(res))
+            return fetch
+
+        def zotero_bib_page(get):
+            def fetch(start: int):
+                with get(start, "format=json&include=bib&style=chicago-fullnote-bibliography") as res:
+                    if res.status_code == 304:
+                        return ([], 0, 0)
                     page = res.json()
-                    if not page:
-                        break
-                    print(f"Fetched bibliography from Zotero's API [{len(page)}].")
-                    for item in page:
-                        key = item['key']
-                        if key in zotero_data:
-                            zd = zotero_data[key]
-                            zd['bib'] = item['bib']
-                            zd['zotero_doc_url'] = item['links']['alternate']['href']
-                    zotero_start += len(page)
-                except Exception as ex:
-                    last_error = ex
-                    error_count += 1
-        # Save to a local cache
-        try:
-            with open(_zotero_cache_filename, 'w', encoding='utf-8') as f:
-                json.dump(zotero_data, f)
-        except:
-            print("Failed to write Zotero data to the cache")
-        return zotero_data
+                    if page:
+                        print(f"Fetched bibliography from Zotero's API [{len(page)}].")
+                    return (page, len(page), _total_results(res))
+            return fetch
+
+        def rdf_pass(get, cache):
+            count = 0
+            for page in fetcher.fetch_pages(zotero_page(get), ErrorBudget('Zotero', _max_errors)):
+                count += index.put('zotero', page.items(), cache)
+            return count
+
+        def bib_pass(get, cache):
+            count = 0
+            for page in fetcher.fetch_pages(zotero_bib_page(get), ErrorBudget('Zotero', _max_errors)):
+                count += index.put('zotero_bib', [
+                    (item['key'], {
+                        'bib': item['bib'],
+                        'zotero_doc_url': item['links']['alternate']['href']
+                    }) for item in page], cache)
+            return count
+
+        if loaded is None:
+            if options['incremental']:
+                print("Fetching all Zotero items")
+            versions = {}
+        appended = 0
+        # Fetched items are appended to the cache as they are received.
+        with RecordCache(_zotero_cache_filename, append=loaded is not None) as cache, \
+                ThreadPoolExecutor(max_workers=2) as passes:
+            for group_id in group_ids:
+                get = group_request(group_id, versions.get(f"zotero:{group_id}"))
+                # The RDF and bibliography passes of a group run in parallel
+                # and the bib info is joined to the items when importing.
+                rdf_future = passes.submit(rdf_pass, get, cache)
+                bib_future = passes.submit(bib_pass, get, cache)
+                appended += rdf_future.result() + bib_future.result()
+        if options['incremental']:
+            print(f"Fetched {appended} changed Zotero records")
+        Command._update_cache(index, ['zotero', 'zotero_bib'], _zotero_cache_filename,
+                              loaded or 0, appended)
+        return new_versions
     
     @staticmethod
-    def _get_voyages_data(options):
-        # Check if we already have cached data from the Zotero API.
-        if not options.get('--ignore-cache', False):
-            try:
-                with open(_voyages_cache_filename, encoding='utf-8') as f:
-                    cached = json.load(f)
-                    print(f"Imported {len(cached.keys())} Voyage entries from cached file")
-                    return cached
-            except:
-                print("No cached Voyage data")
-        voyages_data = {}
+    def _get_voyages_data(options, fetcher: PagedFetcher, index: SourceIndex, versions: dict):
+        """
+        Fetch the Voyages sources to the 'voyages' table of the index and the
+        cache file, indexed by Zotero key. Returns the latest update time of
+        the sources. In incremental mode only the sources updated since the
+        stored update time are fetched and appended to the cached sources.
+        """
+        # Check if we already have cached data from the Voyages API.
+        loaded = Command._load_cache(options, index, _voyages_cache_filename)
+        if loaded is None:
+            print("No cached Voyage data")
+            if options['incremental']:
+                print("Fetching all Voyages sources")
+        else:
+            print(f"Imported {loaded} Voyage entries from cached file")
+            if not options['incremental']:
+                return {}
+        since = versions.get('voyages') if loaded is not None else None
         sv_headers = { "Authorization": f"Token {options['voyages_key']}" }
-        offset = 0
-        error_count = 0
-        last_error = None
-        while True:
-            if error_count >= _max_errors:
-                raise Exception(f"Too many failures fetching data from the Voyages API: {last_error}")
-            try:
-                res = requests.get(
-                    f"{options['voyages_url']}/docs/GENERIC/?limit=10&offset={offset}",
-                    headers=sv_headers,
-                    timeout=60)
-                page = res.json()['results']
-                if not page:
-                    break
-                voyages_data.update({ item['zotero_item_id']: item for item in page })
+        params = f"&last_updated__gte={quote(since)}" if since else ''
+
+        def voyages_page(offset: int):
+            res = fetcher.get(
+                f"{options['voyages_url']}/docs/GENERIC/?limit={options['voyages_page_size']}" + \
+                f"&offset={offset}{params}",
+                headers=sv_headers)
+            data = res.json()
+            page = data['results']
+            if page:
                 print(f"Fetched {len(page)} rows [first id={page[0]['id']}]")
-                error_count = 0
-                offset += len(page)
-            except Exception as ex:
-                last_error = ex
-                error_count += 1
-                continue
-        # Save to a local cache
-        try:
-            with open(_voyages_cache_filename, 'w', encoding='utf-8') as f:
-                json.dump(voyages_data, f)
-        except:
-            print("Failed to write Voyages data to the cache")
-        return voyages_data
+            return (page, len(page), data.get('count'))
+
+        appended = 0
+        # The update times are ISO formatted, so that they sort as strings.
+        latest = since or ''
+        with RecordCache(_voyages_cache_filename, append=loaded is not None) as cache:
+            for page in fetcher.fetch_pages(voyages_page, ErrorBudget('Voyages', _max_errors)):
+                if since:
+                    # Sources that were not updated are skipped even when the
+                    # API ignores the filter.
+                    page = [item for item in page if (item.get('last_updated') or since) >= since]
+                latest = max([latest] + [item.get('last_updated') or '' for item in page])
+                appended += index.put('voyages', [(item['zotero_item_id'], item) for item in page], cache)
+        if since:
+            print(f"Fetched {appended} changed Voyages sources")
+        Command._update_cache(index, ['voyages'], _voyages_cache_filename, loaded or 0, appended)
+        return { 'voyages': latest } if latest else {}
     
     @staticmethod
-    def _map_connections(doc, etype, connections, field_name):
+    def _map_connections(connections, field_name):
         conn = set()
-        for item in connections:
+        for item in connections or []:
             if item.get(field_name):
                 entity_key = item[field_name].get('id')
                 if entity_key:
                     conn.add(entity_key)
-        for ekey in conn:
-            edoc = EntityDocument(document=doc, entity_type=etype, entity_key=ekey)
-            edoc.save()
+        return conn
 
     @staticmethod
     def _extract_iiif_url(url):
@@ -309,71 +434,262 @@ class Command(BaseCommand):
             raise Exception(f"Bad format for IIIF url: '{url}'")
         return [m.group(i) for i in [2, 3]]
     
-    def handle(self, *args, **options):
-        zotero_groups_url = f"{options['zotero_url']}/users/{options['zotero_userid']}/groups"
-        res = requests.get(zotero_groups_url, timeout=30)
-        # Retrieve the group ids from the Zotero API.
-        group_ids = [item['id'] for item in res.json() if item['data']['name']]
-        print(f"Zotero group ids are: {group_ids}")
-        zotero_data = Command._get_zotero_data(options, group_ids)
-        voyages_data = Command._get_voyages_data(options)
-        docs = {d.key: d for d in Document.objects.prefetch_related('revisions').all()}
-        entity_types = {t.name: t for t in EntityType.objects.all()}
-        timestamp_format = "%Y-%m-%dT%H:%M:%S.%fZ"
-        imported_count = 0
+    @staticmethod
+    def _prepare_record(key, voyage_data, rdf):
+        """
+        Build the plain data of the document, revision, pages, transcriptions
+        and entity links imported for a source.
+        """
+        rdf = dict(rdf)
+        pages = [p['page'] for p in voyage_data['page_connections']]
+        page_image_entries = [Command._extract_iiif_url(p.get('iiif_baseimage_url'))
+                              for p in pages]
+        page_images = [pimg for pimg in page_image_entries if pimg is not None]
+        try:
+            timestamp = datetime.strptime(voyage_data['last_updated'], _timestamp_format)
+        except:
+            timestamp = datetime.now()
+        bib = rdf.pop('bib', None)
+        label = rdf.get('Title', 'No title')
+        # Generate metadata for the document.
+        zotero_doc_url = rdf.pop('zotero_doc_url', None)
+        metadata = [_makeLabelValue(k, val, 'en') for k, val in rdf.items()]
+        if zotero_doc_url:
+            metadata.append(_makeLabelValue('Citation', [f"<span><a href='{zotero_doc_url}'>Zotero Entry</a></span>"], 'en'))
+        links = {
+            'Voyages': Command._map_connections(voyage_data.get('source_voyage_connections'), 'voyage'),
+            'Enslaved': Command._map_connections(voyage_data.get('source_enslaved_connections'), 'enslaved'),
+            'Enslavers': Command._map_connections(voyage_data.get('source_enslaver_connections'), 'enslaver'),
+            'Voyage sources': Command._map_connections([{ 'src': voyage_data }], 'src')
+        }
+        # TODO: for now there is no language code in the source API
+        transcriptions = [(i, page['transcription']) for i, page in enumerate(pages, 1)
+                          if page.get('transcription')]
+        content = {
+            'metadata': metadata,
+            'page_images': page_images
+        }
+        return {
+            'key': key,
+            'bib': bib,
+            'label': label,
+            'timestamp': timestamp,
+            'content': content,
+            'content_hash': _content_hash(label, content, transcriptions),
+            'pages': [page_image_url(pimg) if pimg is not None else None
+                      for pimg in page_image_entries],
+            'transcriptions': transcriptions,
+            'links': links
+        }
+
+    @staticmethod
+    def _latest_revisions(doc_ids):
+        """
+        The id, number and content hash of the latest revision of each
+        document. The hash is computed from the stored content for
+        revisions that were created before hashes were recorded.
+        """
+        latest = {}
+        revisions = DocumentRevision.objects.filter(document_id__in=doc_ids) \
+            .order_by('document_id', F('revision_number').desc(nulls_last=True)) \
+            .values_list('document_id', 'id', 'revision_number', 'content_hash')
+        for (doc_id, rev_id, revision_number, content_hash) in revisions:
+            latest.setdefault(doc_id, [rev_id, revision_number or 0, content_hash])
+        unhashed = [item for item in latest.values() if item[2] is None]
+        if unhashed:
+            revs = DocumentRevision.objects \
+                .filter(pk__in=[item[0] for item in unhashed]) \
+                .prefetch_related('transcriptions')
+            hashes = {}
+            for rev in revs:
+                transcriptions = sorted((t.page_number, t.text) for t in rev.transcriptions.all()
+                                        if not t.is_translation)
+                rev.content_hash = _content_hash(rev.label, rev.content, transcriptions)
+                hashes[rev.pk] = rev.content_hash
+            DocumentRevision.objects.bulk_update(revs, ['content_hash'], batch_size=_bulk_batch_size)
+            for item in unhashed:
+                item[2] = hashes.get(item[0])
+        return latest
+
+    @staticmethod
+    def _import_chunk(records: list[dict], entity_types: dict, stats: _ImportStats):
+        """
+        Write a chunk of prepared records to the database with one bulk
+        statement per table. A new revision is only created for records
+        whose content differs from the latest revision of their document.
+        Returns the number of revisions created.
+        """
+        keys = [r['key'] for r in records]
+        with stats.stage('documents', len(records)):
+            # Upsert the documents and resolve their primary keys.
+            Document.objects.bulk_create(
+                [Document(key=r['key'], bib=r['bib']) for r in records],
+                update_conflicts=True, unique_fields=['key'], update_fields=['bib'])
+            doc_ids = dict(Document.objects.filter(key__in=keys).values_list('key', 'id'))
+        with stats.stage('revision hashes', len(records)):
+            latest = Command._latest_revisions(doc_ids.values())
+        new_records = []
+        new_revisions = []
+        for r in records:
+            doc_id = doc_ids[r['key']]
+            (_, revision_number, content_hash) = latest.get(doc_id, [None, 0, None])
+            if content_hash == r['content_hash']:
+                continue
+            new_records.append(r)
+            new_revisions.append(DocumentRevision(
+                document_id=doc_id, label=r['label'],
+                status=DocumentRevision.Status.IMPORTED,
+                revision_number=revision_number + 1, timestamp=r['timestamp'],
+                content=r['content'], content_hash=r['content_hash']))
+        with stats.stage('revisions', len(new_revisions)):
+            DocumentRevision.objects.bulk_create(new_revisions, batch_size=_bulk_batch_size)
+            numbers = {rev.document_id: rev.revision_number for rev in new_revisions}
+            rev_ids = {
+                doc_id: rev_id
+                for (doc_id, revision_number, rev_id) in DocumentRevision.objects
+                    .filter(document_id__in=numbers.keys(), revision_number__in=set(numbers.values()))
+                    .values_list('document_id', 'revision_number', 'id')
+                if numbers[doc_id] == revision_number
+            }
+        pages = [Page(revision_id=rev_ids[doc_ids[r['key']]], page_number=i, image_url=url)
+                 for r in new_records for i, url in enumerate(r['pages'], 1)]
+        with stats.stage('pages', len(pages)):
+            Page.objects.bulk_create(pages, batch_size=_bulk_batch_size)
+        transcriptions = [
+            Transcription(document_rev_id=rev_ids[doc_ids[r['key']]], page_number=i,
+                          language_code='en', text=text, is_translation=False)
+            for r in new_records for (i, text) in r['transcriptions']]
+        with stats.stage('transcriptions', len(transcriptions)):
+            Transcription.objects.bulk_create(transcriptions, batch_size=_bulk_batch_size)
+        # Create entity links to the documents, links that already exist are
+        # left untouched.
+        links = [
+            EntityDocument(document_id=doc_ids[r['key']], entity_type=entity_types[typename],
+                           entity_key=ekey)
+            for r in records for typename, ekeys in r['links'].items() for ekey in ekeys]
+        with stats.stage('entity links', len(links)):
+            EntityDocument.objects.bulk_create(links, batch_size=_bulk_batch_size,
+                                               ignore_conflicts=True)
+        # Bulk operations send no signals, update the published copies of
+        # the documents (their bib and entity links may have changed).
+        documents_changed(doc_ids.values())
+        return len(new_revisions)
+
+    @staticmethod
+    def _quarantine(key: str, ex: Exception, data):
+        print(f"Quarantined {key}: {ex}")
+        return QuarantinedRecord(source=_import_name, key=key,
+                                 error=f"{type(ex).__name__}: {ex}", data=data)
+
+    @staticmethod
+    def _commit_chunk(keys: list[str], quarantined: list[QuarantinedRecord], last_key: str):
+        # The imported records leave the quarantine and the failed ones
+        # enter it, along with the checkpoint of the chunk.
+        QuarantinedRecord.objects.filter(source=_import_name, key__in=keys).delete()
+        QuarantinedRecord.objects.bulk_create(
+            quarantined, update_conflicts=True, unique_fields=['source', 'key'],
+            update_fields=['error', 'data', 'timestamp'])
+        ImportCheckpoint.objects.update_or_create(name=_import_name, defaults={'key': last_key})
+
+    @staticmethod
+    def _import_records(records: list[dict], inputs: dict, quarantined: list[QuarantinedRecord],
+                        last_key: str, entity_types: dict, stats: _ImportStats):
+        """
+        Import a chunk of prepared records and commit it with its
+        checkpoint. If the chunk fails, its records are imported one at a
+        time and the failing ones are quarantined. Returns the number of
+        records imported and of revisions created.
+        """
+        try:
+            with transaction.atomic():
+                count = Command._import_chunk(records, entity_types, stats)
+                Command._commit_chunk([r['key'] for r in records], quarantined, last_key)
+                return (len(records), count)
+        except (DataError, IntegrityError) as ex:
+            print(f"Failed to import a chunk, importing its sources one at a time: {ex}")
+        count = 0
+        imported = []
+        for record in records:
+            try:
+                with transaction.atomic():
+                    count += Command._import_chunk([record], entity_types, stats)
+                imported.append(record['key'])
+            except (DataError, IntegrityError) as ex:
+                quarantined.append(Command._quarantine(record['key'], ex, inputs[record['key']]))
         with transaction.atomic():
-            for key, voyage_data in voyages_data.items():
-                pages = [p['page'] for p in voyage_data['page_connections']]
-                rdf = zotero_data.get(key)
+            Command._commit_chunk(imported, quarantined, last_key)
+        return (len(imported), count)
+
+    def handle(self, *args, **options):
+        # The versions of the sources at the last import, only used by
+        # incremental imports.
+        versions = SourceVersion.all_versions() if options['incremental'] else {}
+        after = None
+        if options['resume']:
+            after = ImportCheckpoint.objects.filter(name=_import_name) \
+                .values_list('key', flat=True).first()
+            if after is None:
+                print("No checkpoint to resume from, importing all the sources")
+            else:
+                print(f"Resuming the import after {after}")
+        with SourceIndex() as index:
+            with PagedFetcher(options['fetch_workers']) as fetcher:
+                zotero_groups_url = f"{options['zotero_url']}/users/{options['zotero_userid']}/groups"
+                res = fetcher.get(zotero_groups_url)
+                # Retrieve the group ids from the Zotero API.
+                group_ids = [item['id'] for item in res.json() if item['data']['name']]
+                print(f"Zotero group ids are: {group_ids}")
+                zotero_versions = Command._get_zotero_data(options, fetcher, index, group_ids, versions)
+                voyages_versions = Command._get_voyages_data(options, fetcher, index, versions)
+            entity_types = {t.name: t for t in EntityType.objects.all()}
+            chunk_size = max(1, options['chunk_size'])
+            stats = _ImportStats()
+            imported_count = 0
+            revision_count = 0
+            quarantined_count = 0
+            chunk = []
+            inputs = {}
+            quarantined = []
+            # Join the sources by Zotero key, in incremental mode a source is
+            # imported again when either its Zotero item or its Voyages data
+            # changed. The sources are imported in key order, each chunk is
+            # committed with the key of its last source as a checkpoint.
+            sources = index.join(['voyages', 'zotero'], ['zotero_bib'],
+                                 changed_only=options['incremental'], after=after)
+            for (key, (voyage_data, rdf, bib)) in sources:
                 if not rdf:
                     continue
-                page_images = [pimg for pimg in
-                    [Command._extract_iiif_url(p.get('iiif_baseimage_url')) for p in pages]
-                    if pimg is not None]
-                # At this point we have enough data to import to our db.
-                doc = docs.get(key)
-                if doc is None:
-                    doc = Document()
-                    doc.key = key
-                # TODO: check whether there is already an identical revision and
-                # prevent the creation of a duplicate.
+                rdf.update(bib or {})
+                inputs[key] = { 'voyages': voyage_data, 'zotero': rdf }
+                # At this point we have enough data to import to our db, a
+                # source with bad data is quarantined instead.
                 try:
-                    timestamp = datetime.strptime(voyage_data['last_updated'], timestamp_format)
-                except:
-                    timestamp = datetime.now()
-                doc.bib = rdf.pop('bib', None)
-                doc.save()
-                rev = DocumentRevision(
-                    document=doc, label=rdf.get('Title', 'No title'),
-                    status=DocumentRevision.Status.IMPORTED,
-                    timestamp=timestamp)
-                rev.revision_number = 1
-                # Generate metadata for the document.
-                zotero_doc_url = rdf.pop('zotero_doc_url', None)
-                metadata = [_makeLabelValue(k, val, 'en') for k, val in rdf.items()]
-                if zotero_doc_url:
-                    metadata.append(_makeLabelValue('Citation', [f"<span><a href='{zotero_doc_url}'>Zotero Entry</a></span>"], 'en'))
-                rev.content = {
-                    'metadata': metadata,
-                    'page_images': page_images
-                }
-                rev.save()
-                # Create entity links to the document.
-                Command._map_connections(doc, entity_types['Voyages'], voyage_data.get('source_voyage_connections'), 'voyage')
-                Command._map_connections(doc, entity_types['Enslaved'], voyage_data.get('source_enslaved_connections'), 'enslaved')
-                Command._map_connections(doc, entity_types['Enslavers'], voyage_data.get('source_enslaver_connections'), 'enslaver')
-                Command._map_connections(doc, entity_types['Voyage sources'], [{ 'src': voyage_data }], 'src')
-                # Import transcript data.
-                for i, page in enumerate(pages, 1):
-                    page_transc = page.get('transcription')
-                    if page_transc:
-                        # TODO: for now there is no language code in the source API
-                        transcription = Transcription(
-                            document_rev=rev, page_number=i,
-                            language_code='en', text=page_transc,
-                            is_translation=False)
-                        transcription.save()
-                imported_count += 1
-                if imported_count % 100 == 0:
+                    with stats.stage('prepare', 1):
+                        chunk.append(Command._prepare_record(key, voyage_data, rdf))
+                except Exception as ex:
+                    quarantined.append(Command._quarantine(key, ex, inputs[key]))
+                if len(chunk) + len(quarantined) >= chunk_size:
+                    (imported, revisions) = Command._import_records(
+                        chunk, inputs, quarantined, key, entity_types, stats)
+                    imported_count += imported
+                    revision_count += revisions
+                    quarantined_count += len(quarantined)
+                    chunk = []
+                    inputs = {}
+                    quarantined = []
                     print(f"Imported {imported_count} documents")
-        print("Import finished")
+            if chunk or quarantined:
+                (imported, revisions) = Command._import_records(
+                    chunk, inputs, quarantined, key, entity_types, stats)
+                imported_count += imported
+                revision_count += revisions
+                quarantined_count += len(quarantined)
+        # The versions are only stored once all the changes were imported,
+        # an interrupted import fetches the same changes again.
+        with transaction.atomic():
+            SourceVersion.store(zotero_versions | voyages_versions)
+            ImportCheckpoint.objects.filter(name=_import_name).delete()
+        for line in stats.summary():
+            print(line)
+        print(f"Import finished, {imported_count} documents imported, " +
+              f"{revision_count} new revisions, {quarantined_count} sources quarantined")
@@ -0,0 +1,36 @@
+"""
+Management command for rebuilding the published documents read by searches
+"""
+
+from django.core.management.base import BaseCommand
+from api.models import Document, PublishedDocument
+
+class Command(BaseCommand):
+    """
+    Published documents rebuild command
+    """
+
+    help = """This command rebuilds the denormalized copies of the current
+        published revisions that are read by the search endpoints"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000,
+                            help="Number of documents synchronized per transaction. " +
+                            "Default = 1000")
+
+    def handle(self, *args, **options):
+        chunk_size = max(1, options['chunk_size'])
+        # Every document is synchronized, which also drops the rows of those
+        # that are no longer published.
+        last_pk = 0
+        synced = 0
+        while True:
+            ids = list(Document.objects.filter(pk__gt=last_pk).order_by('pk')
+                       .values_list('pk', flat=True)[:chunk_size])
+            if not ids:
+                break
+            PublishedDocument.sync(ids)
+            synced += len(ids)
+            last_pk = ids[-1]
+            print(f"Synchronized {synced} documents")
+        print(f"{PublishedDocument.objects.count()} published documents")
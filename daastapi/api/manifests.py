@@ -0,0 +1,222 @@
+"""
+IIIF manifest building
+
+The functions in this module only work on plain data so that manifests can be
+built and serialized in worker processes without access to the database.
+"""
+
+import gzip
+import json
+import re
+from urllib.parse import urlsplit
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# We special case these sources as they have issues with their IIIF Image
+# Service preventing us from creating manifests that point directly to the image
+# service, instead manifests from these sources will link directly to the image
+# files.
+_special_case_no_img_service = ['catalog.archives.gov']
+
+def _get_api_and_profile(img_info):
+    profile_source = img_info['profile'][0]
+    level_match = re.match('.*(level[0-9]).*', profile_source)
+    img_profile = re.match(".*/api/image/([0-9]+)/(level[0-9]).json$", profile_source)
+    if img_profile:
+        api_version = img_profile.group(1)
+    else:
+        # Try to get the api version from the context
+        profile_source = img_info.get('@context', '')
+        api_match = re.match("/api/image/([0-9]+)", profile_source)
+        api_version = api_match.group(1) if api_match else None
+    return (api_version, level_match.group(1) if level_match else None)
+
+def page_image_url(page):
+    """
+    The base URL of the image service of a [host, path] page image entry.
+    """
+    return f"https://{page[0]}{page[1]}"
+
+def resolve_image_info(img_info: dict):
+    """
+    Extract the page details recorded from the info.json of an image service.
+    """
+    (api_version, profile_level) = _get_api_and_profile(img_info)
+    return {
+        'width': int(img_info['width']),
+        'height': int(img_info['height']),
+        'api_version': api_version,
+        'profile_level': profile_level
+    }
+
+def build_manifest(spec: dict, base_url: str):
+    """
+    Build the IIIF manifest of a revision from its manifest spec, a plain dict
+    with the revision data and the resolved image service details of each of
+    its pages. Returns a tuple (manifest, first_thumb) or None if the manifest
+    cannot be generated.
+    """
+    base_id = f"{base_url}/{spec['key']}"
+    first_thumb = None
+    canvas = []
+    transcriptions = spec['transcriptions']
+    # We support multiple languages in the transcription so the same page may
+    # appear multiple times.
+    transcriptions = {page_num: [t for t in transcriptions if t['page_number'] == page_num]
+                      for page_num in {t['page_number'] for t in transcriptions}}
+    for i, page in enumerate(spec['pages'], 1):
+        # A canvas page.
+        img_url_base = page['image_url']
+        host_addr = urlsplit(img_url_base).netloc
+        api_version = page['api_version']
+        profile_level = page['profile_level']
+        use_img_service = not any(s in host_addr for s in _special_case_no_img_service)
+        if use_img_service and not (api_version and profile_level):
+            return None
+        thumb = [
+            {
+                "id": f"{img_url_base}/full/300,300/0/default.jpg",
+                "type": "Image",
+                "format": "image/jpeg"
+            }
+        ]
+        if i == 1:
+            first_thumb = thumb
+        w = page['width']
+        h = page['height']
+        max_dim = max(w, h)
+        max_len = 1920
+        if max_dim > max_len:
+            w = int(round(w * max_len / max_dim))
+            h = int(round(h * max_len / max_dim))
+        img_size_urlparam = f"{w},{h}" if use_img_service else 'max'
+        canvas_body = {
+            "id": f"{img_url_base}/full/{img_size_urlparam}/0/default.jpg",
+            "type": "Image",
+            "format": "image/jpeg",
+            "width": page['width'],
+            "height": page['height']
+        }
+        if use_img_service:
+            canvas_body['service'] = [{
+                "id": img_url_base,
+                "type": f"ImageService{api_version}",
+                "profile": profile_level
+            }]
+        canvas_id = f"{base_id}/canvas{i}"
+        canvas_data = {
+            "id": canvas_id,
+            "type": "Canvas",
+            "thumbnail": thumb,
+            "height": h,
+            "width": w,
+            "items": [{
+                "id": f"{canvas_id}/item1",
+                "type": "AnnotationPage",
+                "items": [{
+                    "id": f"{canvas_id}/item1/image1",
+                    "type": "Annotation",
+                    "motivation": "painting",
+                    "body": canvas_body,
+                    "target": canvas_id
+                }]
+            }]
+        }
+        transc = transcriptions.get(i)
+        if transc:
+            canvas_data["annotations"] = [{
+                "id": f"{canvas_id}/annopage{idx_t}",
+                "type": "AnnotationPage",
+                "items": [{
+                    "id": f"{canvas_id}/annopage{idx_t}/anno1",
+                    "type": "Annotation",
+                    "motivation": "commenting",
+                    "body": {
+                        "type": "TextualBody",
+                        "language": t['language_code'],
+                        "format": "text/html",
+                        "value": t['text']
+                    },
+                    "target": canvas_id
+                }]
+            } for idx_t, t in enumerate(transc, 1)]
+        canvas.append(canvas_data)
+    # Append entity connections to metadata.
+    doc_links = {}
+    for link in spec['links']:
+        entity_links = doc_links.setdefault(link['typename'], [])
+        entity_links.append(f"<span><a href='{link['url']}'>{link['label']}</a></span>")
+    # Make a copy of the metadata so as not to overwrite the revision's
+    # version.
+    metadata = list(spec['metadata'])
+    for typename, entries in doc_links.items():
+        link_item = {
+            "label": { 'en': [f"Linked {typename}"] },
+            "value": { 'en': entries }
+        }
+        metadata.append(link_item)
+    manifest = {
+        "@context": "http://iiif.io/api/presentation/3/context.json",
+        "id": base_id,
+        "type": "Manifest",
+        "label": { 'en': [spec['label']] },
+        "metadata": metadata,
+        "viewingDirection": "left-to-right",
+        "behavior": ["paged"],
+        "navDate": spec['timestamp'],
+        "thumbnail": first_thumb,
+        "items": canvas
+    }
+    return (manifest, first_thumb)
+
+def compress(payload: bytes, encoding: str):
+    """
+    Compress a serialized manifest with the given encoding ('gzip' or 'br').
+    The output is deterministic so that unchanged manifests produce identical
+    files.
+    """
+    if encoding == 'gzip':
+        return gzip.compress(payload, compresslevel=9, mtime=0)
+    if encoding == 'br':
+        if brotli is None:
+            raise Exception("The brotli package is required for 'br' compression")
+        return brotli.compress(payload, mode=brotli.MODE_TEXT)
+    raise Exception(f"Unsupported encoding: '{encoding}'")
+
+# The file suffix used for each supported encoding.
+encoding_suffixes = { 'gzip': '.gz', 'br': '.br' }
+
+def serialize_manifest(manifest: dict, compact: bool = False,
+                       encodings: list[str] | tuple = ()):
+    """
+    Serialize a manifest to the files that should be published for it.
+    Returns a dict indexed by the file suffix ('' for the plain JSON file)
+    whose values are the file contents.
+    """
+    separators = (',', ':') if compact else None
+    payload = json.dumps(manifest, separators=separators).encode('utf-8')
+    files = { '': payload }
+    for encoding in encodings:
+        files[encoding_suffixes[encoding]] = compress(payload, encoding)
+    return files
+
+def build_shard(specs: list[dict], base_url: str, serialize_options: dict | None = None):
+    """
+    Build and serialize the manifests of a shard of revisions. Returns a list
+    with a tuple (files, thumbnail URL) for each spec, where files is the
+    output of serialize_manifest, or None for the specs whose manifest cannot
+    be generated.
+    """
+    results = []
+    for spec in specs:
+        built = build_manifest(spec, base_url)
+        if built is None:
+            results.append(None)
+            continue
+        (manifest, first_thumb) = built
+        results.append((serialize_manifest(manifest, **(serialize_options or {})),
+                        first_thumb[0]['id']))
+    return results
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.3 on 2026-10-17 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_entity_type_seed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageServiceInfo',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(help_text='The base URL of the image service', max_length=1024, unique=True)),
+                ('info', models.JSONField()),
+                ('etag', models.CharField(max_length=255, null=True)),
+                ('last_modified', models.CharField(max_length=64, null=True)),
+                ('fetched_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-17 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_image_service_info'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentrevision',
+            name='manifest_fingerprint',
+            field=models.CharField(max_length=64, null=True),
+        ),
+    ]
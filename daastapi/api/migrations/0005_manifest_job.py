@@ -0,0 +1,40 @@
+# Generated by Django 4.2.3 on 2026-10-17 12:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_manifest_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ManifestJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.IntegerField(choices=[(0, 'Running'), (1, 'Finished')], default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('options', models.JSONField()),
+                ('checkpoint', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ManifestJobItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.IntegerField(choices=[(0, 'Processed'), (1, 'Skipped'), (2, 'Failed')], db_index=True)),
+                ('reason', models.TextField(null=True)),
+                ('retry_count', models.IntegerField(default=0)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='api.manifestjob')),
+                ('revision', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.documentrevision')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='manifestjobitem',
+            constraint=models.UniqueConstraint(fields=('job', 'revision'), name='unique_job_revision'),
+        ),
+    ]
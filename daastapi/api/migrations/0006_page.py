@@ -0,0 +1,31 @@
+# Generated by Django 4.2.3 on 2026-10-17 12:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_manifest_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Page',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('page_number', models.IntegerField()),
+                ('image_url', models.CharField(db_index=True, max_length=1024, null=True)),
+                ('width', models.IntegerField(null=True)),
+                ('height', models.IntegerField(null=True)),
+                ('api_version', models.CharField(max_length=8, null=True)),
+                ('profile_level', models.CharField(max_length=16, null=True)),
+                ('revision', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pages', to='api.documentrevision')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='page',
+            constraint=models.UniqueConstraint(fields=('revision', 'page_number'), name='unique_rev_page_number'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations
+
+def seed_pages(apps, schema_editor):
+    """
+    Create the Page rows of existing revisions from the page images in their
+    content. The image service info of the pages is resolved the next time
+    their manifest is generated.
+    """
+    # We can't import the models directly as they may be a newer version than
+    # this migration expects. We use the historical versions.
+    DocumentRevision = apps.get_model("api", "DocumentRevision")
+    Page = apps.get_model("api", "Page")
+    pages = []
+    for rev_id, content in DocumentRevision.objects.values_list('id', 'content').iterator():
+        for i, page in enumerate(content.get('page_images') or [], 1):
+            pages.append(Page(revision_id=rev_id, page_number=i,
+                              image_url=f"https://{page[0]}{page[1]}"))
+        if len(pages) >= 1000:
+            Page.objects.bulk_create(pages)
+            pages = []
+    Page.objects.bulk_create(pages)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_page'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_pages, migrations.RunPython.noop)
+    ]
@@ -0,0 +1,62 @@
+from django.db import migrations
+
+# SQLite: an external content FTS5 table over the transcriptions, kept in sync
+# by triggers so that every insert, update or delete (including bulk
+# operations) is reflected in the index.
+_sqlite_create = [
+    """CREATE VIRTUAL TABLE api_transcription_fts USING fts5(
+        text, language_code UNINDEXED, document_rev_id UNINDEXED,
+        content='api_transcription', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER api_transcription_fts_insert AFTER INSERT ON api_transcription BEGIN
+        INSERT INTO api_transcription_fts(rowid, text, language_code, document_rev_id)
+        VALUES (new.id, new.text, new.language_code, new.document_rev_id);
+    END""",
+    """CREATE TRIGGER api_transcription_fts_delete AFTER DELETE ON api_transcription BEGIN
+        INSERT INTO api_transcription_fts(api_transcription_fts, rowid, text, language_code, document_rev_id)
+        VALUES ('delete', old.id, old.text, old.language_code, old.document_rev_id);
+    END""",
+    """CREATE TRIGGER api_transcription_fts_update AFTER UPDATE ON api_transcription BEGIN
+        INSERT INTO api_transcription_fts(api_transcription_fts, rowid, text, language_code, document_rev_id)
+        VALUES ('delete', old.id, old.text, old.language_code, old.document_rev_id);
+        INSERT INTO api_transcription_fts(rowid, text, language_code, document_rev_id)
+        VALUES (new.id, new.text, new.language_code, new.document_rev_id);
+    END""",
+    "INSERT INTO api_transcription_fts(api_transcription_fts) VALUES ('rebuild')"
+]
+
+_sqlite_drop = [
+    "DROP TRIGGER IF EXISTS api_transcription_fts_insert",
+    "DROP TRIGGER IF EXISTS api_transcription_fts_delete",
+    "DROP TRIGGER IF EXISTS api_transcription_fts_update",
+    "DROP TABLE IF EXISTS api_transcription_fts"
+]
+
+# PostgreSQL: a GIN index on the text search vector of the transcriptions,
+# which the database keeps up to date by itself.
+_postgresql_create = [
+    """CREATE INDEX api_transcription_text_fts ON api_transcription
+        USING gin (to_tsvector('simple', text))"""
+]
+
+_postgresql_drop = [
+    "DROP INDEX IF EXISTS api_transcription_text_fts"
+]
+
+def _run(statements):
+    def run(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return run
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_page_seed'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            _run({ 'sqlite': _sqlite_create, 'postgresql': _postgresql_create }),
+            _run({ 'sqlite': _sqlite_drop, 'postgresql': _postgresql_drop }))
+    ]
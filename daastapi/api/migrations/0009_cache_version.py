@@ -0,0 +1,32 @@
+# Generated by Django 4.2.3 on 2026-10-17 12:39
+
+from django.db import migrations, models
+
+
+def seed_versions(apps, schema_editor):
+    """
+    Create the version counter of the document data read by searches.
+    """
+    # We can't import the models directly as they may be a newer version than
+    # this migration expects. We use the historical versions.
+    CacheVersion = apps.get_model("api", "CacheVersion")
+    CacheVersion.objects.create(name='published', version=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_transcription_fts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(seed_versions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 4.2.3 on 2026-10-17 12:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_published(apps, schema_editor):
+    """
+    Create the published copies of the current published revisions.
+    """
+    # We can't import the models directly as they may be a newer version than
+    # this migration expects. We use the historical versions.
+    DocumentRevision = apps.get_model("api", "DocumentRevision")
+    EntityDocument = apps.get_model("api", "EntityDocument")
+    PublishedDocument = apps.get_model("api", "PublishedDocument")
+    entities = {}
+    links = EntityDocument.objects.order_by('pk') \
+        .values_list('document_id', 'entity_type__name', 'entity_key')
+    for (doc_id, type_name, entity_key) in links.iterator():
+        entities.setdefault(doc_id, {}).setdefault(type_name, []).append(entity_key)
+    # The current revisions with the PUBLISHED status.
+    revisions = DocumentRevision.objects \
+        .filter(status=200) \
+        .filter(revision_number=models.F('document__current_rev')) \
+        .select_related('document')
+    rows = []
+    for rev in revisions.iterator():
+        rows.append(PublishedDocument(
+            document_id=rev.document_id,
+            revision_id=rev.pk,
+            key=rev.document.key,
+            revision_number=rev.revision_number,
+            label=rev.label,
+            normalized_label=' '.join(rev.label.casefold().split()),
+            thumbnail=rev.document.thumbnail,
+            bib=rev.document.bib,
+            timestamp=rev.timestamp,
+            entities=entities.get(rev.document_id, {})))
+    PublishedDocument.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_cache_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublishedDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=128, unique=True)),
+                ('revision_number', models.IntegerField(null=True)),
+                ('label', models.CharField(max_length=255)),
+                ('normalized_label', models.CharField(db_index=True, max_length=255)),
+                ('thumbnail', models.TextField(null=True)),
+                ('bib', models.TextField(null=True)),
+                ('timestamp', models.DateField(db_index=True)),
+                ('entities', models.JSONField(default=dict)),
+                ('document', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='published', to='api.document')),
+                ('revision', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.documentrevision')),
+            ],
+        ),
+        migrations.RunPython(fill_published, migrations.RunPython.noop),
+    ]
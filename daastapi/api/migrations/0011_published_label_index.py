@@ -0,0 +1,86 @@
+import unicodedata
+from django.db import migrations
+
+# SQLite: an external content FTS5 table with the trigram tokenizer over the
+# normalized labels, which serves substring matches of 3 characters or more.
+# The triggers keep the index in sync with the table, they are dropped with
+# the table when a migration rebuilds it.
+_sqlite_triggers = [
+    """CREATE TRIGGER api_publisheddocument_label_fts_insert AFTER INSERT ON api_publisheddocument BEGIN
+        INSERT INTO api_publisheddocument_label_fts(rowid, normalized_label)
+        VALUES (new.id, new.normalized_label);
+    END""",
+    """CREATE TRIGGER api_publisheddocument_label_fts_delete AFTER DELETE ON api_publisheddocument BEGIN
+        INSERT INTO api_publisheddocument_label_fts(api_publisheddocument_label_fts, rowid, normalized_label)
+        VALUES ('delete', old.id, old.normalized_label);
+    END""",
+    """CREATE TRIGGER api_publisheddocument_label_fts_update AFTER UPDATE ON api_publisheddocument BEGIN
+        INSERT INTO api_publisheddocument_label_fts(api_publisheddocument_label_fts, rowid, normalized_label)
+        VALUES ('delete', old.id, old.normalized_label);
+        INSERT INTO api_publisheddocument_label_fts(rowid, normalized_label)
+        VALUES (new.id, new.normalized_label);
+    END"""
+]
+
+_sqlite_rebuild = [
+    "INSERT INTO api_publisheddocument_label_fts(api_publisheddocument_label_fts) VALUES ('rebuild')"
+]
+
+_sqlite_create = [
+    """CREATE VIRTUAL TABLE api_publisheddocument_label_fts USING fts5(
+        normalized_label, content='api_publisheddocument', content_rowid='id',
+        tokenize='trigram')"""
+] + _sqlite_triggers + _sqlite_rebuild
+
+_sqlite_drop = [
+    "DROP TRIGGER IF EXISTS api_publisheddocument_label_fts_insert",
+    "DROP TRIGGER IF EXISTS api_publisheddocument_label_fts_delete",
+    "DROP TRIGGER IF EXISTS api_publisheddocument_label_fts_update",
+    "DROP TABLE IF EXISTS api_publisheddocument_label_fts"
+]
+
+# PostgreSQL: a trigram GIN index on the normalized labels, which serves the
+# LIKE '%...%' queries of substring matches.
+_postgresql_create = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """CREATE INDEX api_publisheddocument_label_trgm ON api_publisheddocument
+        USING gin (normalized_label gin_trgm_ops)"""
+]
+
+_postgresql_drop = [
+    "DROP INDEX IF EXISTS api_publisheddocument_label_trgm"
+]
+
+def _run(statements):
+    def run(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(sql)
+    return run
+
+def fold_labels(apps, schema_editor):
+    """
+    Normalize the existing labels with accent folding.
+    """
+    # We can't import the models directly as they may be a newer version than
+    # this migration expects. We use the historical versions.
+    PublishedDocument = apps.get_model("api", "PublishedDocument")
+    updated = []
+    for doc in PublishedDocument.objects.only('id', 'label').iterator():
+        decomposed = unicodedata.normalize('NFKD', doc.label.casefold())
+        folded = ''.join(c for c in decomposed if not unicodedata.combining(c))
+        doc.normalized_label = ' '.join(folded.split())
+        updated.append(doc)
+    PublishedDocument.objects.bulk_update(updated, ['normalized_label'], batch_size=1000)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_published_document'),
+    ]
+
+    operations = [
+        migrations.RunPython(fold_labels, migrations.RunPython.noop),
+        migrations.RunPython(
+            _run({ 'sqlite': _sqlite_create, 'postgresql': _postgresql_create }),
+            _run({ 'sqlite': _sqlite_drop, 'postgresql': _postgresql_drop }))
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.3 on 2026-10-17 12:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_published_label_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='entitydocument',
+            index=models.Index(fields=['entity_type', 'entity_key', 'document'], name='entity_doc_lookup'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.3 on 2026-10-17 12:46
+
+from importlib import import_module
+from django.db import migrations, models
+
+# Adding a non null column makes SQLite rebuild the table, which drops the
+# triggers of the label index (see 0011), so they are installed again and
+# the index rebuilt from the new table.
+_label_index = import_module('api.migrations.0011_published_label_index')
+
+_reinstall_triggers = _label_index._run({
+    'sqlite': [
+        "DROP TRIGGER IF EXISTS api_publisheddocument_label_fts_insert",
+        "DROP TRIGGER IF EXISTS api_publisheddocument_label_fts_delete",
+        "DROP TRIGGER IF EXISTS api_publisheddocument_label_fts_update"
+    ] + _label_index._sqlite_triggers + _label_index._sqlite_rebuild
+})
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_entity_doc_lookup'),
+    ]
+
+    operations = [
+        # Removing the column also rebuilds the table.
+        migrations.RunPython(migrations.RunPython.noop, _reinstall_triggers),
+        migrations.AddField(
+            model_name='publisheddocument',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.RunPython(_reinstall_triggers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.3 on 2026-10-17 12:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_published_updated'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SourceVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128, unique=True)),
+                ('version', models.CharField(max_length=64)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='documentrevision',
+            name='content_hash',
+            field=models.CharField(max_length=64, null=True),
+        ),
+    ]
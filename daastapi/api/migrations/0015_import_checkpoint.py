@@ -0,0 +1,37 @@
+# Generated by Django 4.2.3 on 2026-10-17 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_source_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('key', models.CharField(max_length=255)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='QuarantinedRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=64)),
+                ('key', models.CharField(max_length=255)),
+                ('error', models.TextField()),
+                ('data', models.JSONField(null=True)),
+                ('timestamp', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='quarantinedrecord',
+            constraint=models.UniqueConstraint(fields=('source', 'key'), name='unique_quarantined_record'),
+        ),
+    ]
@@ -3,7 +3,13 @@ Document API models
 """
 
 import json
-from django.db import models
+import threading
+import unicodedata
+from django.db import models, transaction
+from django.db.models import F
+
+# The number of published documents synchronized per query.
+_sync_batch_size = 500
 
 class Document(models.Model):
     """
@@ -41,6 +47,12 @@ class DocumentRevision(models.Model):
     timestamp = models.DateField(db_index=True)
     # Document/pages metadata used to build an IIIF manifest.
     content = models.JSONField(null=False)
+    # A hash of all the inputs of the last manifest generated for this
+    # revision, used to skip manifests whose output would not change.
+    manifest_fingerprint = models.CharField(max_length=64, null=True)
+    # A hash of the imported content of the revision, used to skip imports
+    # that would create an identical revision.
+    content_hash = models.CharField(max_length=64, null=True)
 
     class Meta:
         """Multi column uniqueness constraints"""
@@ -52,6 +64,42 @@ class DocumentRevision(models.Model):
     def __str__(self):
         return f"Document Revision {self.revision_number} ({self.label})"
 
+class Page(models.Model):
+    """
+    A page of a document revision and the IIIF image service of its image.
+    The image dimensions and service details are recorded when the image
+    service info is first resolved so that manifests can be built without
+    network requests.
+    """
+    revision = models.ForeignKey(
+        DocumentRevision, null=False,
+        on_delete=models.CASCADE, related_name='pages')
+    page_number = models.IntegerField(null=False)
+    # The base URL of the IIIF image service, null if the page has no image.
+    image_url = models.CharField(max_length=1024, null=True, db_index=True)
+    width = models.IntegerField(null=True)
+    height = models.IntegerField(null=True)
+    api_version = models.CharField(max_length=8, null=True)
+    profile_level = models.CharField(max_length=16, null=True)
+
+    class Meta:
+        """Multi column uniqueness constraints"""
+        constraints = [
+            models.UniqueConstraint(fields=['revision', 'page_number'],
+                                    name='unique_rev_page_number')
+        ]
+
+    @property
+    def is_resolved(self):
+        """
+        Whether the image service info of the page was resolved.
+        """
+        return self.width is not None and self.height is not None and \
+            self.api_version is not None and self.profile_level is not None
+
+    def __str__(self):
+        return f"Page {self.page_number}: {self.image_url}"
+
 class Transcription(models.Model):
     """
     The text transcription of a page in a document.
@@ -100,6 +148,349 @@ class EntityDocument(models.Model):
             models.UniqueConstraint(fields=['document', 'entity_type', 'entity_key'],
                                     name='unique_doc_entity_link')
         ]
+        indexes = [
+            # Covering index of the lookups of documents by entity keys.
+            models.Index(fields=['entity_type', 'entity_key', 'document'],
+                         name='entity_doc_lookup')
+        ]
+
+class PublishedDocument(models.Model):
+    """
+    A denormalized copy of the current published revision of a document with
+    its entity links, so that searches read a single table. The rows are
+    synchronized when revisions are published (see sync) and can be rebuilt
+    with the rebuild_published command.
+    """
+    # The version counter bumped whenever published documents change.
+    version_name = 'published'
+
+    document = models.OneToOneField(Document, null=False,
+        on_delete=models.CASCADE, related_name='published')
+    revision = models.OneToOneField(DocumentRevision, null=False,
+        on_delete=models.CASCADE, related_name='+')
+    key = models.CharField(max_length=128, unique=True)
+    revision_number = models.IntegerField(null=True)
+    label = models.CharField(max_length=255, null=False)
+    # The label as matched by searches, see normalize_label.
+    normalized_label = models.CharField(max_length=255, null=False, db_index=True)
+    thumbnail = models.TextField(null=True)
+    bib = models.TextField(null=True)
+    timestamp = models.DateField(db_index=True)
+    # The keys of the linked entities indexed by entity type name.
+    entities = models.JSONField(null=False, default=dict)
+    # When the row was last synchronized, used by incremental exports.
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+
+    @staticmethod
+    def normalize_label(label: str):
+        """
+        Normalize a label (or search query) for case and accent insensitive
+        matching, e.g. "São  Paulo" becomes "sao paulo".
+        """
+        decomposed = unicodedata.normalize('NFKD', label.casefold())
+        folded = ''.join(c for c in decomposed if not unicodedata.combining(c))
+        return ' '.join(folded.split())
+
+    @staticmethod
+    def sync(document_ids: list[int]):
+        """
+        Create, update or delete the rows of the given documents to match
+        their current published revision and entity links.
+        """
+        document_ids = list(document_ids)
+        for i in range(0, len(document_ids), _sync_batch_size):
+            PublishedDocument._sync_batch(document_ids[i:i + _sync_batch_size])
+        CacheVersion.increment(PublishedDocument.version_name)
+
+    @staticmethod
+    def _sync_batch(document_ids: list[int]):
+        entities = {}
+        links = EntityDocument.objects \
+            .filter(document_id__in=document_ids) \
+            .order_by('pk') \
+            .values_list('document_id', 'entity_type__name', 'entity_key')
+        for (doc_id, type_name, entity_key) in links:
+            by_type_data: list[str] = entities.setdefault(doc_id, {}).setdefault(type_name, [])
+            by_type_data.append(entity_key)
+        revisions = DocumentRevision.objects \
+            .filter(document_id__in=document_ids) \
+            .filter(status=DocumentRevision.Status.PUBLISHED) \
+            .filter(revision_number=F('document__current_rev')) \
+            .select_related('document')
+        rows = [PublishedDocument(
+            document_id=rev.document_id,
+            revision_id=rev.pk,
+            key=rev.document.key,
+            revision_number=rev.revision_number,
+            label=rev.label,
+            normalized_label=PublishedDocument.normalize_label(rev.label),
+            thumbnail=rev.document.thumbnail,
+            bib=rev.document.bib,
+            timestamp=rev.timestamp,
+            entities=entities.get(rev.document_id, {})) for rev in revisions]
+        with transaction.atomic():
+            PublishedDocument.objects.filter(document_id__in=document_ids).delete()
+            PublishedDocument.objects.bulk_create(rows)
+
+    def save(self, *args, **kwargs):
+        self.normalized_label = PublishedDocument.normalize_label(self.label)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"Published document {self.key} rev. {self.revision_number}"
+
+class ImageServiceInfo(models.Model):
+    """
+    A cached copy of the info.json of an IIIF image service.
+    """
+    url = models.CharField(max_length=1024, unique=True,
+        help_text='The base URL of the image service')
+    info = models.JSONField(null=False)
+    # HTTP validators returned by the image server, used to revalidate stale
+    # entries with a conditional request.
+    etag = models.CharField(max_length=255, null=True)
+    last_modified = models.CharField(max_length=64, null=True)
+    fetched_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"Image service info: {self.url}"
+
+class ManifestJob(models.Model):
+    """
+    A run of the manifest generation command, persisted so that an
+    interrupted run can be resumed from its last checkpoint.
+    """
+    class Status(models.IntegerChoices):
+        """
+        The status of the generation job.
+        """
+        RUNNING = 0 # Started and not finished, possibly interrupted.
+        FINISHED = 1 # All the revisions were processed.
+
+    status = models.IntegerField(choices=Status.choices, default=Status.RUNNING)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    # The command options that determine the output of the job.
+    options = models.JSONField(null=False)
+    # The primary key of the last revision in the last completed chunk.
+    checkpoint = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"Manifest job {self.pk} ({self.get_status_display()})"
+
+class ManifestJobItem(models.Model):
+    """
+    The outcome of processing a document revision in a manifest job.
+    """
+    class State(models.IntegerChoices):
+        """
+        The outcome of processing the revision.
+        """
+        PROCESSED = 0 # A manifest was generated.
+        SKIPPED = 1 # No manifest needed to be generated.
+        FAILED = 2 # The manifest could not be generated, see the reason.
+
+    job = models.ForeignKey(ManifestJob, null=False,
+        on_delete=models.CASCADE, related_name='items')
+    revision = models.ForeignKey(DocumentRevision, null=False, on_delete=models.CASCADE)
+    state = models.IntegerField(choices=State.choices, db_index=True)
+    reason = models.TextField(null=True)
+    retry_count = models.IntegerField(default=0)
+
+    class Meta:
+        """Multi column uniqueness constraints"""
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'revision'],
+                                    name='unique_job_revision')
+        ]
+
+class CacheVersion(models.Model):
+    """
+    A version counter for data cached by the API processes. Every change to
+    the cached data increments the counter so that each process can detect
+    that its copy is stale.
+    """
+    name = models.CharField(max_length=64, unique=True)
+    version = models.BigIntegerField(default=0)
+
+    @staticmethod
+    def current(name: str):
+        """
+        The current version of the named data.
+        """
+        return CacheVersion.objects.filter(name=name) \
+            .values_list('version', flat=True).first() or 0
+
+    @staticmethod
+    def increment(name: str):
+        """
+        Increment the version of the named data and return the new version.
+        """
+        with transaction.atomic():
+            if not CacheVersion.objects.filter(name=name).update(version=F('version') + 1):
+                CacheVersion.objects.create(name=name, version=1)
+            return CacheVersion.objects.filter(name=name).values_list('version', flat=True).get()
+
+    def __str__(self):
+        return f"Cache version {self.name}: {self.version}"
+
+class SourceVersion(models.Model):
+    """
+    The version of an external data source at the last successful import,
+    e.g. a Zotero library version, used to only fetch the records that
+    changed since then.
+    """
+    name = models.CharField(max_length=128, unique=True)
+    version = models.CharField(max_length=64)
+    updated = models.DateTimeField(auto_now=True)
+
+    @staticmethod
+    def all_versions():
+        """
+        The stored versions indexed by source name.
+        """
+        return dict(SourceVersion.objects.values_list('name', 'version'))
+
+    @staticmethod
+    def store(versions: dict[str,str]):
+        """
+        Store the versions of the named sources.
+        """
+        with transaction.atomic():
+            for name, version in versions.items():
+                SourceVersion.objects.update_or_create(name=name, defaults={'version': version})
+
+    def __str__(self):
+        return f"Source version {self.name}: {self.version}"
+
+class ImportCheckpoint(models.Model):
+    """
+    The key of the last record committed by an import that has not finished
+    yet, so that an interrupted import can be resumed after it.
+    """
+    name = models.CharField(max_length=64, unique=True)
+    key = models.CharField(max_length=255)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Import checkpoint {self.name}: {self.key}"
+
+class QuarantinedRecord(models.Model):
+    """
+    A record of an external source that failed to import, kept with its
+    input data and the error for inspection. The record leaves the
+    quarantine once it is imported successfully.
+    """
+    source = models.CharField(max_length=64)
+    key = models.CharField(max_length=255)
+    error = models.TextField()
+    data = models.JSONField(null=True)
+    timestamp = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        """Multi column uniqueness constraints"""
+        constraints = [
+            models.UniqueConstraint(fields=['source', 'key'],
+                                    name='unique_quarantined_record')
+        ]
+
+    def __str__(self):
+        return f"Quarantined record {self.source}/{self.key}"
+
+class CacheCounters:
+    """
+    Usage counters of a cache of this process. The cached data is versioned
+    (see CacheVersion) and each new version invalidates all the entries.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._version = None
+        self._lock = threading.Lock()
+
+    def record(self, version: int, hits: int = 0, misses: int = 0):
+        """
+        Record cache hits and misses for the given data version.
+        """
+        with self._lock:
+            if self._version is not None and version != self._version:
+                self.invalidations += 1
+            self._version = version
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self):
+        """
+        The counters as a dict.
+        """
+        with self._lock:
+            return {
+                'version': self._version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations
+            }
+
+class EntityLookupIndex:
+    """
+    An in-memory inverted index from entity keys to the published documents
+    linked to them. The whole index is rebuilt the first time it is used
+    after the published documents changed.
+    """
+
+    def __init__(self):
+        self._version = None
+        self._links: dict[tuple[str,str],list[int]] = {}
+        self._docs: dict[int,dict] = {}
+        self._lock = threading.Lock()
+        # A lookup that rebuilds the index is a miss.
+        self.counters = CacheCounters()
+
+    def lookup(self, keys_by_type: dict[str,list[str]]):
+        """
+        Get the published documents linked to the given entity keys, as a
+        dict of (type name, entity key) to document ids and a dict of
+        document ids to documents.
+        """
+        version = CacheVersion.current(PublishedDocument.version_name)
+        with self._lock:
+            rebuild = version != self._version
+            if rebuild:
+                self._load()
+                self._version = version
+            self.counters.record(version, hits=int(not rebuild), misses=int(rebuild))
+            links = {}
+            for typename, keys in keys_by_type.items():
+                for key in keys:
+                    doc_ids = self._links.get((typename, key))
+                    if doc_ids:
+                        links[(typename, key)] = doc_ids
+            return (links, self._docs)
+
+    def _load(self):
+        docs = {}
+        for item in PublishedDocument.objects.values('document_id', 'key', 'label', 'thumbnail'):
+            docs[item.pop('document_id')] = item
+        links = {}
+        items = EntityDocument.objects \
+            .filter(document_id__in=PublishedDocument.objects.values('document_id')) \
+            .values_list('entity_type__name', 'entity_key', 'document_id')
+        for (typename, entity_key, doc_id) in items.iterator():
+            links.setdefault((typename, entity_key), []).append(doc_id)
+        self._links = links
+        self._docs = docs
+
+    def stats(self):
+        """
+        The usage counters and size of the index.
+        """
+        stats = self.counters.stats()
+        with self._lock:
+            stats['entity_keys'] = len(self._links)
+            stats['documents'] = len(self._docs)
+        return stats
 
 class SearchOnEntity:
     """
@@ -110,6 +501,18 @@ class SearchOnEntity:
         self.typename = typename
         self.keys = keys
 
+class SearchFacets:
+    """
+    Search component that requests the counts of the entities linked to all
+    the matching documents.
+    """
+
+    def __init__(self, top: int | None = None, types: list[str] | None = None):
+        # The number of most linked entity keys returned for each type.
+        self.top = 10 if top is None else top
+        # Restrict the facets to these entity type names.
+        self.types = types
+
 class SearchModel:
     """
     Represents a search of documents in the database
@@ -119,48 +522,111 @@ class SearchModel:
                 label: str | None = None,
                 entities: list[SearchOnEntity] | None = None,
                 results_page: int | None = None,
-                page_size: int | None = None):
+                page_size: int | None = None,
+                text: str | None = None,
+                language: str | None = None,
+                cursor: str | None = None,
+                count: bool | None = None,
+                facets: SearchFacets | None = None):
         self.label = label
         self.entities = entities or []
         self.results_page = results_page or 1
         self.page_size = page_size or 25
+        # Full-text search over the transcriptions, optionally restricted to
+        # transcriptions in the given language code.
+        self.text = text
+        self.language = language
+        # An opaque cursor returned by a previous search, the next page of
+        # results starts right after it (results_page is then ignored).
+        self.cursor = cursor
+        # Whether to count the total matches when paging with a cursor, the
+        # first page is always counted.
+        self.count = bool(count)
+        self.facets = facets
+
+    def canonical(self):
+        """
+        A canonical JSON representation of the search, identical for all the
+        equivalent searches.
+        """
+        entities = {}
+        for e in self.entities:
+            entities.setdefault(e.typename, set()).update(e.keys)
+        data = {
+            'label': PublishedDocument.normalize_label(self.label) if self.label else None,
+            'entities': {typename: sorted(keys) for typename, keys in entities.items()},
+            'results_page': self.results_page,
+            'page_size': self.page_size,
+            'text': ' '.join(self.text.split()) if self.text else None,
+            'language': self.language,
+            'cursor': self.cursor,
+            'count': self.count,
+            'facets': {
+                'top': self.facets.top,
+                'types': sorted(self.facets.types) if self.facets.types is not None else None
+            } if self.facets else None
+        }
+        return json.dumps(data, sort_keys=True, separators=(',', ':'))
 
     @staticmethod
     def from_json(json_value: str):
         """
         Parse a JSON string to a SearchModel
         """
-        data = json.loads(json_value)
-        return SearchModel(
-            data.get('label'),
-            [SearchOnEntity(e['typename'], e['keys']) for e in data.get('entities', [])],
-            data.get('results_page'),
-            data.get('page_size'))
+        return SearchModel.from_dict(json.loads(json_value))
 
-class EntityCache:
-    """
-    A simple cache that organizes the entities associated with each document.
-    """
-
-    def __init__(self):
-        self._data = None
-
-    def get(self, doc_key: str):
+    @staticmethod
+    def _positive_int(data: dict, name: str):
         """
-        Get cached data for the document with the given key.
+        The optional positive integer value of a search field, numbers given
+        as strings are converted.
         """
-        if not self._data:
-            self.load()
-        return self._data.get(doc_key, {})
+        value = data.get(name)
+        if value is None:
+            return None
+        if isinstance(value, (int, str)) and not isinstance(value, bool):
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+            else:
+                if value > 0:
+                    return value
+        raise ValueError(f"{name} must be a positive integer")
 
-    def load(self):
+    @staticmethod
+    def from_dict(data: dict):
         """
-        Load the cache
+        Convert parsed JSON data to a SearchModel, raises ValueError for
+        invalid paging, entities or facets.
         """
-        items = EntityDocument.objects.select_related('document', 'entity_type').all()
-        data = {}
-        for item in items:
-            doc_data: dict[str,list[str]] = data.setdefault(item.document.key, {})
-            by_type_data: list[str] = doc_data.setdefault(item.entity_type.name, [])
-            by_type_data.append(item.entity_key)
-        self._data = data
+        if not isinstance(data, dict):
+            raise ValueError("Expected a search object")
+        entities = data.get('entities') or []
+        if not isinstance(entities, list) or not all(
+                isinstance(e, dict) and isinstance(e.get('typename'), str) and
+                isinstance(e.get('keys'), list) and all(isinstance(k, str) for k in e['keys'])
+                for e in entities):
+            raise ValueError("entities must be a list of entity type names with lists of keys")
+        facets = data.get('facets')
+        if isinstance(facets, dict):
+            top = facets.get('top')
+            types = facets.get('types')
+            if top is not None and (not isinstance(top, int) or isinstance(top, bool) or top < 0):
+                raise ValueError("facets.top must be a non-negative integer")
+            if types is not None and \
+                    not (isinstance(types, list) and all(isinstance(t, str) for t in types)):
+                raise ValueError("facets.types must be a list of entity type names")
+            facets = SearchFacets(top, types)
+        elif facets:
+            facets = SearchFacets()
+        return SearchModel(
+            data.get('label'),
+            [SearchOnEntity(e['typename'], e['keys']) for e in entities],
+            SearchModel._positive_int(data, 'results_page'),
+            SearchModel._positive_int(data, 'page_size'),
+            data.get('text'),
+            data.get('language'),
+            data.get('cursor'),
+            data.get('count'),
+            facets or None)
@@ -0,0 +1,69 @@
+"""
+Synchronization of the published documents read by searches
+"""
+
+import threading
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from api.models import Document, DocumentRevision, EntityDocument, EntityType, PublishedDocument, \
+    Transcription
+
+# The ids of the documents (or None for all the documents) changed in the
+# current transaction of each thread.
+_pending = threading.local()
+
+def _documents_changed(document_id: int | None):
+    ids = getattr(_pending, 'ids', set())
+    if document_id is None or ids is None:
+        ids = None
+    else:
+        ids.add(document_id)
+    _pending.ids = ids
+    # A callback is registered for each change but only the first one to run
+    # after the commit does any work, changes rolled back are simply
+    # synchronized with the next commit.
+    transaction.on_commit(_sync_changes)
+
+def _sync_changes():
+    if not hasattr(_pending, 'ids'):
+        return
+    ids = _pending.ids
+    del _pending.ids
+    if ids is None:
+        ids = Document.objects.values_list('id', flat=True)
+    PublishedDocument.sync(ids)
+
+def documents_changed(document_ids: list[int] | None = None):
+    """
+    Synchronize the published copies of the given documents, or of all the
+    documents if None, once the current transaction commits. This must be
+    called after bulk operations, which do not send signals.
+    """
+    if document_ids is None:
+        _documents_changed(None)
+    else:
+        for document_id in document_ids:
+            _documents_changed(document_id)
+
+@receiver([post_save, post_delete], sender=Document)
+def _document_changed(sender, instance: Document, **kwargs):
+    _documents_changed(instance.pk)
+
+@receiver([post_save, post_delete], sender=DocumentRevision)
+@receiver([post_save, post_delete], sender=EntityDocument)
+def _document_data_changed(sender, instance: DocumentRevision | EntityDocument, **kwargs):
+    _documents_changed(instance.document_id)
+
+@receiver([post_save, post_delete], sender=Transcription)
+def _transcription_changed(sender, instance: Transcription, **kwargs):
+    # Transcriptions are not copied but the cached full-text search responses
+    # depend on them.
+    _documents_changed(instance.document_rev.document_id)
+
+@receiver(post_save, sender=EntityType)
+def _entity_type_changed(sender, instance: EntityType, created: bool, **kwargs):
+    # Entity types cannot be deleted while linked to documents, and new ones
+    # are not linked to any document yet.
+    if not created:
+        _documents_changed(None)
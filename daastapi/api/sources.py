@@ -0,0 +1,318 @@
+"""
+Concurrent paginated fetching from the external source APIs and the
+on-disk storage of the fetched records
+"""
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable
+import requests
+from requests.adapters import HTTPAdapter
+
+class ErrorBudget:
+    """
+    Counts the consecutive failed requests to an API and aborts once there
+    are too many of them. Any successful request resets the count.
+    """
+
+    def __init__(self, name: str, max_errors: int):
+        self.name = name
+        self.max_errors = max_errors
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def failed(self, ex: Exception):
+        """
+        Record a failed request, raising if the budget is exhausted.
+        """
+        with self._lock:
+            self._count += 1
+            if self._count >= self.max_errors:
+                raise Exception(f"Too many failures fetching data from the {self.name} API: {ex}")
+
+    def succeeded(self):
+        """
+        Record a successful request.
+        """
+        with self._lock:
+            self._count = 0
+
+class PagedFetcher:
+    """
+    Fetches the pages of paginated APIs through a shared keep-alive session.
+    The first page of a listing is fetched alone to learn the total number
+    of records, then the remaining pages are fetched concurrently with at
+    most `workers` requests in flight and `workers * 2` pages buffered.
+    """
+
+    def __init__(self, workers: int = 4, timeout: int = 60):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix='source-fetch')
+
+    def get(self, url: str, **kwargs):
+        """
+        Send a GET request, raising for error statuses.
+        """
+        res = self.session.get(url, timeout=self.timeout, **kwargs)
+        res.raise_for_status()
+        return res
+
+    @staticmethod
+    def _with_retries(budget: ErrorBudget, fetch_page: Callable, offset: int):
+        while True:
+            try:
+                result = fetch_page(offset)
+                budget.succeeded()
+                return result
+            except Exception as ex:
+                budget.failed(ex)
+
+    def fetch_pages(self, fetch_page: Callable, budget: ErrorBudget):
+        """
+        Fetch all the pages of a listing. fetch_page(offset) fetches the
+        page starting at the given offset and returns a (result, count,
+        total) tuple with the number of records in the page and the total
+        number of records (None if unknown). Failed pages are retried within
+        the error budget. Yields the results in offset order.
+        """
+        (result, count, total) = PagedFetcher._with_retries(budget, fetch_page, 0)
+        yield result
+        offset = count
+        if total is not None and count:
+            # The page size of the first page is used as servers may cap
+            # the requested limit. At most twice as many pages as workers
+            # are requested ahead of the page being consumed, so a stalled
+            # page doesn't let completed pages pile up in memory.
+            page_offsets = iter(range(count, total, count))
+            futures = deque()
+            def submit():
+                page_offset = next(page_offsets, None)
+                if page_offset is not None:
+                    futures.append(self._executor.submit(
+                        PagedFetcher._with_retries, budget, fetch_page, page_offset))
+            for _ in range(self.workers * 2):
+                submit()
+            try:
+                while futures:
+                    (result, page_count, _) = futures.popleft().result()
+                    offset += page_count
+                    submit()
+                    yield result
+            finally:
+                for future in futures:
+                    future.cancel()
+            offset = max(offset, total)
+        # Continue one page at a time until an empty page, which also picks
+        # up records added while the listing was fetched.
+        while count:
+            (result, count, _) = PagedFetcher._with_retries(budget, fetch_page, offset)
+            if count:
+                yield result
+            offset += count
+
+    def close(self):
+        """
+        Release the worker threads and the connections.
+        """
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class RecordCache:
+    """
+    A JSON lines file of (table, key, data) records, where the later
+    records of a key replace the earlier ones. A new cache is written to a
+    temporary file that only replaces the existing cache once it is
+    complete, records can also be appended to an existing cache.
+    """
+
+    def __init__(self, filename: str, append: bool = False):
+        self.filename = filename
+        self._path = filename if append else filename + '.tmp'
+        if append:
+            with open(filename, 'ab+') as f:
+                size = f.seek(0, os.SEEK_END)
+                if size:
+                    f.seek(size - 1)
+                    if f.read(1) != b'\n':
+                        # End a record cut short by an interrupted write, so
+                        # that the next record isn't appended to it.
+                        f.write(b'\n')
+        self._file = open(self._path, 'a' if append else 'w', encoding='utf-8')
+
+    def write(self, table: str, rows: Iterable[tuple[str,str]]):
+        """
+        Write records given as (key, JSON data) rows.
+        """
+        prefix = json.dumps(table)
+        self._file.writelines(f"[{prefix}, {json.dumps(key)}, {data}]\n" for (key, data) in rows)
+        self._file.flush()
+
+    @staticmethod
+    def read(filename: str):
+        """
+        Read the (table, key, data) records of a cache file. Lines that are
+        not records, e.g. a line cut short by an interrupted write, are
+        skipped.
+        """
+        with open(filename, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, list) and len(record) == 3:
+                    yield record
+
+    def close(self, complete: bool = True):
+        """
+        Close the file, replacing the existing cache by a new one if it is
+        complete.
+        """
+        self._file.close()
+        if self._path != self.filename:
+            if complete:
+                os.replace(self._path, self.filename)
+            else:
+                os.remove(self._path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(exc_type is None)
+
+class SourceIndex:
+    """
+    An on-disk index of the records fetched from the external sources by
+    key, so that they can be joined in bounded memory. The index is a
+    temporary SQLite database removed when the index is closed. Records put
+    in a table replace the earlier records with the same key, the records
+    put after the index is loaded from a cache are flagged as changed.
+    """
+
+    def __init__(self):
+        (fd, self.path) = tempfile.mkstemp(prefix='source-index-', suffix='.sqlite3')
+        os.close(fd)
+        # The records are put from the fetch threads.
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._lock = threading.Lock()
+        self._tables = set()
+
+    def _table(self, name: str):
+        if name not in self._tables:
+            self._db.execute(f'CREATE TABLE IF NOT EXISTS "{name}" (' +
+                             'key TEXT PRIMARY KEY, data TEXT NOT NULL, changed INTEGER NOT NULL)')
+            self._tables.add(name)
+        return f'"{name}"'
+
+    def _insert(self, table: str, rows: list[tuple[str,str]], changed: bool):
+        with self._db:
+            self._db.executemany(
+                f'INSERT OR REPLACE INTO {self._table(table)} (key, data, changed) VALUES (?, ?, ?)',
+                [(key, data, int(changed)) for (key, data) in rows])
+
+    def put(self, table: str, items: Iterable[tuple[str,object]], cache: RecordCache | None = None):
+        """
+        Put (key, data) records in a table and append them to the cache.
+        Returns the number of records.
+        """
+        rows = [(key, json.dumps(data, ensure_ascii=False)) for (key, data) in items]
+        with self._lock:
+            if cache is not None:
+                cache.write(table, rows)
+            self._insert(table, rows, True)
+        return len(rows)
+
+    def load(self, filename: str, batch_size: int = 1000):
+        """
+        Load the records of a cache file, returns the number of records read.
+        """
+        count = 0
+        batches: dict[str,list] = {}
+        with self._lock:
+            for (table, key, data) in RecordCache.read(filename):
+                batch = batches.setdefault(table, [])
+                batch.append((key, json.dumps(data, ensure_ascii=False)))
+                if len(batch) >= batch_size:
+                    self._insert(table, batch, False)
+                    batch.clear()
+                count += 1
+            for (table, batch) in batches.items():
+                self._insert(table, batch, False)
+        return count
+
+    def count(self, tables: list[str]):
+        """
+        The total number of records in the tables.
+        """
+        return sum(self._db.execute(f'SELECT COUNT(*) FROM {self._table(table)}').fetchone()[0]
+                   for table in tables)
+
+    def dump(self, tables: list[str], cache: RecordCache):
+        """
+        Write all the records of the tables to a cache.
+        """
+        for table in tables:
+            rows = self._db.execute(f'SELECT key, data FROM {self._table(table)} ORDER BY key')
+            while batch := rows.fetchmany(1000):
+                cache.write(table, batch)
+
+    def join(self, required: list[str], optional: list[str] | None = None,
+             changed_only: bool = False, after: str | None = None):
+        """
+        Generate the (key, [data of each table]) records of the keys present
+        in all the required tables, ordered by key. The data of the optional
+        tables is None for a key they don't have. The records can be limited
+        to those that changed in any of the tables and to the keys after a
+        given key.
+        """
+        tables = [self._table(table) for table in required + (optional or [])]
+        sql = f'SELECT t0.key, {", ".join(f"t{i}.data" for i in range(len(tables)))} ' + \
+            f'FROM {tables[0]} t0'
+        for i, table in enumerate(tables[1:], 1):
+            sql += f' {"LEFT " if i >= len(required) else ""}JOIN {table} t{i} ON t{i}.key = t0.key'
+        conditions = []
+        params = []
+        if changed_only:
+            conditions.append('(' + ' OR '.join(f't{i}.changed = 1' for i in range(len(tables))) + ')')
+        if after is not None:
+            conditions.append('t0.key > ?')
+            params.append(after)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        rows = self._db.execute(sql + ' ORDER BY t0.key', params)
+        while batch := rows.fetchmany(1000):
+            for (key, *data) in batch:
+                yield (key, [json.loads(d) if d is not None else None for d in data])
+
+    def close(self):
+        """
+        Remove the index.
+        """
+        self._db.close()
+        os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
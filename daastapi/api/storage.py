@@ -0,0 +1,197 @@
+"""
+Storage backends for generated manifests
+"""
+
+import hashlib
+import os
+import pathlib
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+# The Content-Encoding of the files published for each file suffix.
+_content_encodings = { '.gz': 'gzip', '.br': 'br' }
+
+def _digest(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+class ManifestStorage(ABC):
+    """
+    Base class of the manifest storage backends.
+    """
+
+    @abstractmethod
+    def is_unchanged(self, name: str, digest: str) -> bool:
+        """
+        Check whether the stored file with the given name already has the
+        content with the given SHA-256 digest.
+        """
+
+    @abstractmethod
+    def save(self, name: str, data: bytes, digest: str):
+        """
+        Store a file, replacing any existing file with the same name.
+        """
+
+    def close(self):
+        """
+        Release any resource held by the storage.
+        """
+
+class LocalManifestStorage(ManifestStorage):
+    """
+    Stores manifests in a local directory. Files are written atomically by
+    renaming a fully written temporary file into place.
+    """
+
+    def __init__(self, out_dir: pathlib.Path):
+        self.out_dir = out_dir
+
+    def is_unchanged(self, name, digest):
+        try:
+            with open(self.out_dir.joinpath(name), 'rb') as f:
+                return _digest(f.read()) == digest
+        except FileNotFoundError:
+            return False
+
+    def save(self, name, data, digest):
+        path = self.out_dir.joinpath(name)
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix=f".{path.name}.",
+                                         suffix='.tmp', delete=False) as f:
+            try:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                # Temporary files are only readable by their owner.
+                os.chmod(f.name, 0o644)
+            except:
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, path)
+
+class BlobManifestStorage(ManifestStorage):
+    """
+    Stores manifests in an Azure Blob Storage container (which backs the
+    static website at MANIFEST_URL_BASE) using the Blob service REST API.
+    The container URL should include a SAS token with read/write permissions.
+    The Azurite emulator can be used as a local stand-in.
+
+    The SHA-256 digest of each blob is kept in its metadata so that unchanged
+    files are not uploaded again.
+    """
+
+    api_version = '2021-08-06'
+
+    def __init__(self, container_url: str, workers: int = 8, timeout: int = 60):
+        parts = urlsplit(container_url)
+        self._base = f"{parts.scheme}://{parts.netloc}{parts.path.rstrip('/')}"
+        self._query = parts.query
+        self.timeout = timeout
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max(1, workers))
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+    def _blob_url(self, name: str):
+        url = f"{self._base}/{quote(name)}"
+        return f"{url}?{self._query}" if self._query else url
+
+    def is_unchanged(self, name, digest):
+        res = self._session.head(self._blob_url(name),
+                                 headers={ 'x-ms-version': self.api_version },
+                                 timeout=self.timeout)
+        if res.status_code == 404:
+            return False
+        res.raise_for_status()
+        return res.headers.get('x-ms-meta-sha256') == digest
+
+    def save(self, name, data, digest):
+        headers = {
+            'x-ms-version': self.api_version,
+            'x-ms-blob-type': 'BlockBlob',
+            'x-ms-blob-content-type': 'application/json',
+            'x-ms-meta-sha256': digest
+        }
+        encoding = _content_encodings.get(pathlib.PurePosixPath(name).suffix)
+        if encoding:
+            headers['x-ms-blob-content-encoding'] = encoding
+        res = self._session.put(self._blob_url(name), data=data, headers=headers,
+                                timeout=self.timeout)
+        res.raise_for_status()
+
+    def close(self):
+        self._session.close()
+
+class ManifestPublisher:
+    """
+    Publishes files to a storage backend in parallel. The number of pending
+    files is bounded so that the build never runs too far ahead of the
+    uploads. Files whose stored content already has the same hash are skipped.
+    """
+
+    def __init__(self, storage: ManifestStorage, workers: int = 8):
+        self.storage = storage
+        self.workers = max(1, workers)
+        self.saved = 0
+        self.unchanged = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix='manifest-upload')
+        self._slots = threading.BoundedSemaphore(self.workers * 4)
+        self._lock = threading.Lock()
+        self._futures = []
+
+    def _publish(self, name: str, data: bytes):
+        try:
+            digest = _digest(data)
+            if self.storage.is_unchanged(name, digest):
+                with self._lock:
+                    self.unchanged += 1
+                return
+            self.storage.save(name, data, digest)
+            with self._lock:
+                self.saved += 1
+        finally:
+            self._slots.release()
+
+    def publish(self, name: str, data: bytes):
+        """
+        Queue a file for publication, blocking while too many files are
+        pending.
+        """
+        self._slots.acquire()
+        self._futures.append(self._executor.submit(self._publish, name, data))
+
+    def wait(self):
+        """
+        Wait until every queued file has landed in the storage. Raises the
+        first error that occurred, if any.
+        """
+        futures = self._futures
+        self._futures = []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """
+        Wait for the pending files and release the storage.
+        """
+        try:
+            self._executor.shutdown(wait=True)
+        finally:
+            self.storage.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stats(self):
+        """
+        A summary of the files published.
+        """
+        return f"{self.saved} files saved, {self.unchanged} unchanged"
@@ -1,3 +1,1507 @@
-from django.test import TestCase
+import contextlib
+import datetime
+import gzip
+import hashlib
+import importlib
+import io
+import json
+import os
+import pathlib
+import requests
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import urlencode, urlsplit
+from django.apps import apps as django_apps
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import F
+from django.test import Client, SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from api import fulltext, views
+from api.iiif import CircuitOpenError, HostPolicy, ImageInfoCache, ImageInfoFetcher, \
+    _TokenBucket
+from api.management.commands import generate_manifests
+from api.management.commands.import_external import Command as ImportCommand, _ImportStats
+from api.manifests import resolve_image_info
+from api.models import CacheVersion, Document, DocumentRevision, EntityDocument, \
+    EntityLookupIndex, EntityType, ImageServiceInfo, ImportCheckpoint, ManifestJob, \
+    ManifestJobItem, Page, PublishedDocument, QuarantinedRecord, SourceVersion, Transcription
+from api.sources import ErrorBudget, PagedFetcher, RecordCache, SourceIndex
+from api.storage import BlobManifestStorage, LocalManifestStorage, ManifestPublisher, \
+    ManifestStorage
 
-# Create your tests here.
+class _FakeImageServer:
+    """
+    Stands in for IIIF image servers by answering the info.json requests of
+    requests sessions with the registered image info. Conditional requests
+    are answered with 304 when the ETag matches.
+    """
+
+    def __init__(self):
+        self.infos: dict[str,dict] = {}
+        self.etags: dict[str,str] = {}
+        self.requests: list[str] = []
+        # The hosts that refuse connections.
+        self.down: set[str] = set()
+        # Error statuses returned by the next requests for an image service.
+        self.errors: dict[str,list[int]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, img_url_base: str, width: int = 4000, height: int = 3000,
+            profile: str = 'http://iiif.io/api/image/2/level2.json', etag: str | None = None):
+        self.infos[img_url_base] = {
+            '@context': 'http://iiif.io/api/image/2/context.json',
+            'profile': [profile],
+            'width': width,
+            'height': height
+        }
+        if etag:
+            self.etags[img_url_base] = etag
+
+    def get(self, session, url: str, headers: dict | None = None, **kwargs):
+        img_url_base = url.removesuffix('/info.json')
+        with self._lock:
+            self.requests.append(url)
+            errors = self.errors.get(img_url_base)
+            error = errors.pop(0) if errors else None
+        if urlsplit(url).netloc in self.down:
+            raise requests.ConnectionError("Connection refused")
+        info = self.infos.get(img_url_base)
+        etag = self.etags.get(img_url_base)
+        res = requests.Response()
+        res.url = url
+        res.status_code = error or (200 if info else 404)
+        res._content = json.dumps(info or {}).encode('utf-8')
+        if etag:
+            res.headers['ETag'] = etag
+            if (headers or {}).get('If-None-Match') == etag:
+                res.status_code = 304
+                res._content = b''
+        return res
+
+    def patch(self):
+        return mock.patch.object(requests.Session, 'get', autospec=True, side_effect=self.get)
+
+class ImageInfoFetcherTests(SimpleTestCase):
+
+    def test_results_in_page_order(self):
+        server = _FakeImageServer()
+        urls = [f"https://iiif{i % 2}.example.org/iiif/img{i}" for i in range(6)]
+        for i, url in enumerate(urls):
+            server.add(url, width=i + 1)
+
+        def slow_get(session, url, **kwargs):
+            # The first pages are answered last.
+            time.sleep(0.01 * (6 - len(server.requests)))
+            return server.get(session, url, **kwargs)
+
+        with mock.patch.object(requests.Session, 'get', autospec=True, side_effect=slow_get), \
+                ImageInfoFetcher(workers=4) as fetcher:
+            infos = fetcher.fetch_all(urls)
+            self.assertEqual(len(fetcher._hosts), 2)
+        self.assertEqual([info['width'] for info in infos], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(sorted(server.requests), sorted(f"{url}/info.json" for url in urls))
+
+class ManifestTestCase(TestCase):
+    """
+    Base test case running generate_manifests with stand-in image servers.
+    """
+
+    base_url = 'https://manifests.example.org'
+
+    def setUp(self):
+        self.server = _FakeImageServer()
+        patcher = self.server.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        out_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(out_dir.cleanup)
+        self.out_dir = out_dir.name
+
+    def add_revision(self, key: str, pages: int = 2, revision_number: int = 1,
+                     host: str = 'iiif.example.org', label: str | None = None,
+                     status: int = DocumentRevision.Status.APPROVED):
+        doc = Document.objects.get_or_create(key=key)[0]
+        page_images = []
+        for i in range(1, pages + 1):
+            path = f"/iiif/{key}_{revision_number}_{i}"
+            self.server.add(f"https://{host}{path}")
+            page_images.append([host, path])
+        rev = DocumentRevision.objects.create(
+            document=doc, revision_number=revision_number, label=label or f"Document {key}",
+            status=status, timestamp=datetime.date(1790, 1, 1),
+            content={ 'page_images': page_images, 'metadata': [] })
+        Page.objects.bulk_create(Page(revision=rev, page_number=i, image_url=f"https://{h}{p}")
+                                 for i, (h, p) in enumerate(page_images, 1))
+        return rev
+
+    def generate(self, *args, storage: list[str] | None = None):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            # The stand-in image servers need no rate limit.
+            call_command('generate_manifests', '--base-url', self.base_url, '--status', '100',
+                         '--host-rate', '0', *(storage or ['--out-dir', self.out_dir]), *args)
+        return out.getvalue()
+
+    def manifest(self, key: str, revision_number: int = 1):
+        with open(f"{self.out_dir}/{key}_rev{str(revision_number).zfill(3)}.json",
+                  encoding='utf-8') as f:
+            return json.load(f)
+
+class GenerateManifestsTests(ManifestTestCase):
+
+    def test_manifest(self):
+        rev = self.add_revision('K1', pages=3)
+        Transcription.objects.create(document_rev=rev, page_number=2, language_code='en',
+                                     text='Page two', is_translation=False)
+        EntityDocument.objects.create(document=rev.document, entity_key='7',
+                                      entity_type=EntityType.objects.get(name='Voyages'))
+        self.generate()
+        manifest = self.manifest('K1')
+        self.assertEqual(manifest['id'], f"{self.base_url}/K1")
+        self.assertEqual(manifest['label'], { 'en': ['Document K1'] })
+        img_url_bases = [f"https://iiif.example.org/iiif/K1_1_{i}" for i in range(1, 4)]
+        self.assertEqual([canvas['items'][0]['items'][0]['body']['service'][0]['id']
+                          for canvas in manifest['items']], img_url_bases)
+        canvas = manifest['items'][1]
+        self.assertEqual((canvas['width'], canvas['height']), (1920, 1440))
+        self.assertEqual(canvas['items'][0]['items'][0]['body']['service'][0]['type'],
+                         'ImageService2')
+        self.assertEqual(canvas['annotations'][0]['items'][0]['body']['value'], 'Page two')
+        self.assertNotIn('annotations', manifest['items'][0])
+        self.assertEqual(manifest['metadata'][0]['label'], { 'en': ['Linked Voyages'] })
+        rev.refresh_from_db()
+        rev.document.refresh_from_db()
+        self.assertEqual(rev.status, DocumentRevision.Status.PUBLISHED)
+        self.assertEqual(rev.document.current_rev, 1)
+        self.assertEqual(rev.document.thumbnail, f"{img_url_bases[0]}/full/300,300/0/default.jpg")
+
+    def test_no_images(self):
+        rev = self.add_revision('K1', pages=0)
+        self.generate()
+        rev.refresh_from_db()
+        self.assertEqual(rev.status, DocumentRevision.Status.NO_IMAGES)
+        self.assertEqual(self.server.requests, [])
+
+    def test_bad_profile(self):
+        self.add_revision('K1')
+        rev = self.add_revision('K2')
+        self.server.add('https://iiif.example.org/iiif/K2_1_2', profile='http://example.org/profile')
+        self.add_revision('K3')
+        out = self.generate('--chunk-size', '2')
+        self.assertIn("Failed to find API version and level for image service: " +
+                      "Document K2 [K2]", out)
+        # The failed revision is recorded and the run goes on.
+        job = ManifestJob.objects.get()
+        self.assertIn(f"Failed to generate 1 manifests, retry them with --resume {job.pk}", out)
+        self.assertEqual(list(DocumentRevision.objects
+                              .filter(status=DocumentRevision.Status.PUBLISHED)
+                              .values_list('document__key', flat=True)), ['K1', 'K3'])
+        item = job.items.get(revision=rev)
+        self.assertEqual((item.state, item.reason), (ManifestJobItem.State.FAILED,
+            "Failed to find API version and level for image service"))
+
+    def test_image_info_cache(self):
+        self.add_revision('K1')
+        self.assertIn("Image info cache: 0 hits, 2 misses, 0 revalidated", self.generate())
+        Page.objects.update(width=None)
+        DocumentRevision.objects.update(status=DocumentRevision.Status.APPROVED)
+        self.server.requests.clear()
+        self.assertIn("Image info cache: 2 hits, 0 misses, 0 revalidated", self.generate())
+        self.assertEqual(self.server.requests, [])
+        DocumentRevision.objects.update(status=DocumentRevision.Status.APPROVED)
+        self.assertIn("Image info cache: 0 hits, 2 misses, 0 revalidated",
+                      self.generate('--refresh-image-info'))
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_chunks(self):
+        for i in range(1, 6):
+            self.add_revision(f"K{i}", pages=i % 2)
+        with CaptureQueriesContext(connection) as queries:
+            self.generate('--chunk-size', '2')
+        self.assertEqual(sorted(DocumentRevision.objects.values_list('document__key', 'status')), [
+            ('K1', DocumentRevision.Status.PUBLISHED),
+            ('K2', DocumentRevision.Status.NO_IMAGES),
+            ('K3', DocumentRevision.Status.PUBLISHED),
+            ('K4', DocumentRevision.Status.NO_IMAGES),
+            ('K5', DocumentRevision.Status.PUBLISHED)
+        ])
+        self.assertEqual(sorted(Document.objects.values_list('key', 'current_rev')),
+                         [('K1', 1), ('K2', None), ('K3', 1), ('K4', None), ('K5', 1)])
+        # One bulk update of the revisions per chunk.
+        updates = [q['sql'] for q in queries.captured_queries
+                   if q['sql'].startswith('UPDATE "api_documentrevision"')]
+        self.assertEqual(len(updates), 3)
+
+    def test_workers(self):
+        for i in range(1, 6):
+            self.add_revision(f"K{i}", pages=i)
+        self.generate('--workers', '2', '--chunk-size', '3')
+        manifests = {}
+        for i in range(1, 6):
+            manifests[i] = self.manifest(f"K{i}")
+            os.remove(f"{self.out_dir}/K{i}_rev001.json")
+        self.assertFalse(DocumentRevision.objects
+                         .exclude(status=DocumentRevision.Status.PUBLISHED).exists())
+        # The worker processes build the same manifests.
+        DocumentRevision.objects.update(status=DocumentRevision.Status.APPROVED)
+        self.generate()
+        for i in range(1, 6):
+            self.assertEqual(self.manifest(f"K{i}"), manifests[i])
+            self.assertEqual(len(manifests[i]['items']), i)
+
+    def test_image_server_error(self):
+        self.add_revision('K1')
+        self.add_revision('K2', host='down.example.org')
+        self.server.down.add('down.example.org')
+        out = self.generate('--fetch-retries', '0', '--fetch-workers', '1',
+                            '--circuit-threshold', '1')
+        # The second page of K2 is skipped once the first one failed.
+        self.assertIn("Image server down.example.org: 1 requests, 1 errors, 0 retries, " +
+                      "1 skipped", out)
+        self.assertIn("Image server iiif.example.org: 2 requests, 0 errors", out)
+        self.assertEqual(sorted(ManifestJobItem.objects.values_list('revision__document__key',
+                                                                    'state', 'reason')), [
+            ('K1', ManifestJobItem.State.PROCESSED, None),
+            ('K2', ManifestJobItem.State.FAILED,
+             "Failed to fetch image service info: Connection refused")
+        ])
+
+    def test_published_copies(self):
+        self.add_revision('K1')
+        self.add_revision('K2', pages=0)
+        self.generate()
+        self.assertEqual(list(PublishedDocument.objects.values_list('key', 'thumbnail')), [
+            ('K1', "https://iiif.example.org/iiif/K1_1_1/full/300,300/0/default.jpg")
+        ])
+
+    def test_revisions_of_a_document_in_one_chunk(self):
+        self.add_revision('K1')
+        self.add_revision('K1', revision_number=2)
+        self.generate()
+        doc = Document.objects.get(key='K1')
+        self.assertEqual(doc.current_rev, 2)
+        self.assertEqual(doc.thumbnail,
+                         "https://iiif.example.org/iiif/K1_2_1/full/300,300/0/default.jpg")
+        self.assertEqual(list(PublishedDocument.objects.values_list('key', 'revision_number')),
+                         [('K1', 2)])
+
+class ImageInfoCacheTests(TestCase):
+
+    urls = ['https://iiif.example.org/iiif/img1', 'https://iiif.example.org/iiif/img2']
+
+    def setUp(self):
+        self.server = _FakeImageServer()
+        for i, url in enumerate(self.urls, 1):
+            self.server.add(url, width=i, etag=f'"v{i}"')
+        patcher = self.server.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fetcher = ImageInfoFetcher(workers=2)
+        self.addCleanup(self.fetcher.close)
+
+    def fetch_all(self, cache: ImageInfoCache, urls: list[str]):
+        self.server.requests.clear()
+        return [info['width'] for info in cache.fetch_all(urls)]
+
+    def test_cached(self):
+        cache = ImageInfoCache(self.fetcher, timedelta(days=1))
+        self.assertEqual(self.fetch_all(cache, self.urls + self.urls[:1]), [1, 2, 1])
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.fetch_all(ImageInfoCache(self.fetcher, timedelta(days=1)), self.urls),
+                         [1, 2])
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(ImageServiceInfo.objects.get(url=self.urls[0]).etag, '"v1"')
+        self.assertEqual(cache.stats(), "1 hits, 2 misses, 0 revalidated")
+
+    def test_expired(self):
+        cache = ImageInfoCache(self.fetcher, timedelta(days=1))
+        self.fetch_all(cache, self.urls)
+        ImageServiceInfo.objects.update(fetched_at=F('fetched_at') - timedelta(days=2))
+        self.server.add(self.urls[1], width=20, etag='"v20"')
+        self.assertEqual(self.fetch_all(cache, self.urls), [1, 20])
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(cache.stats(), "0 hits, 3 misses, 1 revalidated")
+        # Revalidated entries are fresh again.
+        self.assertEqual(self.fetch_all(cache, self.urls), [1, 20])
+        self.assertEqual(self.server.requests, [])
+
+    def test_refresh(self):
+        self.fetch_all(ImageInfoCache(self.fetcher, timedelta(days=1)), self.urls)
+        self.server.add(self.urls[0], width=10, etag='"v1"')
+        cache = ImageInfoCache(self.fetcher, timedelta(days=1), refresh=True)
+        # No conditional request when refreshing.
+        self.assertEqual(self.fetch_all(cache, self.urls), [10, 2])
+        self.assertEqual(cache.stats(), "0 hits, 2 misses, 0 revalidated")
+
+class IncrementalManifestTests(ManifestTestCase):
+
+    def test_incremental(self):
+        self.add_revision('K1')
+        rev = self.add_revision('K2')
+        self.generate()
+        self.assertEqual(len(set(DocumentRevision.objects
+                                 .values_list('manifest_fingerprint', flat=True))), 2)
+        # Relinking one document only rebuilds its manifest.
+        EntityDocument.objects.create(document=rev.document, entity_key='7',
+                                      entity_type=EntityType.objects.get(name='Voyages'))
+        os.remove(f"{self.out_dir}/K1_rev001.json")
+        self.server.requests.clear()
+        self.assertIn("Skipped 1 unchanged manifests", self.generate('--incremental'))
+        self.assertFalse(os.path.exists(f"{self.out_dir}/K1_rev001.json"))
+        self.assertEqual(self.manifest('K2')['metadata'][0]['label'], { 'en': ['Linked Voyages'] })
+        self.assertIn("Skipped 2 unchanged manifests", self.generate('--incremental'))
+
+    def test_new_base_url(self):
+        self.add_revision('K1')
+        self.generate()
+        self.base_url = 'https://other.example.org'
+        self.assertIn("Skipped 0 unchanged manifests", self.generate('--incremental'))
+        self.assertEqual(self.manifest('K1')['id'], 'https://other.example.org/K1')
+
+class ManifestOutputTests(ManifestTestCase):
+
+    def test_compressed(self):
+        self.add_revision('K1')
+        self.generate('--compact', '--compress', 'gzip')
+        self.assertEqual(sorted(os.listdir(self.out_dir)),
+                         ['K1_rev001.json', 'K1_rev001.json.gz', 'index.json'])
+        with open(f"{self.out_dir}/K1_rev001.json", 'rb') as f:
+            payload = f.read()
+        self.assertNotIn(b'", "', payload)
+        self.assertEqual(json.loads(payload)['id'], f"{self.base_url}/K1")
+        with gzip.open(f"{self.out_dir}/K1_rev001.json.gz") as f:
+            self.assertEqual(f.read(), payload)
+
+    def test_brotli_required(self):
+        with mock.patch.object(generate_manifests, 'brotli', None), \
+                self.assertRaisesMessage(CommandError, "The brotli package is required"):
+            self.generate('--compress', 'br')
+
+    def test_index(self):
+        self.add_revision('K1')
+        self.add_revision('K2', pages=0)
+        self.add_revision('K3')
+        self.generate()
+        with open(f"{self.out_dir}/index.json", encoding='utf-8') as f:
+            self.assertEqual(json.load(f), { 'manifests': [
+                { 'key': 'K1', 'revision_number': 1, 'file': 'K1_rev001.json' },
+                { 'key': 'K3', 'revision_number': 1, 'file': 'K3_rev001.json' }
+            ] })
+
+    def test_storage_required(self):
+        with self.assertRaisesMessage(CommandError, "Exactly one of --out-dir or " +
+                                      "--blob-container-url is required"):
+            self.generate(storage=['--out-dir', self.out_dir,
+                                   '--blob-container-url', 'http://localhost/manifests'])
+
+class _MemoryStorage(ManifestStorage):
+    """
+    Keeps the published files in memory.
+    """
+
+    def __init__(self):
+        self.files: dict[str,bytes] = {}
+        self.saved: list[str] = []
+        self._lock = threading.Lock()
+
+    def is_unchanged(self, name, digest):
+        return name in self.files and hashlib.sha256(self.files[name]).hexdigest() == digest
+
+    def save(self, name, data, digest):
+        with self._lock:
+            self.files[name] = data
+            self.saved.append(name)
+
+class ManifestPublisherTests(SimpleTestCase):
+
+    def test_skip_unchanged(self):
+        storage = _MemoryStorage()
+        with ManifestPublisher(storage, workers=2) as publisher:
+            publisher.publish('K1_rev001.json', b'1')
+            publisher.publish('K2_rev001.json', b'2')
+            publisher.wait()
+            self.assertEqual(sorted(storage.saved), ['K1_rev001.json', 'K2_rev001.json'])
+            publisher.publish('K1_rev001.json', b'1')
+            publisher.publish('K2_rev001.json', b'20')
+            publisher.wait()
+            self.assertEqual(publisher.stats(), "3 files saved, 1 unchanged")
+        self.assertEqual(storage.files['K2_rev001.json'], b'20')
+
+    def test_errors(self):
+        storage = _MemoryStorage()
+        with mock.patch.object(storage, 'save', side_effect=OSError("Disk full")), \
+                ManifestPublisher(storage) as publisher:
+            publisher.publish('K1_rev001.json', b'1')
+            with self.assertRaisesMessage(OSError, "Disk full"):
+                publisher.wait()
+
+    def test_incomplete_storage(self):
+        class ReadOnlyStorage(ManifestStorage):
+            def is_unchanged(self, name, digest):
+                return False
+        with self.assertRaises(TypeError):
+            ReadOnlyStorage()
+
+class LocalManifestStorageTests(SimpleTestCase):
+
+    def setUp(self):
+        out_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(out_dir.cleanup)
+        self.out_dir = pathlib.Path(out_dir.name)
+        self.storage = LocalManifestStorage(self.out_dir)
+
+    def test_is_unchanged(self):
+        digest = hashlib.sha256(b'{}').hexdigest()
+        self.assertFalse(self.storage.is_unchanged('K1_rev001.json', digest))
+        self.storage.save('K1_rev001.json', b'{}', digest)
+        self.assertTrue(self.storage.is_unchanged('K1_rev001.json', digest))
+        self.assertFalse(self.storage.is_unchanged('K1_rev001.json', '0' * 64))
+
+    def test_atomic_write(self):
+        self.storage.save('K1_rev001.json', b'{"v": 1}', '')
+        with mock.patch('os.fsync', side_effect=OSError("Disk full")), \
+                self.assertRaises(OSError):
+            self.storage.save('K1_rev001.json', b'{"v": 2}', '')
+        # The previous file is left in place and the temporary file is removed.
+        self.assertEqual(os.listdir(self.out_dir), ['K1_rev001.json'])
+        self.assertEqual(self.out_dir.joinpath('K1_rev001.json').read_bytes(), b'{"v": 1}')
+
+class _BlobServiceStub(BaseHTTPRequestHandler):
+    """
+    A minimal stand-in for the Blob service REST API, storing the blobs of
+    the server in memory.
+    """
+
+    def do_HEAD(self):
+        blob = self.server.blobs.get(urlsplit(self.path).path)
+        self.send_response(404 if blob is None else 200)
+        if blob is not None:
+            self.send_header('x-ms-meta-sha256', blob['headers'].get('x-ms-meta-sha256'))
+        self.end_headers()
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(self.path)
+        self.server.blobs[urlsplit(self.path).path] = { 'data': data, 'headers': self.headers }
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class BlobManifestStorageTests(ManifestTestCase):
+
+    def setUp(self):
+        super().setUp()
+        server = ThreadingHTTPServer(('localhost', 0), _BlobServiceStub)
+        server.blobs = {}
+        server.requests = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.server_stub = server
+        self.container_url = f"http://localhost:{server.server_port}/manifests?sv=1&sig=x"
+
+    def test_storage(self):
+        storage = BlobManifestStorage(self.container_url)
+        self.addCleanup(storage.close)
+        digest = hashlib.sha256(b'{}').hexdigest()
+        self.assertFalse(storage.is_unchanged('K1_rev001.json.gz', digest))
+        storage.save('K1_rev001.json.gz', b'{}', digest)
+        self.assertTrue(storage.is_unchanged('K1_rev001.json.gz', digest))
+        self.assertEqual(self.server_stub.requests, ['/manifests/K1_rev001.json.gz?sv=1&sig=x'])
+        blob = self.server_stub.blobs['/manifests/K1_rev001.json.gz']
+        self.assertEqual(blob['headers']['x-ms-blob-content-encoding'], 'gzip')
+        self.assertEqual(blob['headers']['x-ms-blob-type'], 'BlockBlob')
+
+    def test_generate(self):
+        self.add_revision('K1')
+        self.add_revision('K2')
+        out = self.generate(storage=['--blob-container-url', self.container_url])
+        self.assertIn("Manifest storage: 3 files saved, 0 unchanged", out)
+        # The index is uploaded after all the manifests.
+        self.assertEqual(self.server_stub.requests[-1], '/manifests/index.json?sv=1&sig=x')
+        manifest = json.loads(self.server_stub.blobs['/manifests/K2_rev001.json']['data'])
+        self.assertEqual(manifest['id'], f"{self.base_url}/K2")
+        DocumentRevision.objects.update(status=DocumentRevision.Status.APPROVED)
+        out = self.generate(storage=['--blob-container-url', self.container_url])
+        self.assertIn("Manifest storage: 0 files saved, 3 unchanged", out)
+
+class ManifestJobTests(ManifestTestCase):
+
+    def test_resume(self):
+        for i in range(1, 4):
+            self.add_revision(f"K{i}")
+        manifest_spec = generate_manifests._manifest_spec
+
+        def interrupted_spec(rev):
+            if rev.document.key == 'K3':
+                raise KeyboardInterrupt()
+            return manifest_spec(rev)
+
+        with mock.patch.object(generate_manifests, '_manifest_spec', interrupted_spec), \
+                self.assertRaises(KeyboardInterrupt):
+            self.generate('--chunk-size', '1', '--compact')
+        job = ManifestJob.objects.get()
+        self.assertEqual(job.status, ManifestJob.Status.RUNNING)
+        self.assertEqual(job.options['compact'], True)
+        self.assertEqual(job.checkpoint, DocumentRevision.objects.get(document__key='K2').pk)
+        out = self.generate('--resume', str(job.pk))
+        self.assertIn("Found 1 revisions to publish", out)
+        # The manifest of K3 and the index.
+        self.assertIn("Manifest storage: 2 files saved, 0 unchanged", out)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ManifestJob.Status.FINISHED)
+        self.assertEqual(job.items.filter(state=ManifestJobItem.State.PROCESSED).count(), 3)
+        # The options of the job are used when resuming.
+        with open(f"{self.out_dir}/K3_rev001.json", 'rb') as f:
+            self.assertNotIn(b'", "', f.read())
+
+    def test_retry_failed(self):
+        rev = self.add_revision('K1')
+        self.server.add('https://iiif.example.org/iiif/K1_1_1', profile='http://example.org/profile')
+        self.generate()
+        job = ManifestJob.objects.get()
+        self.assertIn("Found 1 revisions to publish",
+                      self.generate('--resume', str(job.pk), '--max-retries', '1'))
+        self.assertEqual(job.items.get().retry_count, 1)
+        self.assertIn("Found 0 revisions to publish",
+                      self.generate('--resume', str(job.pk), '--max-retries', '1'))
+        self.server.add('https://iiif.example.org/iiif/K1_1_1')
+        self.generate('--resume', str(job.pk), '--max-retries', '2', '--refresh-image-info')
+        item = job.items.get()
+        self.assertEqual((item.state, item.retry_count), (ManifestJobItem.State.PROCESSED, 2))
+        rev.refresh_from_db()
+        self.assertEqual(rev.status, DocumentRevision.Status.PUBLISHED)
+
+    def test_unknown_job(self):
+        with self.assertRaisesMessage(CommandError, "Manifest job 10 does not exist"):
+            self.generate('--resume', '10')
+
+class HostPolicyTests(SimpleTestCase):
+
+    url = 'https://iiif.example.org/iiif/img1'
+
+    def setUp(self):
+        self.server = _FakeImageServer()
+        self.server.add(self.url)
+        # Requests go through get, which tests can replace.
+        self.get = self.server.get
+        patcher = mock.patch.object(requests.Session, 'get', autospec=True,
+                                    side_effect=lambda *args, **kwargs: self.get(*args, **kwargs))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetcher(self, **policy):
+        fetcher = ImageInfoFetcher(workers=4, policy=HostPolicy(backoff=0, **policy))
+        self.addCleanup(fetcher.close)
+        return fetcher
+
+    def test_retries(self):
+        self.server.errors[self.url] = [503, 429]
+        fetcher = self.fetcher(retries=2)
+        self.assertEqual(fetcher.fetch(self.url)['width'], 4000)
+        self.assertTrue(fetcher.host_stats()['iiif.example.org']
+                        .startswith("3 requests, 2 errors, 2 retries, 0 skipped"))
+        self.server.errors[self.url] = [500, 500, 500]
+        with self.assertRaises(requests.HTTPError):
+            fetcher.fetch(self.url)
+
+    def test_client_errors_not_retried(self):
+        fetcher = self.fetcher(retries=2)
+        with self.assertRaises(requests.HTTPError):
+            fetcher.fetch('https://iiif.example.org/iiif/missing')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_circuit_breaker(self):
+        self.server.down.add('iiif.example.org')
+        fetcher = self.fetcher(retries=0, failure_threshold=2, cooldown=60)
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                fetcher.fetch(self.url)
+        with self.assertRaisesMessage(CircuitOpenError,
+                                      "Circuit open for image server iiif.example.org"):
+            fetcher.fetch(self.url)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertTrue(fetcher.host_stats()['iiif.example.org']
+                        .startswith("2 requests, 2 errors, 0 retries, 1 skipped"))
+
+    def test_circuit_cooldown(self):
+        self.server.errors[self.url] = [503]
+        fetcher = self.fetcher(retries=0, failure_threshold=1, cooldown=0)
+        with self.assertRaises(requests.HTTPError):
+            fetcher.fetch(self.url)
+        self.assertEqual(fetcher.fetch(self.url)['width'], 4000)
+
+    def test_concurrency(self):
+        active = []
+        max_active = []
+        lock = threading.Lock()
+
+        def slow_get(session, url, **kwargs):
+            with lock:
+                active.append(url)
+                max_active.append(len(active))
+            time.sleep(0.01)
+            with lock:
+                active.remove(url)
+            return self.server.get(session, url, **kwargs)
+
+        urls = [f"{self.url}_{i}" for i in range(8)]
+        for url in urls:
+            self.server.add(url)
+        self.get = slow_get
+        self.fetcher(concurrency=2, rate=0).fetch_all(urls)
+        self.assertEqual(max(max_active), 2)
+
+    def test_rate(self):
+        bucket = _TokenBucket(rate=100, capacity=2)
+        start = time.monotonic()
+        for _ in range(12):
+            bucket.acquire()
+        # The first 2 tokens are available right away.
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+class PageTests(ManifestTestCase):
+
+    def test_resolve_image_info(self):
+        self.assertEqual(resolve_image_info({
+            '@context': 'http://iiif.io/api/image/2/context.json',
+            'profile': ['http://iiif.io/api/image/2/level1.json'],
+            'width': '400',
+            'height': 300
+        }), { 'width': 400, 'height': 300, 'api_version': '2', 'profile_level': 'level1' })
+
+    def test_pages_resolved(self):
+        rev = self.add_revision('K1')
+        self.server.add('https://iiif.example.org/iiif/K1_1_2', width=1000, height=2000)
+        Page.objects.create(revision=rev, page_number=3)
+        self.assertFalse(any(page.is_resolved for page in rev.pages.all()))
+        self.generate()
+        self.assertEqual(list(rev.pages.order_by('page_number')
+                              .values_list('width', 'height', 'api_version', 'profile_level')), [
+            (4000, 3000, '2', 'level2'),
+            (1000, 2000, '2', 'level2'),
+            (None, None, None, None)
+        ])
+        # Pages without an image are left out of the manifest.
+        self.assertEqual(len(self.manifest('K1')['items']), 2)
+
+    def test_resolved_pages_not_fetched(self):
+        self.add_revision('K1')
+        self.generate()
+        manifest = self.manifest('K1')
+        # A change of the image service is only seen when refreshing.
+        self.server.add('https://iiif.example.org/iiif/K1_1_1', width=1000, height=2000)
+        DocumentRevision.objects.update(status=DocumentRevision.Status.APPROVED)
+        self.server.requests.clear()
+        self.generate()
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(self.manifest('K1'), manifest)
+        DocumentRevision.objects.update(status=DocumentRevision.Status.APPROVED)
+        self.generate('--refresh-image-info')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.manifest('K1')['items'][0]['items'][0]['items'][0]['body']['width'],
+                         1000)
+
+    def test_failed_pages_not_recorded(self):
+        rev = self.add_revision('K1')
+        self.server.add('https://iiif.example.org/iiif/K1_1_1', profile='http://example.org/profile')
+        self.generate()
+        self.assertEqual([page.is_resolved for page in rev.pages.order_by('page_number')],
+                         [False, True])
+
+    def test_seed_pages(self):
+        self.add_revision('K1', pages=0)
+        rev = self.add_revision('K2')
+        rev.pages.all().delete()
+        seed_pages = importlib.import_module('api.migrations.0007_page_seed').seed_pages
+        seed_pages(django_apps, None)
+        self.assertEqual(list(Page.objects.values_list('revision', 'page_number', 'image_url')), [
+            (rev.pk, 1, 'https://iiif.example.org/iiif/K2_1_1'),
+            (rev.pk, 2, 'https://iiif.example.org/iiif/K2_1_2')
+        ])
+
+    def test_pages_synchronized(self):
+        rev = self.add_revision('K1')
+        # The content was edited without updating the pages.
+        self.server.add('https://iiif.example.org/iiif/new', width=1000, height=2000)
+        rev.content['page_images'] = [['iiif.example.org', '/iiif/K1_1_2'],
+                                      ['iiif.example.org', '/iiif/new']]
+        rev.save()
+        self.generate()
+        self.assertEqual(list(rev.pages.order_by('page_number')
+                              .values_list('page_number', 'image_url', 'width')), [
+            (1, 'https://iiif.example.org/iiif/K1_1_2', 4000),
+            (2, 'https://iiif.example.org/iiif/new', 1000)
+        ])
+        self.assertEqual([canvas['items'][0]['items'][0]['body']['service'][0]['id']
+                          for canvas in self.manifest('K1')['items']],
+                         ['https://iiif.example.org/iiif/K1_1_2',
+                          'https://iiif.example.org/iiif/new'])
+
+    def test_refreshed_dimensions(self):
+        self.add_revision('K1')
+        self.generate()
+        self.server.add('https://iiif.example.org/iiif/K1_1_1', width=1000, height=2000)
+        self.assertIn("Skipped 1 unchanged manifests", self.generate('--incremental'))
+        # Refreshed image service details rebuild the manifest.
+        self.assertIn("Skipped 0 unchanged manifests",
+                      self.generate('--incremental', '--refresh-image-info'))
+        self.assertEqual(self.manifest('K1')['items'][0]['items'][0]['items'][0]['body']['width'],
+                         1000)
+        self.assertIn("Skipped 1 unchanged manifests",
+                      self.generate('--incremental', '--refresh-image-info'))
+
+class ApiTestCase(TestCase):
+    """
+    Base test case with helpers to publish documents and call the API.
+    """
+
+    def setUp(self):
+        # Cached responses are indexed by data version, which is rolled back
+        # after each test.
+        cache.clear()
+        self.client = Client(HTTP_HOST='localhost')
+
+    def publish(self, key: str, label: str, transcriptions: list[str] | None = None,
+                entities: dict[str,list[str]] | None = None, language: str = 'en'):
+        with self.captureOnCommitCallbacks(execute=True):
+            doc = Document.objects.create(key=key, current_rev=1, bib=f"Bib {key}")
+            rev = DocumentRevision.objects.create(
+                document=doc, label=label, status=DocumentRevision.Status.PUBLISHED,
+                revision_number=1, timestamp=datetime.date(1790, 1, 1), content={})
+            for i, text in enumerate(transcriptions or [], 1):
+                Transcription.objects.create(document_rev=rev, page_number=i, language_code=language,
+                                             text=text, is_translation=False)
+            for typename, keys in (entities or {}).items():
+                for entity_key in keys:
+                    EntityDocument.objects.create(
+                        document=doc, entity_type=EntityType.objects.get(name=typename),
+                        entity_key=entity_key)
+        return doc
+
+    def post(self, url: str, data):
+        return self.client.post(url, json.dumps(data), content_type='application/json')
+
+    def search(self, data):
+        response = self.post('/api/search', data)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+class TextSearchTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.publish('SHIP1', 'Ship one', ['The ship arrived in Bahia',
+                                           'Cargo of sugar, tobacco, cotton, rum and other goods'])
+        self.publish('SHIP2', 'Ship two', ['A ship from Lisbon to Bahia', 'Sugar and more sugar'])
+        self.publish('SHIP3', 'Ship three', ['Navio chegou à Bahia'], language='pt')
+        self.publish('OTHER', 'Other', ['Nothing to see'])
+
+    def test_text(self):
+        result = self.search({ 'text': 'sugar' })
+        self.assertEqual(result['matches'], 2)
+        # The revision with the most occurrences ranks first.
+        self.assertEqual([item['key'] for item in result['results']], ['SHIP2', 'SHIP1'])
+        self.assertGreaterEqual(result['results'][0]['score'], result['results'][1]['score'])
+        snippet = result['results'][1]['snippets'][0]
+        self.assertEqual((snippet['page'], snippet['language']), (2, 'en'))
+        self.assertIn('sugar', snippet['snippet'])
+
+    def test_language(self):
+        result = self.search({ 'text': 'bahia', 'language': 'pt' })
+        self.assertEqual([item['key'] for item in result['results']], ['SHIP3'])
+        result = self.search({ 'text': 'bahia' })
+        self.assertEqual(result['matches'], 3)
+
+    def test_text_and_label(self):
+        result = self.search({ 'text': 'bahia', 'label': 'ship t' })
+        self.assertEqual(sorted(item['key'] for item in result['results']), ['SHIP2', 'SHIP3'])
+
+    def test_results_page(self):
+        keys = []
+        for results_page in range(1, 4):
+            result = self.search({ 'text': 'bahia', 'page_size': 1,
+                                   'results_page': results_page })
+            keys += [item['key'] for item in result['results']]
+        self.assertEqual(sorted(keys), ['SHIP1', 'SHIP2', 'SHIP3'])
+
+    def test_no_terms(self):
+        result = self.search({ 'text': ' "*" ' })
+        self.assertEqual((result['matches'], result['results']), (0, []))
+
+    def test_unsupported_database(self):
+        with mock.patch.object(fulltext, 'is_supported', return_value=False):
+            response = self.post('/api/search', { 'text': 'sugar' })
+        self.assertEqual(response.status_code, 400)
+
+    def test_index_sync(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            transcription = Transcription.objects.get(text='Nothing to see')
+            transcription.text = 'Sugar at last'
+            transcription.save()
+        self.assertEqual(self.search({ 'text': 'sugar' })['matches'], 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            Transcription.objects.filter(document_rev__document__key='SHIP2').delete()
+        self.assertEqual(self.search({ 'text': 'sugar' })['matches'], 2)
+
+    def test_cursor_paging(self):
+        keys = []
+        result = self.search({ 'text': 'bahia', 'page_size': 1 })
+        keys.append(result['results'][0]['key'])
+        while result['next_cursor']:
+            result = self.search({ 'text': 'bahia', 'page_size': 1,
+                                   'cursor': result['next_cursor'] })
+            keys += [item['key'] for item in result['results']]
+        self.assertEqual(sorted(keys), ['SHIP1', 'SHIP2', 'SHIP3'])
+        # A key cursor is not valid for text searches.
+        response = self.post('/api/search', {
+            'text': 'bahia',
+            'cursor': self.search({ 'page_size': 1 })['next_cursor']
+        })
+        self.assertEqual(response.status_code, 400)
+
+class SearchTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(25):
+            self.publish(f"DOC{i:02d}", f"Register {i}", entities={
+                'Voyages': [str(i % 3)],
+                'Enslaved': [str(i)]
+            })
+
+    def test_result_fields(self):
+        result = self.search({ 'label': 'register 7' })
+        self.assertEqual(result['results'], [{
+            'label': 'Register 7',
+            'revision_number': 1,
+            'key': 'DOC07',
+            'bib': 'Bib DOC07',
+            'entities': { 'Voyages': ['1'], 'Enslaved': ['7'] },
+            'thumb': None
+        }])
+
+    def test_entities(self):
+        (matches, keys) = self.all_pages({
+            'page_size': 3,
+            'entities': [
+                { 'typename': 'Voyages', 'keys': ['1'] },
+                { 'typename': 'Enslaved', 'keys': ['0', '3'] }
+            ]
+        })
+        expected = sorted({f"DOC{i:02d}" for i in range(25) if i % 3 == 1} | {'DOC00', 'DOC03'})
+        self.assertEqual(matches, len(expected))
+        self.assertEqual(keys, expected)
+
+    def all_pages(self, data):
+        keys = []
+        result = self.search(data)
+        matches = result['matches']
+        keys += [item['key'] for item in result['results']]
+        while result['next_cursor']:
+            result = self.search(data | { 'cursor': result['next_cursor'] })
+            # Only the first page is counted.
+            self.assertIsNone(result['matches'])
+            keys += [item['key'] for item in result['results']]
+        return (matches, keys)
+
+    def test_cursor_paging(self):
+        (matches, keys) = self.all_pages({ 'page_size': 10 })
+        self.assertEqual(matches, 25)
+        self.assertEqual(keys, [f"DOC{i:02d}" for i in range(25)])
+        result = self.search({ 'page_size': 10, 'count': True,
+                               'cursor': self.search({ 'page_size': 10 })['next_cursor'] })
+        self.assertEqual(result['matches'], 25)
+
+    def test_results_page(self):
+        result = self.search({ 'page_size': 10, 'results_page': 2 })
+        self.assertEqual(result['results'][0]['key'], 'DOC10')
+        # Out of range pages return the last page.
+        result = self.search({ 'page_size': 10, 'results_page': 9 })
+        self.assertEqual([item['key'] for item in result['results']],
+                         [f"DOC{i:02d}" for i in range(20, 25)])
+
+    def test_invalid_cursor(self):
+        for cursor in ['not a cursor', 'e30=', 'eyJrZXkiOiAxfQ==']:
+            response = self.post('/api/search', { 'cursor': cursor })
+            self.assertEqual(response.status_code, 400, cursor)
+
+    def test_facets(self):
+        result = self.search({ 'label': 'register 1', 'facets': { 'top': 2 } })
+        # Register 1 and Register 10 to 19.
+        self.assertEqual(result['matches'], 11)
+        self.assertEqual(result['facets']['Voyages'], {
+            'count': 11,
+            # Keys with the same count are ordered by key.
+            'top': [{ 'key': '1', 'count': 5 }, { 'key': '0', 'count': 3 }]
+        })
+        self.assertEqual(result['facets']['Enslaved']['count'], 11)
+        self.assertEqual(result['facets']['Enslaved']['top'],
+                         [{ 'key': '1', 'count': 1 }, { 'key': '10', 'count': 1 }])
+        result = self.search({ 'facets': { 'types': ['Voyages'] } })
+        self.assertEqual(list(result['facets'].keys()), ['Voyages'])
+        self.assertEqual(len(result['facets']['Voyages']['top']), 3)
+        self.assertNotIn('facets', self.search({ 'label': 'register 1' }))
+
+    def test_response_cache(self):
+        first = self.post('/api/search', { 'label': 'register' })
+        second = self.post('/api/search', { 'label': '  REGISTER' })
+        self.assertEqual((first['X-Cache'], second['X-Cache']), ('MISS', 'HIT'))
+        self.assertEqual(first.content, second.content)
+        # Publishing a document invalidates the cached responses.
+        self.publish('DOC99', 'Register 99')
+        third = self.post('/api/search', { 'label': 'register' })
+        self.assertEqual(third['X-Cache'], 'MISS')
+        self.assertEqual(third.json()['matches'], 26)
+
+    def test_invalid(self):
+        for data in [{ 'page_size': 0 }, { 'page_size': 'ten' }, { 'page_size': True },
+                     { 'results_page': -1 }, { 'results_page': 1.5 },
+                     { 'entities': { 'Voyages': ['1'] } },
+                     { 'entities': [{ 'typename': 'Voyages', 'keys': '1' }] },
+                     { 'entities': [{ 'keys': ['1'] }] }, ['label']]:
+            response = self.post('/api/search', data)
+            self.assertEqual(response.status_code, 400, data)
+        response = self.post('/api/search/batch', [{ 'page_size': -5 }])
+        self.assertEqual(response.status_code, 400)
+        # Numbers given as strings are accepted.
+        self.assertEqual(len(self.search({ 'page_size': '5', 'results_page': '2' })['results']), 5)
+
+class PublishedDocumentTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.doc = self.publish('DOC1', 'Register  One', entities={ 'Voyages': ['1', '2'] })
+
+    def test_published_copy(self):
+        published = PublishedDocument.objects.get()
+        self.assertEqual((published.key, published.label, published.normalized_label,
+                          published.bib, published.entities),
+                         ('DOC1', 'Register  One', 'register one', 'Bib DOC1',
+                          { 'Voyages': ['1', '2'] }))
+
+    def test_changes_synchronized(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            EntityDocument.objects.filter(entity_key='1').delete()
+            rev = self.doc.revisions.get()
+            rev.label = 'Register two'
+            rev.save()
+        self.assertEqual(self.search({ 'label': 'two' })['results'][0]['entities'],
+                         { 'Voyages': ['2'] })
+        with self.captureOnCommitCallbacks(execute=True):
+            rev.status = DocumentRevision.Status.APPROVED
+            rev.save()
+        self.assertFalse(PublishedDocument.objects.exists())
+
+    def test_entity_type_rename(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            EntityType.objects.filter(name='Voyages').update(name='Trips')
+            EntityType.objects.get(name='Trips').save()
+        self.assertEqual(PublishedDocument.objects.get().entities, { 'Trips': ['1', '2'] })
+
+    def test_version(self):
+        version = self.client.get('/api/stats').json()['published']['version']
+        self.publish('DOC2', 'Register two')
+        self.assertEqual(self.client.get('/api/stats').json()['published']['version'],
+                         version + 1)
+        self.assertEqual(self.client.post('/api/stats').status_code, 405)
+
+    def test_rebuild(self):
+        self.publish('DOC2', 'Register two')
+        # Queryset updates send no signals.
+        DocumentRevision.objects.filter(document=self.doc).update(label='Changed')
+        DocumentRevision.objects.exclude(document=self.doc) \
+            .update(status=DocumentRevision.Status.APPROVED)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            call_command('rebuild_published', '--chunk-size', '1')
+        self.assertIn("Synchronized 2 documents\n1 published documents", out.getvalue())
+        self.assertEqual(PublishedDocument.objects.get().label, 'Changed')
+
+class CacheStatsTests(ApiTestCase):
+
+    def stats(self):
+        response = self.client.get('/api/stats')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_search_counters(self):
+        self.publish('DOC1', 'Ledger')
+        self.search({ 'label': 'ledger' })
+        # The counters are shared by all the tests, which use different
+        # data versions.
+        before = self.stats()['search']
+        self.search({ 'label': 'ledger' })
+        self.post('/api/search/batch', [{ 'label': 'ledger' }, { 'label': 'other' }])
+        self.publish('DOC2', 'Other ledger')
+        self.search({ 'label': 'ledger' })
+        after = self.stats()['search']
+        self.assertEqual(after['hits'] - before['hits'], 2)
+        self.assertEqual(after['misses'] - before['misses'], 2)
+        self.assertEqual(after['invalidations'] - before['invalidations'], 1)
+
+    def test_entity_lookup_counters(self):
+        index = EntityLookupIndex()
+        self.publish('DOC1', 'Ledger', entities={ 'Voyages': ['1'] })
+        index.lookup({ 'Voyages': ['1'] })
+        index.lookup({ 'Voyages': ['1'] })
+        self.publish('DOC2', 'Other', entities={ 'Voyages': ['1'] })
+        (links, _) = index.lookup({ 'Voyages': ['1'] })
+        self.assertEqual(len(links[('Voyages', '1')]), 2)
+        stats = index.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['invalidations']), (1, 2, 1))
+        self.assertEqual((stats['entity_keys'], stats['documents']), (1, 2))
+
+        with mock.patch.object(views, '_entity_lookup_index', index):
+            self.assertEqual(self.stats()['entity_lookup'], stats)
+        self.assertNotIn('entity_lookup', self.stats())
+
+class LabelSearchTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            self.publish(f"LEDGER{i}", f"São Paulo ledger {i}")
+        self.publish('OTHER', 'Bahia register')
+
+    def assertMatches(self, label: str, keys: list[str]):
+        result = self.search({ 'label': label })
+        self.assertEqual(result['matches'], len(keys))
+        self.assertEqual([item['key'] for item in result['results']], keys)
+
+    def test_accent_and_case_insensitive(self):
+        ledgers = ['LEDGER0', 'LEDGER1', 'LEDGER2']
+        self.assertMatches('sao paulo', ledgers)
+        self.assertMatches('SAO', ledgers)
+        self.assertMatches('ledger', ledgers)
+        self.assertMatches('São  PAULO ledger 1', ['LEDGER1'])
+
+    def test_short_label(self):
+        # Labels shorter than the trigrams of the index are matched without it.
+        self.assertMatches('ba', ['OTHER'])
+
+    def test_no_match(self):
+        self.assertMatches('lisbon', [])
+
+    def test_label_change(self):
+        rev = DocumentRevision.objects.get(document__key='OTHER')
+        with self.captureOnCommitCallbacks(execute=True):
+            rev.label = 'Lisbon register'
+            rev.save()
+        self.assertMatches('bahia', [])
+        self.assertMatches('lisbon', ['OTHER'])
+
+class SearchBatchTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(12):
+            self.publish(f"DOC{i:02d}", f"Register {i}", entities={ 'Voyages': [str(i % 4)] })
+
+    def test_same_results_as_single_searches(self):
+        searches = [
+            { 'entities': [{ 'typename': 'Voyages', 'keys': ['1'] }] },
+            { 'entities': [{ 'typename': 'Voyages', 'keys': ['2', '3'] }], 'page_size': 2,
+              'results_page': 2 },
+            { 'entities': [{ 'typename': 'Voyages', 'keys': ['9'] }] },
+            { 'label': 'register 1' },
+            { 'label': 'register', 'facets': True, 'page_size': 5 }
+        ]
+        response = self.post('/api/search/batch', searches)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Cache-Hits'], '0')
+        batch = response.json()
+        cache.clear()
+        self.assertEqual(batch, [self.search(sm) for sm in searches])
+        response = self.post('/api/search/batch', searches)
+        self.assertEqual(response['X-Cache-Hits'], str(len(searches)))
+        self.assertEqual(response.json(), batch)
+
+    def test_errors(self):
+        response = self.post('/api/search/batch', [{ 'label': 'register 1' }, { 'cursor': 'bad' }])
+        self.assertEqual(response.status_code, 200)
+        (result, error) = response.json()
+        self.assertEqual(result['matches'], 3)
+        self.assertEqual(error, { 'error': 'Invalid cursor' })
+        self.assertEqual(self.post('/api/search/batch', { 'label': 'x' }).status_code, 400)
+        response = self.client.post('/api/search/batch', '{bad', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        with self.settings(SEARCH_BATCH_MAX_SIZE=2):
+            response = self.post('/api/search/batch', [{}, {}, {}])
+            self.assertEqual(response.status_code, 400)
+
+class LookupTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.publish('DOC1', 'Register 1', entities={ 'Voyages': ['1', '2'], 'Enslaved': ['1'] })
+        self.publish('DOC2', 'Register 2', entities={ 'Voyages': ['1'] })
+        # Documents that are not published are not returned.
+        doc = Document.objects.create(key='DRAFT')
+        EntityDocument.objects.create(document=doc, entity_type=EntityType.objects.get(name='Voyages'),
+                                      entity_key='1')
+
+    def test_lookup(self):
+        response = self.post('/api/lookup', { 'Voyages': ['1', '2', '3'], 'Enslaved': ['1'],
+                                              'Enslavers': ['1'] })
+        self.assertEqual(response.status_code, 200)
+        doc1 = { 'key': 'DOC1', 'label': 'Register 1', 'thumb': None }
+        doc2 = { 'key': 'DOC2', 'label': 'Register 2', 'thumb': None }
+        self.assertEqual(response.json(), {
+            'Voyages': { '1': [doc1, doc2], '2': [doc1] },
+            'Enslaved': { '1': [doc1] },
+            'Enslavers': {}
+        })
+
+    def test_in_memory_index(self):
+        keys = { 'Voyages': ['1', '2', '3'], 'Enslaved': ['1'] }
+        (links, docs) = EntityLookupIndex().lookup(keys)
+        (expected_links, expected_docs) = views._lookup_links(keys)
+        # The links to documents that are not published are filtered by the
+        # view.
+        self.assertEqual({k: sorted(v) for k, v in links.items()},
+                         {k: sorted(doc_id for doc_id in v if doc_id in expected_docs)
+                          for k, v in expected_links.items()})
+        self.assertEqual({doc_id: docs[doc_id] for ids in links.values() for doc_id in ids},
+                         expected_docs)
+
+    def test_invalid(self):
+        for data in [['1'], { 'Voyages': '1' }, { 'Voyages': [1] }]:
+            self.assertEqual(self.post('/api/lookup', data).status_code, 400, data)
+        response = self.client.post('/api/lookup', '{bad', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        with self.settings(ENTITY_LOOKUP_MAX_KEYS=2):
+            response = self.post('/api/lookup', { 'Voyages': ['1', '2'], 'Enslaved': ['1'] })
+            self.assertEqual(response.status_code, 400)
+
+class ExportTests(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(5):
+            self.publish(f"DOC{i}", f"Register {i}", [f"Page {i}"], { 'Voyages': [str(i)] })
+
+    def export(self, query: str = ''):
+        response = self.client.get('/api/export' + query)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        content = b''.join(response.streaming_content).decode('utf-8')
+        return [json.loads(line) for line in content.splitlines()]
+
+    def test_export(self):
+        items = self.export()
+        self.assertEqual([item['key'] for item in items], [f"DOC{i}" for i in range(5)])
+        self.assertNotIn('transcriptions', items[0])
+        self.assertNotIn('entities', items[0])
+        items = self.export('?transcriptions=1&entities=true')
+        self.assertEqual(items[2]['transcriptions'], [{
+            'page': 1,
+            'language': 'en',
+            'is_translation': False,
+            'text': 'Page 2'
+        }])
+        self.assertEqual(items[2]['entities'], { 'Voyages': ['2'] })
+
+    def test_cursor_and_since(self):
+        self.assertEqual([item['key'] for item in self.export('?cursor=DOC2')], ['DOC3', 'DOC4'])
+        updated = sorted(item['updated'] for item in self.export())
+        self.assertEqual(self.export(f"?since={datetime.datetime.now().year + 1}-01-01"), [])
+        self.assertEqual(len(self.export('?' + urlencode({ 'since': updated[0] }))), 5)
+        self.assertEqual(len(self.export('?' + urlencode({ 'since': updated[-1] }))),
+                         updated.count(updated[-1]))
+        response = self.client.get('/api/export?since=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+
+    def test_export_catalog(self):
+        with tempfile.TemporaryDirectory() as out_dir, \
+                contextlib.redirect_stderr(io.StringIO()) as err:
+            call_command('export_catalog', '--out', f"{out_dir}/catalog.ndjson", '--entities',
+                         '--cursor', 'DOC1', '--batch-size', '2')
+            with open(f"{out_dir}/catalog.ndjson", encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        self.assertEqual(lines, [json.dumps(item) for item in self.export('?cursor=DOC1&entities=1')])
+        self.assertIn("Exported 3 documents", err.getvalue())
+        with self.assertRaisesMessage(CommandError, "Invalid --since time: yesterday"):
+            call_command('export_catalog', '--since', 'yesterday')
+
+def _voyage(key: str, text: str = 'Page text', image: str = 'img1'):
+    return {
+        'id': 1,
+        'zotero_item_id': key,
+        'last_updated': '2024-01-02T00:00:00.000Z',
+        'page_connections': [
+            { 'page': {
+                'iiif_baseimage_url': f"https://iiif.example.org/iiif/{image}/full/max/0/default.jpg",
+                'transcription': text
+            } },
+            { 'page': { 'iiif_baseimage_url': None, 'transcription': None } }
+        ],
+        'source_voyage_connections': [{ 'voyage': { 'id': 7 } }],
+        'source_enslaved_connections': [{ 'enslaved': { 'id': 8 } }],
+        'source_enslaver_connections': []
+    }
+
+def _rdf(key: str):
+    return { 'Title': [f"Source {key}"], 'Date': ['1790'] }
+
+class ImportTests(TestCase):
+
+    def setUp(self):
+        self.entity_types = {t.name: t for t in EntityType.objects.all()}
+
+    def test_import_chunk(self):
+        records = [ImportCommand._prepare_record(key, _voyage(key),
+                                                 _rdf(key) | { 'bib': f"Bib {key}" })
+                   for key in ['K1', 'K2']]
+        stats = _ImportStats()
+        # One query per stage, and one to resolve the documents and revisions.
+        with self.assertNumQueries(8), self.captureOnCommitCallbacks() as callbacks:
+            ImportCommand._import_chunk(records, self.entity_types, stats)
+        # The published copies of the documents are synchronized on commit.
+        self.assertTrue(callbacks)
+        self.assertEqual(list(Document.objects.order_by('key').values_list('key', 'bib')),
+                         [('K1', 'Bib K1'), ('K2', 'Bib K2')])
+        rev = DocumentRevision.objects.get(document__key='K2')
+        self.assertEqual((rev.revision_number, rev.status), (1, DocumentRevision.Status.IMPORTED))
+        self.assertEqual(rev.content['page_images'], [['iiif.example.org', '/iiif/img1']])
+        self.assertEqual(list(rev.transcriptions.values_list('page_number', 'text')),
+                         [(1, 'Page text')])
+        self.assertEqual(list(rev.pages.order_by('page_number')
+                              .values_list('page_number', 'image_url')),
+                         [(1, 'https://iiif.example.org/iiif/img1'), (2, None)])
+        self.assertEqual(sorted(EntityDocument.objects.filter(document=rev.document)
+                                .values_list('entity_type__name', 'entity_key')),
+                         [('Enslaved', '8'), ('Voyage sources', '1'), ('Voyages', '7')])
+        self.assertEqual([line.split(':')[0] for line in stats.summary()],
+                         ['documents', 'revision hashes', 'revisions', 'pages', 'transcriptions',
+                          'entity links'])
+
+    def test_bad_iiif_url(self):
+        voyage = _voyage('K1')
+        voyage['page_connections'][0]['page']['iiif_baseimage_url'] = 'https://bad/url.jpg'
+        with self.assertRaisesMessage(Exception, 'Bad format for IIIF url'):
+            ImportCommand._prepare_record('K1', voyage, _rdf('K1'))
+
+    def import_records(self, records: list[dict], quarantined: list | None = None):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return ImportCommand._import_records(
+                records, {r['key']: { 'key': r['key'] } for r in records}, quarantined or [],
+                records[-1]['key'], self.entity_types, _ImportStats())
+
+    def test_revisions_only_for_changed_content(self):
+        record = ImportCommand._prepare_record('K1', _voyage('K1'), _rdf('K1'))
+        self.assertEqual(self.import_records([record]), (1, 1))
+        self.assertEqual(self.import_records([record]), (1, 0))
+        changed = ImportCommand._prepare_record('K1', _voyage('K1', 'New text'), _rdf('K1'))
+        self.assertEqual(self.import_records([changed]), (1, 1))
+        revisions = DocumentRevision.objects.filter(document__key='K1').order_by('revision_number')
+        self.assertEqual([rev.revision_number for rev in revisions], [1, 2])
+        self.assertEqual(list(revisions[1].transcriptions.values_list('page_number', 'text')),
+                         [(1, 'New text')])
+        self.assertEqual(list(revisions[1].pages.values_list('page_number', 'image_url')),
+                         [(1, 'https://iiif.example.org/iiif/img1'), (2, None)])
+        self.assertEqual(sorted(EntityDocument.objects.values_list('entity_type__name', 'entity_key')),
+                         [('Enslaved', '8'), ('Voyage sources', '1'), ('Voyages', '7')])
+
+    def test_revisions_without_hash(self):
+        record = ImportCommand._prepare_record('K1', _voyage('K1'), _rdf('K1'))
+        self.import_records([record])
+        DocumentRevision.objects.update(content_hash=None)
+        # The hash of the stored content is the hash of the imported content.
+        self.assertEqual(self.import_records([record]), (1, 0))
+        self.assertEqual(DocumentRevision.objects.get().content_hash, record['content_hash'])
+
+    def test_quarantine(self):
+        good = ImportCommand._prepare_record('K1', _voyage('K1'), _rdf('K1'))
+        bad = ImportCommand._prepare_record('K2', _voyage('K2'), _rdf('K2'))
+        bad['label'] = None
+        self.assertEqual(self.import_records([good, bad]), (1, 1))
+        self.assertEqual(list(Document.objects.values_list('key', flat=True)), ['K1'])
+        quarantined = QuarantinedRecord.objects.get()
+        self.assertEqual((quarantined.source, quarantined.key, quarantined.data),
+                         ('import_external', 'K2', { 'key': 'K2' }))
+        self.assertTrue(quarantined.error.startswith('IntegrityError'))
+        self.assertEqual(ImportCheckpoint.objects.get().key, 'K2')
+        # The record leaves the quarantine once it is imported.
+        fixed = ImportCommand._prepare_record('K2', _voyage('K2'), _rdf('K2'))
+        self.assertEqual(self.import_records([fixed]), (1, 1))
+        self.assertFalse(QuarantinedRecord.objects.exists())
+
+class ImportCommandTests(TestCase):
+    """
+    Runs the import command on sources returned directly instead of fetched
+    from the APIs.
+    """
+
+    def run_import(self, *args, changed: set[str] | None = None, voyages: dict | None = None):
+        def put(index: SourceIndex, table: str, items: dict):
+            # The unchanged sources are loaded from a cache, as in an
+            # incremental import.
+            if changed is not None:
+                with tempfile.TemporaryDirectory() as dir:
+                    filename = os.path.join(dir, 'cache')
+                    with RecordCache(filename) as cache:
+                        cache.write(table, [(key, json.dumps(data)) for (key, data) in items.items()
+                                            if key not in changed])
+                    index.load(filename)
+            index.put(table, [(key, data) for (key, data) in items.items()
+                              if changed is None or key in changed])
+        def get_zotero_data(options, fetcher, index, group_ids, versions):
+            put(index, 'zotero', {key: _rdf(key) for key in ['K1', 'K2']})
+            return { 'zotero:1': '5' }
+        def get_voyages_data(options, fetcher, index, versions):
+            put(index, 'voyages', voyages or {key: _voyage(key) for key in ['K1', 'K2', 'K3']})
+            return { 'voyages': '2024-01-02' }
+        groups = mock.Mock(json=lambda: [{ 'id': 1, 'data': { 'name': 'Group' } }])
+        with mock.patch.object(ImportCommand, '_get_zotero_data', get_zotero_data), \
+                mock.patch.object(ImportCommand, '_get_voyages_data', get_voyages_data), \
+                mock.patch.object(PagedFetcher, 'get', return_value=groups), \
+                contextlib.redirect_stdout(io.StringIO()) as out:
+            call_command('import_external', *args)
+        return out.getvalue()
+
+    def test_import(self):
+        out = self.run_import('--chunk-size', '1')
+        self.assertIn("Imported 2 documents\n", out)
+        self.assertIn("entity links: 6 rows", out)
+        self.assertIn("Import finished, 2 documents imported, 2 new revisions", out)
+        # Sources without Zotero data are skipped.
+        self.assertEqual(list(Document.objects.order_by('key').values_list('key', flat=True)),
+                         ['K1', 'K2'])
+        self.assertEqual(SourceVersion.all_versions(),
+                         { 'zotero:1': '5', 'voyages': '2024-01-02' })
+        self.assertIn("2 documents imported, 0 new revisions", self.run_import())
+
+    def test_incremental(self):
+        self.assertIn("1 documents imported", self.run_import('--incremental', changed={'K2'}))
+        self.assertEqual(list(Document.objects.values_list('key', flat=True)), ['K2'])
+
+    def test_bad_source_quarantined(self):
+        voyages = {key: _voyage(key) for key in ['K1', 'K2']}
+        voyages['K2']['page_connections'][0]['page']['iiif_baseimage_url'] = 'https://bad/url.jpg'
+        out = self.run_import(voyages=voyages)
+        self.assertIn("1 documents imported, 1 new revisions, 1 sources quarantined", out)
+        quarantined = QuarantinedRecord.objects.get()
+        self.assertEqual(quarantined.key, 'K2')
+        self.assertEqual(quarantined.data['voyages']['zotero_item_id'], 'K2')
+        self.assertFalse(ImportCheckpoint.objects.exists())
+
+    def test_resume(self):
+        ImportCheckpoint.objects.create(name='import_external', key='K1')
+        out = self.run_import('--resume')
+        self.assertIn("Resuming the import after K1", out)
+        self.assertEqual(list(Document.objects.values_list('key', flat=True)), ['K2'])
+        self.assertFalse(ImportCheckpoint.objects.exists())
+
+class PagedFetcherTests(SimpleTestCase):
+
+    def fetch_page(self, offset: int):
+        self.requested.append(offset)
+        page = list(range(offset, min(offset + 10, 95)))
+        return (page, len(page), 95)
+
+    def test_pages_in_order(self):
+        self.requested = []
+        with PagedFetcher(workers=2) as fetcher:
+            pages = fetcher.fetch_pages(self.fetch_page, ErrorBudget('Test', 3))
+            self.assertEqual(next(pages), list(range(10)))
+            self.assertEqual(next(pages), list(range(10, 20)))
+            time.sleep(0.1)
+            # The first page, the consumed page and a window of twice the
+            # number of workers.
+            self.assertEqual(len(self.requested), 2 + 2 * 2)
+            rest = [item for page in pages for item in page]
+        self.assertEqual(rest, list(range(20, 95)))
+
+    def test_retries(self):
+        self.requested = []
+        failures = [20, 20]
+        def fetch_page(offset: int):
+            if offset in failures:
+                failures.remove(offset)
+                raise Exception("Failed")
+            return self.fetch_page(offset)
+        with PagedFetcher(workers=2) as fetcher:
+            items = [item for page in fetcher.fetch_pages(fetch_page, ErrorBudget('Test', 3))
+                     for item in page]
+        self.assertEqual(items, list(range(95)))
+        # A single worker so that no other page resets the error count.
+        with PagedFetcher(workers=1) as fetcher:
+            failures = [20, 20, 20]
+            with self.assertRaises(Exception):
+                list(fetcher.fetch_pages(fetch_page, ErrorBudget('Test', 3)))
+
+class SourceIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'cache')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_join(self):
+        with SourceIndex() as index, RecordCache(self.filename) as cache:
+            index.put('a', [('K1', { 'v': 1 }), ('K2', { 'v': 2 }), ('K3', { 'v': 3 })], cache)
+            index.put('b', [('K1', 'b1'), ('K3', 'b3')], cache)
+            index.put('a', [('K1', { 'v': 10 })], cache)
+            self.assertEqual(list(index.join(['a'], ['b'])), [
+                ('K1', [{ 'v': 10 }, 'b1']), ('K2', [{ 'v': 2 }, None]), ('K3', [{ 'v': 3 }, 'b3'])
+            ])
+            self.assertEqual([key for (key, _) in index.join(['a', 'b'], after='K1')], ['K3'])
+        with open(self.filename, 'a', encoding='utf-8') as f:
+            # A record cut short by an interrupted write.
+            f.write('["a", "K4", {"v"')
+        with SourceIndex() as index:
+            self.assertEqual(index.load(self.filename), 6)
+            self.assertEqual(list(index.join(['a'], changed_only=True)), [])
+            with RecordCache(self.filename, append=True) as cache:
+                index.put('b', [('K2', 'b2')], cache)
+            self.assertEqual(list(index.join(['a', 'b'], changed_only=True)),
+                             [('K2', [{ 'v': 2 }, 'b2'])])
+            self.assertEqual(index.count(['a', 'b']), 6)
+
+    def test_incomplete_cache(self):
+        with RecordCache(self.filename) as cache:
+            cache.write('a', [('K1', '1')])
+        with self.assertRaises(ValueError):
+            with RecordCache(self.filename) as cache:
+                cache.write('a', [('K2', '2')])
+                raise ValueError()
+        # An incomplete cache doesn't replace the existing one.
+        self.assertEqual(list(RecordCache.read(self.filename)), [['a', 'K1', 1]])
+        self.assertEqual(os.listdir(self.dir.name), ['cache'])
+
+    def test_append_after_interrupted_write(self):
+        with RecordCache(self.filename) as cache:
+            cache.write('a', [('K1', '1')])
+        with open(self.filename, 'a', encoding='utf-8') as f:
+            f.write('["a", "K4", {"v"')
+        with RecordCache(self.filename, append=True) as cache:
+            cache.write('a', [('K2', '2')])
+            cache.write('a', [('K3', '3')])
+        self.assertEqual(list(RecordCache.read(self.filename)),
+                         [['a', 'K1', 1], ['a', 'K2', 2], ['a', 'K3', 3]])
+
+class FacetValidationTests(ApiTestCase):
+
+    def test_invalid_facets(self):
+        for facets in [{ 'top': '5' }, { 'top': -1 }, { 'top': True }, { 'types': 'Voyages' },
+                       { 'types': [1] }]:
+            response = self.post('/api/search', { 'facets': facets })
+            self.assertEqual(response.status_code, 400, facets)
+        response = self.post('/api/search/batch', [{ 'facets': { 'top': 1.5 } }])
+        self.assertEqual(response.status_code, 400)
+
+    def test_valid_facets(self):
+        result = self.search({ 'facets': { 'top': 0, 'types': ['Voyages'] } })
+        self.assertEqual(result['facets'], {})
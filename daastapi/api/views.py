@@ -1,12 +1,23 @@
+import base64
+import datetime
+import hashlib
+import json
 from django.conf import settings
-from django.core.paginator import Paginator
-from django.db.models import F, Q, Subquery
-from django.http import Http404, JsonResponse
+from django.core.cache import cache
+from django.db.models import Count, F, Q, Subquery, Window
+from django.db.models.functions import RowNumber
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, \
+    StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_GET, require_POST
 from functools import reduce
-from api.models import Document, DocumentRevision, EntityCache, EntityDocument, SearchModel
+from api import fulltext
+from api.export import export_lines
+from api.models import CacheCounters, CacheVersion, Document, DocumentRevision, \
+    EntityDocument, EntityLookupIndex, PublishedDocument, SearchFacets, SearchModel
 
 def manifest(request, key: str, rev_number_query: int | None = None):
     """
@@ -25,7 +36,69 @@ def manifest(request, key: str, rev_number_query: int | None = None):
         raise Http404
     return redirect(f"{settings.MANIFEST_URL_BASE}/{key}_rev{str(doc.current_rev).zfill(3)}.json")
 
-_entity_cache = EntityCache()
+def _encode_cursor(position: dict):
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+def _decode_cursor(cursor: str):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception as ex:
+        raise ValueError(f"Invalid cursor: {cursor}") from ex
+    if not isinstance(position, dict):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return position
+
+# The maximum number of keys or ids in the IN clauses of batch queries.
+_batch_query_size = 500
+
+# The fields of each search result.
+_result_fields = ['label', 'revision_number', 'key', 'bib', 'entities']
+_result_named_fields = {
+    'thumb': F('thumbnail')
+}
+
+def _cache_key(sm: SearchModel, version: int):
+    # Responses are cached by data version so that every cached response is
+    # invalidated when the published documents change.
+    return f"search:{version}:" + hashlib.sha256(sm.canonical().encode('utf-8')).hexdigest()
+
+def _page_offset(sm: SearchModel, count: int):
+    # Out of range pages return the last page.
+    page_number = max(1, min(sm.results_page, (count - 1) // sm.page_size + 1))
+    return (page_number - 1) * sm.page_size
+
+def _facets(qs, facets: SearchFacets):
+    """
+    Count the matching documents linked to each entity type and to its most
+    linked entity keys, using grouped queries over the whole result set.
+    """
+    links = EntityDocument.objects.filter(document_id__in=qs.values('document_id'))
+    if facets.types is not None:
+        links = links.filter(entity_type__name__in=facets.types)
+    result = {}
+    by_type = links \
+        .values('entity_type__name') \
+        .annotate(count=Count('document_id', distinct=True)) \
+        .order_by('entity_type__name')
+    for item in by_type:
+        result[item['entity_type__name']] = { 'count': item['count'], 'top': [] }
+    if facets.top > 0 and result:
+        # Keep the top keys of each type with a window function instead of
+        # one query per type.
+        top_keys = links \
+            .values('entity_type__name', 'entity_key') \
+            .annotate(count=Count('document_id')) \
+            .annotate(position=Window(RowNumber(), partition_by=F('entity_type__name'),
+                                      order_by=[F('count').desc(), F('entity_key').asc()])) \
+            .filter(position__lte=facets.top) \
+            .order_by('entity_type__name', 'position')
+        for item in top_keys:
+            result[item['entity_type__name']]['top'].append(
+                { 'key': item['entity_key'], 'count': item['count'] })
+    return result
+
+# Usage counters of the search response cache in this process.
+_search_cache_counters = CacheCounters()
 
 @csrf_exempt
 @require_POST
@@ -33,13 +106,39 @@ def search(request):
     """
     Search endpoint for Documents.
     """
-    sm = SearchModel.from_json(request.body.decode('utf-8'))
+    try:
+        sm = SearchModel.from_json(request.body.decode('utf-8'))
+    except ValueError as ex:
+        return HttpResponseBadRequest(str(ex))
+    version = CacheVersion.current(PublishedDocument.version_name)
+    cache_key = _cache_key(sm, version)
+    content = cache.get(cache_key)
+    _search_cache_counters.record(version, hits=int(content is not None),
+                                  misses=int(content is None))
+    if content is not None:
+        response = HttpResponse(content, content_type='application/json')
+        response['X-Cache'] = 'HIT'
+        return response
+    response = _search(sm)
+    if response.status_code == 200:
+        cache.set(cache_key, response.content, settings.SEARCH_CACHE_TIMEOUT)
+    response['X-Cache'] = 'MISS'
+    return response
+
+def _search(sm: SearchModel):
+    """
+    Run a search and build its response.
+    """
     # Start with the current published revisions.
-    qs = DocumentRevision.objects \
-        .filter(status=DocumentRevision.Status.PUBLISHED) \
-        .filter(revision_number=F('document__current_rev'))
+    qs = PublishedDocument.objects.all()
     if sm.label:
-        qs = qs.filter(label__icontains=sm.label)
+        # Labels are matched case and accent insensitively.
+        label = PublishedDocument.normalize_label(sm.label)
+        label_ids = fulltext.matching_labels(label)
+        if label_ids is not None:
+            qs = qs.filter(id__in=label_ids)
+        else:
+            qs = qs.filter(normalized_label__contains=label)
     if sm.entities:
         entity_filter = [Q(entity_type__name=e.typename) & Q(entity_key__in=e.keys)
                          for e in sm.entities]
@@ -47,13 +146,256 @@ def search(request):
             .filter(reduce(lambda x, y: x | y, entity_filter)) \
             .values_list('document_id')
         qs = qs.filter(document_id__in=Subquery(entity_query))
-    qs = qs.order_by('document__key')
-    qs = qs.values('label', 'revision_number',
-            key=F('document__key'),
-            thumb=F('document__thumbnail'),
-            bib=F('document__bib'))
-    paginator = Paginator(qs, sm.page_size)
-    results = list(paginator.get_page(sm.results_page))
-    for item in results:
-        item['entities'] = _entity_cache.get(item['key'])
-    return JsonResponse({ 'matches': qs.count(), 'results': results })
+    if sm.text:
+        if not fulltext.is_supported():
+            return HttpResponseBadRequest("Full-text search is not supported by this database")
+        if not fulltext.has_terms(sm.text):
+            return JsonResponse({ 'matches': 0, 'results': [], 'next_cursor': None })
+        qs = qs.filter(revision_id__in=fulltext.matching_revisions(sm.text, sm.language))
+    try:
+        cursor = _decode_cursor(sm.cursor) if sm.cursor else None
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor")
+    # Counting all the matches is expensive so only the first page is
+    # counted unless the client asks for it.
+    count = qs.count() if cursor is None or sm.count else None
+    facets = _facets(qs, sm.facets) if sm.facets else None
+    offset = _page_offset(sm, count) if cursor is None and count is not None else 0
+    if sm.text:
+        # Rank the matching revisions by their best matching transcription.
+        if cursor is not None and not (isinstance(cursor.get('score'), (int, float)) and \
+                                       isinstance(cursor.get('id'), int)):
+            return HttpResponseBadRequest("Invalid cursor")
+        after = (cursor['score'], cursor['id']) if cursor else None
+        ranked = fulltext.rank_revisions(sm.text, sm.language, qs.values('revision_id'),
+                                         sm.page_size + 1, offset, after)
+        next_cursor = { 'score': ranked[-2][1], 'id': ranked[-2][0] } \
+            if len(ranked) > sm.page_size else None
+        ranked = ranked[:sm.page_size]
+        rows = {item['revision_id']: item for item in
+                qs.filter(revision_id__in=[rev_id for (rev_id, _) in ranked])
+                    .values('revision_id', *_result_fields, **_result_named_fields)}
+        snippets = fulltext.snippets([rev_id for (rev_id, _) in ranked], sm.text, sm.language)
+        results = []
+        for (rev_id, score) in ranked:
+            item = rows[rev_id]
+            del item['revision_id']
+            item['score'] = score
+            item['snippets'] = snippets.get(rev_id, [])
+            results.append(item)
+    else:
+        if cursor is not None and not isinstance(cursor.get('key'), str):
+            return HttpResponseBadRequest("Invalid cursor")
+        # The document key is a unique sort key for keyset pagination.
+        qs = qs.order_by('key')
+        if cursor:
+            qs = qs.filter(key__gt=cursor['key'])
+        qs = qs.values(*_result_fields, **_result_named_fields)
+        results = list(qs[offset:offset + sm.page_size + 1])
+        next_cursor = { 'key': results[-2]['key'] } if len(results) > sm.page_size else None
+        results = results[:sm.page_size]
+    response = {
+        'matches': count,
+        'results': results,
+        'next_cursor': _encode_cursor(next_cursor) if next_cursor else None
+    }
+    if facets is not None:
+        response['facets'] = facets
+    return JsonResponse(response)
+
+def _is_entity_search(sm: SearchModel):
+    return bool(sm.entities) and not (sm.label or sm.text or sm.cursor or sm.facets)
+
+def _entity_searches(searches: list[SearchModel]):
+    """
+    Answer searches that only match entities together, with a single query
+    per entity type for the links of all the searches and a single query for
+    all the matching published documents. The responses are the same as the
+    ones of _search.
+    """
+    keys_by_type: dict[str,set[str]] = {}
+    for sm in searches:
+        for e in sm.entities:
+            keys_by_type.setdefault(e.typename, set()).update(e.keys)
+    linked_docs: dict[tuple[str,str],set[int]] = {}
+    for typename, keys in keys_by_type.items():
+        keys = list(keys)
+        for i in range(0, len(keys), _batch_query_size):
+            links = EntityDocument.objects \
+                .filter(entity_type__name=typename) \
+                .filter(entity_key__in=keys[i:i + _batch_query_size]) \
+                .values_list('entity_key', 'document_id')
+            for (entity_key, doc_id) in links:
+                linked_docs.setdefault((typename, entity_key), set()).add(doc_id)
+    doc_ids = list(set().union(*linked_docs.values()))
+    rows = {}
+    for i in range(0, len(doc_ids), _batch_query_size):
+        published = PublishedDocument.objects \
+            .filter(document_id__in=doc_ids[i:i + _batch_query_size]) \
+            .values('document_id', *_result_fields, **_result_named_fields)
+        for item in published:
+            rows[item.pop('document_id')] = item
+    responses = []
+    for sm in searches:
+        matches = set()
+        for e in sm.entities:
+            for key in e.keys:
+                matches.update(linked_docs.get((e.typename, key), ()))
+        results = sorted((rows[doc_id] for doc_id in matches if doc_id in rows),
+                         key=lambda item: item['key'])
+        count = len(results)
+        offset = _page_offset(sm, count)
+        page = results[offset:offset + sm.page_size]
+        next_cursor = { 'key': page[-1]['key'] } if offset + sm.page_size < count else None
+        responses.append(JsonResponse({
+            'matches': count,
+            'results': page,
+            'next_cursor': _encode_cursor(next_cursor) if next_cursor else None
+        }))
+    return responses
+
+@csrf_exempt
+@require_POST
+def search_batch(request):
+    """
+    Batch search endpoint for Documents, the request is a JSON list of
+    searches and the response has the list of their responses in the same
+    order. Searches that only match entities are answered together.
+    """
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except ValueError as ex:
+        return HttpResponseBadRequest(str(ex))
+    if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
+        return HttpResponseBadRequest("Expected a list of searches")
+    if len(data) > settings.SEARCH_BATCH_MAX_SIZE:
+        return HttpResponseBadRequest(
+            f"At most {settings.SEARCH_BATCH_MAX_SIZE} searches can be sent at once")
+    try:
+        searches = [SearchModel.from_dict(item) for item in data]
+    except ValueError as ex:
+        return HttpResponseBadRequest(str(ex))
+    version = CacheVersion.current(PublishedDocument.version_name)
+    cache_keys = [_cache_key(sm, version) for sm in searches]
+    cached = cache.get_many(set(cache_keys))
+    contents = [cached.get(key) for key in cache_keys]
+    missing = [i for i, content in enumerate(contents) if content is None]
+    _search_cache_counters.record(version, hits=len(searches) - len(missing),
+                                  misses=len(missing))
+    grouped = [i for i in missing if _is_entity_search(searches[i])]
+    responses = dict(zip(grouped, _entity_searches([searches[i] for i in grouped])))
+    for i in missing:
+        if i not in responses:
+            responses[i] = _search(searches[i])
+    fresh = {}
+    for i, response in responses.items():
+        if response.status_code == 200:
+            contents[i] = response.content
+            fresh[cache_keys[i]] = response.content
+        else:
+            contents[i] = json.dumps({ 'error': response.content.decode('utf-8') }).encode('utf-8')
+    cache.set_many(fresh, settings.SEARCH_CACHE_TIMEOUT)
+    response = HttpResponse(b'[' + b','.join(contents) + b']', content_type='application/json')
+    response['X-Cache-Hits'] = str(len(searches) - len(missing))
+    return response
+
+def _lookup_links(keys_by_type: dict[str,list[str]]):
+    """
+    Query the published documents linked to the given entity keys, as a
+    dict of (type name, entity key) to document ids and a dict of document
+    ids to documents. The links are read from the entity_doc_lookup
+    covering index with one query per type and chunk of keys.
+    """
+    links = {}
+    for typename, keys in keys_by_type.items():
+        for i in range(0, len(keys), _batch_query_size):
+            items = EntityDocument.objects \
+                .filter(entity_type__name=typename) \
+                .filter(entity_key__in=keys[i:i + _batch_query_size]) \
+                .values_list('entity_key', 'document_id')
+            for (entity_key, doc_id) in items:
+                links.setdefault((typename, entity_key), []).append(doc_id)
+    doc_ids = list(set().union(*links.values()))
+    docs = {}
+    for i in range(0, len(doc_ids), _batch_query_size):
+        published = PublishedDocument.objects \
+            .filter(document_id__in=doc_ids[i:i + _batch_query_size]) \
+            .values('document_id', 'key', 'label', 'thumbnail')
+        for item in published:
+            docs[item.pop('document_id')] = item
+    return (links, docs)
+
+_entity_lookup_index = EntityLookupIndex() if settings.ENTITY_LOOKUP_IN_MEMORY else None
+
+@csrf_exempt
+@require_POST
+def lookup(request):
+    """
+    Reverse lookup endpoint of the published Documents linked to entities.
+    The request is a JSON object of entity keys indexed by entity type name
+    and the response has, for each type and entity key, the list of linked
+    documents.
+    """
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except ValueError as ex:
+        return HttpResponseBadRequest(str(ex))
+    if not isinstance(data, dict) or \
+            not all(isinstance(keys, list) and all(isinstance(k, str) for k in keys)
+                    for keys in data.values()):
+        return HttpResponseBadRequest("Expected lists of entity keys indexed by entity type")
+    keys_by_type = {typename: list(set(keys)) for typename, keys in data.items()}
+    if sum(len(keys) for keys in keys_by_type.values()) > settings.ENTITY_LOOKUP_MAX_KEYS:
+        return HttpResponseBadRequest(
+            f"At most {settings.ENTITY_LOOKUP_MAX_KEYS} entity keys can be looked up at once")
+    if _entity_lookup_index is not None:
+        (links, docs) = _entity_lookup_index.lookup(keys_by_type)
+    else:
+        (links, docs) = _lookup_links(keys_by_type)
+    result = {typename: {} for typename in keys_by_type}
+    for (typename, entity_key), doc_ids in links.items():
+        matches = sorted((docs[doc_id] for doc_id in doc_ids if doc_id in docs),
+                         key=lambda doc: doc['key'])
+        if matches:
+            result[typename][entity_key] = [{
+                'key': doc['key'],
+                'label': doc['label'],
+                'thumb': doc['thumbnail']
+            } for doc in matches]
+    return JsonResponse(result)
+
+@require_GET
+def cache_stats(request):
+    """
+    Usage counters of the caches of this process.
+    """
+    stats = {
+        'published': { 'version': CacheVersion.current(PublishedDocument.version_name) },
+        'search': _search_cache_counters.stats()
+    }
+    if _entity_lookup_index is not None:
+        stats['entity_lookup'] = _entity_lookup_index.stats()
+    return JsonResponse(stats)
+
+def _flag(request, name: str):
+    return request.GET.get(name, '').lower() in ('1', 'true', 'yes')
+
+@require_GET
+def export(request):
+    """
+    Streaming export endpoint of the published Documents as newline
+    delimited JSON. An interrupted export is resumed by passing the key of
+    the last document received as the cursor, and harvesters can request
+    only the documents updated since an ISO 8601 time.
+    """
+    since = None
+    if request.GET.get('since'):
+        since = parse_datetime(request.GET['since'])
+        if since is None:
+            return HttpResponseBadRequest("Invalid since time")
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since, datetime.timezone.utc)
+    lines = export_lines(request.GET.get('cursor'), since,
+                         _flag(request, 'transcriptions'), _flag(request, 'entities'))
+    return StreamingHttpResponse((line.encode('utf-8') for line in lines),
+                                 content_type='application/x-ndjson')
@@ -85,6 +85,31 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'daastapi',
+    }
+}
+
+# Number of seconds search responses are cached. Cached responses are also
+# invalidated as soon as the published documents change.
+SEARCH_CACHE_TIMEOUT = 300
+
+# The maximum number of searches in a batch search request.
+SEARCH_BATCH_MAX_SIZE = 100
+
+# The maximum number of entity keys in a reverse lookup request.
+ENTITY_LOOKUP_MAX_KEYS = 10000
+
+# Whether reverse lookups are served from an in-memory inverted index of all
+# the entity links of published documents instead of database queries.
+ENTITY_LOOKUP_IN_MEMORY = False
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -17,11 +17,15 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, re_path
 
-from api.views import manifest, search
+from api.views import cache_stats, export, lookup, manifest, search, search_batch
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/search', search),
+    path('api/search/batch', search_batch),
+    path('api/lookup', lookup),
+    path('api/export', export),
+    path('api/stats', cache_stats),
     re_path(r"api/manifest/(?P<key>[0-9A-Z]+)/(?P<rev_number_query>[0-9]+)", manifest),
     re_path(r"api/manifest/(?P<key>[0-9A-Z]+)", manifest),
 ]